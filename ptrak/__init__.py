@@ -1,6 +1,6 @@
 """ """
 import os
-from flask import Flask, render_template, session, g, url_for
+from flask import Flask, current_app, render_template, request, session, g, url_for, jsonify
 from base64 import b64decode
 
 def create_app(test_config=None):
@@ -26,6 +26,19 @@ def create_app(test_config=None):
     )
     # --- END WARNING SECTION ---
 
+    # tunables; the instance/test config can override any of these
+    app.config.from_mapping(
+        UNREAD_PREVIEWS=5,  # unread messages previewed on the dashboard
+        DASHBOARD_ANNOUNCEMENTS=5,  # latest announcements on the dashboard
+        # tasks per page, for each status tab on the project page
+        TASK_PAGE_SIZE={'new': 25, 'in progress': 25, 'under review': 25, 'complete': 10},
+        ANNOUNCEMENT_PAGE_SIZE=10,
+        MESSAGE_PAGE_SIZE=25,  # messages per page of the inbox
+        # items per page in the JSON API (?limit= can ask for up to the max)
+        API_PAGE_SIZE=50,
+        API_MAX_PAGE_SIZE=200,
+    )
+
     if test_config is None:
         # load the instance config, if it exists, when not testing
         app.config.from_pyfile('config.py', silent=True)
@@ -49,7 +62,31 @@ def create_app(test_config=None):
         # add close_db() to the app context teardown
         from . import db
         db.init_app(app)
+        # caches for per-request data (see ptrak.cache)
+        from . import cache
+        cache.init_app(app)
+        from . import fragments
+        fragments.init_app(app)
+        # streamed pages (see ptrak.streaming)
+        from . import streaming
+        streaming.init_app(app)
+        # password hashing pool (see ptrak.passwords)
+        from . import passwords
+        passwords.init_app(app)
+        # full-text search (see ptrak.search)
+        from . import search
+        search.init_app(app)
+        # the user directory, for people pickers (see ptrak.directory)
+        from . import directory
+        directory.init_app(app)
+        # live notifications (see ptrak.notify)
+        from . import notify
+        notify.init_app(app)
+        # task notes (see ptrak.notes)
+        from . import notes
+        notes.init_app(app)
         app.jinja_env.globals.update(mystify=db.mystify, demystify=db.demystify, len=len, enumerate=enumerate)
+        app.jinja_env.filters['timefmt'] = format_time
 
         # add the user blueprint to the app
         from . import user
@@ -67,6 +104,10 @@ def create_app(test_config=None):
         from . import task
         app.register_blueprint(task.bp)
 
+        # add the (read-only) JSON API blueprint to the app
+        from . import api
+        app.register_blueprint(api.bp)
+
 
         @app.route('/')
         def testindex():
@@ -85,4 +126,47 @@ def create_app(test_config=None):
                 + g.user['lastlogin'].strftime(app.config['TIME_FMT'].decode("utf-8")) \
                 + '<br /><a href="/">Return to home page</a>'
 
+        @app.route('/admin/poolstats')
+        @user.login_required(level=5)
+        def poolstats():
+            # connection pool counters for this worker process
+            return jsonify(db.get_pool().stats())
+
+        @app.route('/admin/cachestats')
+        @user.login_required(level=5)
+        def cachestats():
+            return jsonify(shared=cache.get_cache().stats(),
+                           fragments=fragments.get_fragment_cache().stats())
+
+        @app.route('/admin/notifystats')
+        @user.login_required(level=5)
+        def notifystats():
+            # open event streams and events published, for this worker
+            return jsonify(notify.get_broker().stats())
+
+        from . import instrument
+        if instrument.get_monitor(app) is not None and app.config['SQL_DEBUG_ENDPOINT']:
+            @app.route('/admin/sqlstats')
+            @user.login_required(level=5)
+            def sqlstats():
+                # the statements this worker has spent the most time on;
+                # ?by=calls|mean|max and ?top=N
+                by = request.args.get('by', 'total')
+                if by not in ('total', 'calls', 'mean', 'max'):
+                    by = 'total'
+                top = instrument.get_monitor().top(request.args.get('top', 20, type=int), by)
+                return jsonify(by=by, statements=top)
+
     return app
+
+def format_time(value):
+    """
+    Template filter: format a timestamp with the app's ``TIME_FMT``.
+    Empty values (e.g., a project with no due date) come out blank.
+    """
+    if not value:
+        return ''
+    fmt = current_app.config['TIME_FMT']
+    if isinstance(fmt, bytes):
+        fmt = fmt.decode('utf-8')
+    return value.strftime(fmt)
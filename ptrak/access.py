@@ -0,0 +1,115 @@
+"""
+Project-level authorization.
+
+Almost every project/task view needs to know whether the current user
+is involved in a project, and at what rank (1 = contributor,
+3 = manager). Rather than asking ``Involvements`` each time, we load
+the user's whole pid -> rank map once per request, and, with a shared
+cache (the ``redis`` backend of ``ptrak.cache``), keep it there.
+
+The in-process ``lru`` backend is never used for ranks: each worker
+has its own copy, and ``forget_ranks()`` only clears the one in the
+worker that made the change, so a removed or demoted member would keep
+their old rank everywhere else until it expired. Without a shared
+cache, the map is read (off the primary key) on every request instead.
+
+Anything that adds, removes or re-ranks someone's involvement must
+call ``forget_ranks()`` for that user.
+"""
+import functools
+
+from flask import current_app, flash, g, has_request_context, redirect, session, url_for
+
+from ptrak.cache import get_cache
+from ptrak.db import get_db
+
+
+# a user's pid -> rank map
+RANKS_QUERY = 'SELECT pid, `rank` FROM Involvements WHERE uid=(%s)'
+
+
+def ranks_cache_key(uid):
+    return 'ranks:{}'.format(uid)
+
+
+def project_ranks(uid=None):
+    """
+    Get the projects a user is involved in, with their rank in each.
+
+    :param uid: the user (defaults to the logged-in user)
+    :return: dict mapping pid to rank
+    """
+    if uid is None:
+        uid = session.get('uid')
+        if uid is None:
+            return {}
+        # the logged-in user's map is asked for a lot; keep it for the request
+        if 'ranks' in g:
+            return g.ranks
+
+    cache = get_cache()
+    key = ranks_cache_key(uid)
+    ranks = cache.get(key) if cache.shared else None
+    if ranks is None:
+        dbcursor = get_db().cursor()
+        dbcursor.execute(RANKS_QUERY, (uid,))
+        ranks = {row['pid']: row['rank'] for row in dbcursor.fetchall()}
+        if cache.shared:
+            cache.set(key, ranks, current_app.config['RANKS_CACHE_TTL'])
+
+    if uid == session.get('uid'):
+        g.ranks = ranks
+    return ranks
+
+
+def project_rank(pid, uid=None):
+    """
+    :return: the user's rank in project ``pid``, or None if not involved
+    """
+    return project_ranks(uid).get(pid)
+
+
+def forget_ranks(*uids):
+    """
+    Drop the cached rank maps for the given users.
+    """
+    get_cache().delete(*[ranks_cache_key(uid) for uid in uids])
+    if has_request_context() and session.get('uid') in uids:
+        g.pop('ranks', None)
+
+
+def involvement_required(view=None, rank=1, message=None, fallback=None):
+    """
+    Restrict a project view (one with a ``pid`` argument) to users
+    involved in that project with at least the given rank. Use it
+    *under* ``login_required``::
+
+        @bp.route('/<int:pid>/edit')
+        @login_required(level=3)
+        @involvement_required(rank=2)
+        def edit(pid):
+            ...
+
+    The user's rank is available to the view as ``g.rank``.
+
+    :param rank: the minimum project rank needed
+    :param message: what to flash if the user doesn't qualify
+    :param fallback: endpoint to send them to instead (given ``pid``
+                     if it's a project endpoint); defaults to the dashboard
+    """
+    if view is None:
+        return functools.partial(involvement_required, rank=rank,
+                                 message=message, fallback=fallback)
+
+    @functools.wraps(view)
+    def wrapped_view(*args, **kwargs):
+        pid = kwargs['pid']
+        userrank = project_rank(pid)
+        if userrank is None or userrank < rank:
+            flash(message or 'You aren\'t involved in that project.', category='warning')
+            if fallback is None:
+                return redirect(url_for('my.dashboard'))
+            return redirect(url_for(fallback, pid=pid))
+        g.rank = userrank
+        return view(*args, **kwargs)
+    return wrapped_view
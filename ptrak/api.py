@@ -0,0 +1,463 @@
+"""
+The ``api`` blueprint: read-only JSON for scripts and dashboards.
+
+Everything here is for polling. Each response carries an ``ETag`` (and,
+where there's a timestamp to go on, a ``Last-Modified``), so a client
+that sends them back with ``If-None-Match`` / ``If-Modified-Since``
+gets an empty ``304`` when nothing has changed. For the lists, the
+validators come from a COUNT/MAX over the same index the list is read
+from, so a ``304`` never runs the list query at all.
+
+The ``ETag`` is the validator to use. ``Last-Modified`` only has
+one-second resolution, and is left off wherever a change wouldn't
+move it (e.g. a task leaving a filtered list).
+
+Lists take ``?fields=a,b,c`` to pick the fields returned, and are paged
+newest-first with ``?limit=`` and ``?cursor=`` (the ``next`` value of
+the previous page; see ``ptrak.paging``). Users are given by uid.
+
+Uses the browser session, like the rest of the app, but answers with
+JSON errors (401/403/404) instead of redirecting.
+"""
+import datetime
+import functools
+import hashlib
+import json
+
+from flask import (
+    Blueprint, current_app, g, jsonify, make_response, request, session
+)
+
+from ptrak.access import project_rank, project_ranks
+from ptrak.db import get_db
+from ptrak.directory import get_directory
+from ptrak.fragments import project_version
+from ptrak.paging import fetch_page
+from ptrak.project import STATUSES
+from ptrak import search as fulltext
+from ptrak import tags
+
+bp = Blueprint('api', __name__, url_prefix='/api')
+
+# the validators for the lists (see ``list_validators()``); these run on
+# every poll, and ``flask check-queries`` EXPLAINs them
+TASK_VALIDATORS = ('SELECT COUNT(*) AS num, UNIX_TIMESTAMP(MAX(date_updated)) AS latest'
+                   ' FROM Tasks WHERE {}')
+ANNOUNCEMENT_VALIDATORS = ('SELECT COUNT(*) AS num, UNIX_TIMESTAMP(MAX(date_made)) AS latest'
+                           ' FROM Announcements WHERE pid=%s')
+MESSAGE_VALIDATORS = ('SELECT COUNT(*) AS num, SUM(unread) AS unread,'
+                      ' UNIX_TIMESTAMP(MAX(date_sent)) AS latest'
+                      ' FROM Messages WHERE destination=%s')
+
+# public field name -> column, for each kind of resource
+PROJECT_FIELDS = {
+    'pid': 'pid', 'title': 'title', 'description': 'description',
+    'owner': 'owner', 'date_due': 'date_due',
+}
+TASK_FIELDS = {
+    'tid': 'tid', 'pid': 'pid', 'title': 'title', 'status': 'status',
+    'description': 'description', 'tags': 'tags', 'creator': 'creator',
+    'date_due': 'date_due', 'date_submitted': 'date_submitted',
+    'date_updated': 'date_updated',
+}
+ANNOUNCEMENT_FIELDS = {
+    'aid': 'aid', 'pid': 'pid', 'author': 'author', 'content': 'content',
+    'date_made': 'date_made',
+}
+MESSAGE_FIELDS = {
+    'mid': 'mid', 'source': 'source', 'subject': 'subject',
+    'content': 'content', 'date_sent': 'date_sent', 'unread': 'unread',
+}
+
+
+class APIError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@bp.errorhandler(APIError)
+def handle_api_error(e):
+    return jsonify(error=e.message), e.status
+
+
+def api_login_required(view):
+    """
+    Like ``ptrak.user.login_required``, but for JSON clients.
+    """
+    @functools.wraps(view)
+    def wrapped_view(*args, **kwargs):
+        if g.user is None:
+            raise APIError('Not logged in.', 401)
+        if g.user['level'] < 0:
+            raise APIError('Account disabled.', 403)
+        return view(*args, **kwargs)
+    return wrapped_view
+
+
+def check_involvement(pid):
+    # not involved and doesn't exist look the same from outside
+    if project_rank(pid) is None:
+        raise APIError('No such project.', 404)
+
+
+def select_fields(allowed, needed=()):
+    """
+    Work out which fields to return, from ``?fields=``.
+
+    :param allowed: the resource's field -> column map
+    :param needed: columns the query needs whether or not they're asked
+                   for (e.g. the sort keys)
+    :return: (the requested fields, the column list to SELECT)
+    """
+    wanted = request.args.get('fields')
+    if wanted:
+        fields = [name.strip() for name in wanted.split(',') if name.strip()]
+        unknown = [name for name in fields if name not in allowed]
+        if unknown:
+            raise APIError('Unknown field(s): {}.'.format(', '.join(unknown)))
+    else:
+        fields = list(allowed)
+    columns = [allowed[name] for name in fields]
+    columns += [column for column in needed if column not in columns]
+    return fields, ', '.join(columns)
+
+
+def page_size():
+    try:
+        limit = int(request.args.get('limit', current_app.config['API_PAGE_SIZE']))
+    except ValueError:
+        raise APIError('Invalid limit.')
+    return max(1, min(limit, current_app.config['API_MAX_PAGE_SIZE']))
+
+
+def to_json(row, fields):
+    """
+    :return: a dict of just ``fields``, with timestamps in ISO 8601
+    """
+    item = {}
+    for name in fields:
+        value = row[name]
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        item[name] = value
+    return item
+
+
+def make_etag(*parts):
+    """
+    A strong ETag for a response that is fully determined by ``parts``
+    (plus the URL asked for).
+    """
+    raw = json.dumps([request.full_path] + [str(part) for part in parts])
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:24]
+
+
+def list_validators(dbcursor, query, args):
+    """
+    Run a ``SELECT COUNT(*) AS num, UNIX_TIMESTAMP(MAX(...)) AS latest``
+    style query (plus anything else that should change the ETag).
+
+    :return: (etag parts, last modified time or None)
+    """
+    dbcursor.execute(query, args)
+    row = dbcursor.fetchone()
+    latest = row.get('latest')
+    if latest is not None:
+        latest = datetime.datetime.fromtimestamp(int(latest), datetime.timezone.utc)
+    return sorted(row.items()), latest
+
+
+def not_modified(etag, last_modified=None):
+    """
+    Check the request's conditional headers.
+
+    :return: a ``304`` response if the client's copy is current, else None
+    """
+    if request.if_none_match:
+        # If-None-Match wins over If-Modified-Since when both are sent
+        if not request.if_none_match.contains(etag):
+            return None
+    elif last_modified is None or request.if_modified_since is None \
+            or last_modified > request.if_modified_since:
+        return None
+    return finish(make_response('', 304), etag, last_modified)
+
+
+def finish(response, etag, last_modified=None):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # private: what's in here depends on who's asking
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def respond(data, etag, last_modified=None):
+    return finish(jsonify(data), etag, last_modified)
+
+
+def page(dbcursor, query, args, sort, fields):
+    """
+    Fetch one page of a list, as the response body.
+    """
+    rows, more = fetch_page(
+        dbcursor, query, args, sort=sort,
+        after=request.args.get('cursor'), limit=page_size()
+    )
+    return dict(items=[to_json(row, fields) for row in rows], next=more)
+
+
+@bp.route('/projects')
+@api_login_required
+def projects():
+    """
+    The projects the user is involved in, with their rank in each.
+    """
+    ranks = project_ranks()
+    fields, columns = select_fields(PROJECT_FIELDS, needed=('pid',))
+    items = []
+    if ranks:
+        dbcursor = get_db().cursor()
+        dbcursor.execute(
+            'SELECT {} FROM Projects WHERE pid IN ({}) ORDER BY pid'.format(
+                columns, ', '.join(['%s'] * len(ranks))),
+            list(ranks)
+        )
+        for row in dbcursor.fetchall():
+            item = to_json(row, fields)
+            item['rank'] = ranks[row['pid']]
+            items.append(item)
+    data = dict(items=items)
+    # small and not timestamped, so the ETag is just a hash of the body
+    etag = make_etag(json.dumps(data, sort_keys=True))
+    return not_modified(etag) or respond(data, etag)
+
+
+@bp.route('/projects/<int:pid>')
+@api_login_required
+def project(pid):
+    check_involvement(pid)
+    fields, columns = select_fields(PROJECT_FIELDS)
+    dbcursor = get_db().cursor()
+    dbcursor.execute('SELECT {} FROM Projects WHERE pid=%s'.format(columns), (pid,))
+    row = dbcursor.fetchone()
+    if row is None:
+        raise APIError('No such project.', 404)
+    data = to_json(row, fields)
+    data['rank'] = project_rank(pid)
+    etag = make_etag(json.dumps(data, sort_keys=True))
+    return not_modified(etag) or respond(data, etag)
+
+
+@bp.route('/projects/<int:pid>/tasks')
+@api_login_required
+def tasks(pid):
+    """
+    The project's tasks, most recently updated first.
+    ``?status=`` narrows it to one status, ``?tag=`` to one tag.
+    """
+    check_involvement(pid)
+    where, args = 'pid=%s', (pid,)
+    status = request.args.get('status')
+    if status is not None:
+        if status not in STATUSES:
+            raise APIError('Unknown status.')
+        where, args = where + ' AND status=%s', args + (status,)
+    tag = request.args.get('tag')
+    if tag is not None:
+        tag = (tags.parse(tag) or [None])[0]
+        if tag is None:
+            raise APIError('Invalid tag.')
+        condition, tagargs = tags.tagged(pid, tag)
+        where, args = where + ' AND ' + condition, args + tagargs
+
+    dbcursor = get_db().cursor()
+    # both forms are answered from an index on (pid[, status], date_updated)
+    parts, latest = list_validators(dbcursor, TASK_VALIDATORS.format(where), args)
+    # the project version changes on every write, which also catches
+    # two updates within the same second
+    etag = make_etag(project_version(pid), *parts)
+    if status is not None or tag is not None:
+        # a task leaving the filtered set doesn't move its MAX(), so
+        # Last-Modified would miss it; only the ETag can be trusted
+        latest = None
+    cached = not_modified(etag, latest)
+    if cached is not None:
+        return cached
+
+    fields, columns = select_fields(TASK_FIELDS, needed=('date_updated', 'tid'))
+    data = page(dbcursor, 'SELECT {} FROM Tasks WHERE {}'.format(columns, where), args,
+                ('date_updated', 'tid'), fields)
+    return respond(data, etag, latest)
+
+
+@bp.route('/projects/<int:pid>/tags')
+@api_login_required
+def project_tags(pid):
+    """
+    The project's most used tags, with how many tasks have each.
+    """
+    check_involvement(pid)
+    counts = tags.tag_counts(pid)(get_db().cursor())
+    data = dict(items=[dict(tag=row['tag'], tasks=row['num']) for row in counts])
+    etag = make_etag(project_version(pid))
+    return not_modified(etag) or respond(data, etag)
+
+
+@bp.route('/tagged')
+@api_login_required
+def tagged():
+    """
+    The tasks with a tag (``?tag=``, required) in all of the user's
+    projects, most recently updated first.
+    """
+    tag = (tags.parse(request.args.get('tag')) or [None])[0]
+    if tag is None:
+        raise APIError('Missing tag.')
+    fields, columns = select_fields(TASK_FIELDS, needed=('date_updated', 'tid'))
+    rows, more = tags.tagged_tasks(
+        get_db().cursor(), tag, list(project_ranks()),
+        after=request.args.get('cursor'), limit=page_size(),
+        columns=', '.join('Tasks.' + column for column in columns.split(', '))
+    )
+    data = dict(items=[to_json(row, fields) for row in rows], next=more)
+    etag = make_etag(json.dumps(data, sort_keys=True))
+    return not_modified(etag) or respond(data, etag)
+
+
+@bp.route('/tasks/<int:tid>')
+@api_login_required
+def task(tid):
+    fields, columns = select_fields(TASK_FIELDS, needed=('pid', 'date_updated'))
+    dbcursor = get_db().cursor()
+    dbcursor.execute(
+        'SELECT {}, UNIX_TIMESTAMP(date_updated) AS latest'
+        ' FROM Tasks WHERE tid=%s'.format(columns),
+        (tid,)
+    )
+    row = dbcursor.fetchone()
+    if row is None or project_rank(row['pid']) is None:
+        raise APIError('No such task.', 404)
+    latest = None
+    if row['latest'] is not None:
+        latest = datetime.datetime.fromtimestamp(int(row['latest']), datetime.timezone.utc)
+    data = to_json(row, fields)
+    etag = make_etag(json.dumps(data, sort_keys=True))
+    return not_modified(etag, latest) or respond(data, etag, latest)
+
+
+@bp.route('/projects/<int:pid>/announcements')
+@api_login_required
+def announcements(pid):
+    """
+    The project's announcements, newest first.
+    """
+    check_involvement(pid)
+    dbcursor = get_db().cursor()
+    parts, latest = list_validators(dbcursor, ANNOUNCEMENT_VALIDATORS, (pid,))
+    etag = make_etag(project_version(pid), *parts)
+    cached = not_modified(etag, latest)
+    if cached is not None:
+        return cached
+
+    fields, columns = select_fields(ANNOUNCEMENT_FIELDS, needed=('date_made', 'aid'))
+    data = page(dbcursor, 'SELECT {} FROM Announcements WHERE pid=%s'.format(columns), (pid,),
+                ('date_made', 'aid'), fields)
+    return respond(data, etag, latest)
+
+
+@bp.route('/messages')
+@api_login_required
+def messages():
+    """
+    The user's inbox, newest first. Unlike ``my.messages``, reading it
+    here doesn't mark anything as read.
+    """
+    uid = session['uid']
+    dbcursor = get_db().cursor()
+    # unread is in the ETag too, since reading a message changes it
+    # but not its date; all three come from the (destination, unread,
+    # date_sent) index
+    parts, latest = list_validators(dbcursor, MESSAGE_VALIDATORS, (uid,))
+    etag = make_etag(uid, *parts)
+    # Last-Modified can't see messages being read, so it's left off
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    fields, columns = select_fields(MESSAGE_FIELDS, needed=('date_sent', 'mid'))
+    data = page(dbcursor, 'SELECT {} FROM Messages WHERE destination=%s'.format(columns), (uid,),
+                ('date_sent', 'mid'), fields)
+    return respond(data, etag)
+
+
+@bp.route('/users')
+@api_login_required
+def users():
+    """
+    Typeahead for picking people: the users whose first name, last
+    name, full name or email starts with ``?q=`` (see
+    ``ptrak.directory``), at most ``?limit=``. ``?exclude_project=``
+    leaves out the members of a project. The user asking is never
+    included.
+    """
+    config = current_app.config
+    try:
+        limit = int(request.args.get('limit', config['DIRECTORY_RESULTS']))
+        project = request.args.get('exclude_project')
+        project = int(project) if project is not None else None
+    except ValueError:
+        raise APIError('Invalid limit or project.')
+    limit = max(1, min(limit, config['DIRECTORY_MAX_RESULTS']))
+
+    exclude = {session['uid']}
+    if project is not None:
+        check_involvement(project)
+        dbcursor = get_db().cursor()
+        dbcursor.execute('SELECT uid FROM Involvements WHERE pid=%s', (project,))
+        exclude.update(row['uid'] for row in dbcursor.fetchall())
+
+    found = get_directory().search(request.args.get('q', ''), limit, exclude)
+    data = dict(items=[dict(uid=each.uid, name=each.name, email=each.email) for each in found])
+    etag = make_etag(json.dumps(data, sort_keys=True))
+    return not_modified(etag) or respond(data, etag)
+
+
+@bp.route('/search')
+@api_login_required
+def search():
+    """
+    Full-text search of the user's projects (see ``ptrak.search``), best
+    matches first. ``?q=`` is required; ``?kind=`` (task, note or
+    announcement) and ``?project=`` narrow it down, and ``?page=``
+    (from 1) pages through the results.
+    """
+    q = request.args.get('q', '').strip()
+    if not q:
+        raise APIError('Missing q.')
+    kind = request.args.get('kind')
+    if kind is not None and kind not in fulltext.KINDS:
+        raise APIError('Unknown kind.')
+    try:
+        number = int(request.args.get('page', 1))
+        project = request.args.get('project')
+        project = int(project) if project is not None else None
+    except ValueError:
+        raise APIError('Invalid page or project.')
+
+    if project is not None:
+        check_involvement(project)
+        pids = [project]
+    else:
+        pids = list(project_ranks())
+    results, more = fulltext.search(q, pids, (kind,) if kind else fulltext.KINDS, number)
+    data = dict(
+        items=[dict(result, date=result['date'].isoformat() if result['date'] else None)
+               for result in results],
+        next=number + 1 if more else None,
+    )
+    etag = make_etag(json.dumps(data, sort_keys=True))
+    return not_modified(etag) or respond(data, etag)
@@ -0,0 +1,548 @@
+"""
+Load tests for the hot routes, against a local database.
+
+Seed a scratch database with a known amount of data, then drive the
+real views (through ``create_app()`` and Flask's test client, so no
+web server is involved) from several threads at once::
+
+    python -m ptrak.bench seed --db ptrak_bench --users 500 --tasks 20000
+    python -m ptrak.bench run --db ptrak_bench --concurrency 1,8,32 -o after.json
+    python -m ptrak.bench compare before.json after.json
+
+Both take ``--backend sqlite --path bench.sqlite3`` to run against an
+SQLite file instead (see ``ptrak.storage``).
+
+``run`` measures each route on its own, at each concurrency level,
+and writes throughput, latency percentiles and queries per request as
+JSON. ``compare`` diffs two result files and exits non-zero if a route
+got slower (or started making more queries) by more than a threshold.
+
+Queries per request (and the time spent in them) come from what
+``ptrak.instrument`` recorded for the request, read once the whole
+response has been read (streamed pages run most of theirs after the
+``Server-Timing`` header has been sent).
+Every seeded user's password is ``bench``.
+"""
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+
+import click
+import pymysql
+
+PASSWORD = 'bench'
+
+# route name -> what one request of it does; see ROUTES below
+DEFAULT_ROUTES = ('login', 'dashboard', 'project', 'status', 'messages', 'task_edit')
+
+
+def connect(options, db=True):
+    return pymysql.connect(
+        host=options['host'], port=options['port'], user=options['user'],
+        password=options['password'], db=options['db'] if db else None,
+        cursorclass=pymysql.cursors.DictCursor, autocommit=True
+    )
+
+
+def make_app(options, overrides=()):
+    """
+    Build the real app, pointed at the bench database.
+    """
+    from ptrak import create_app
+    config = dict(
+        SECRET_KEY=b'bench',
+        DB_BACKEND=options['backend'],
+        SQLITE_PATH=options['path'],
+        MYSQL_HOST=options['host'],
+        MYSQL_PORT=options['port'],
+        MYSQL_USER=options['user'],
+        MYSQL_PASS=options['password'],
+        MYSQL_DB=options['db'],
+        # one server thread per client thread, so the pool (sized from
+        # it) isn't what's being measured
+        DB_SERVER_THREADS=options.get('server_threads', 8),
+        # queries per request are read from what ptrak.instrument records
+        SQL_INSTRUMENT=True,
+    )
+    config.update(overrides)
+    return create_app(config)
+
+
+def percentile(ordered, fraction):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not ordered:
+        return None
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def chunks(rows, size=1000):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+# --- seeding ---------------------------------------------------------------
+
+def seed(options, volumes, rng, echo):
+    """
+    Create the bench database from scratch and fill it with
+    ``volumes`` worth of random data.
+    """
+    from ptrak.db import get_db, mystify
+    from ptrak import feed, migrate, passwords
+
+    if options['backend'] == 'sqlite':
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(options['path'] + suffix):
+                os.remove(options['path'] + suffix)
+    else:
+        server = connect(options, db=False)
+        with server.cursor() as dbcursor:
+            dbcursor.execute('DROP DATABASE IF EXISTS `{}`'.format(options['db']))
+            dbcursor.execute('CREATE DATABASE `{}`'.format(options['db']))
+        server.close()
+
+    app = make_app(options)
+    with app.app_context():
+        dbcursor = get_db().cursor()
+        migrate.upgrade(dbcursor, echo=echo)
+        now = datetime.datetime.now().replace(microsecond=0)
+
+        def when(days=90):
+            return now - datetime.timedelta(seconds=rng.randrange(days * 86400))
+
+        # one hash for everybody, or seeding takes minutes
+        password = passwords.hash_password(PASSWORD)
+        users = range(1, volumes['users'] + 1)
+        echo('Seeding {} users'.format(len(users)))
+        for chunk in chunks(list(users)):
+            dbcursor.executemany(
+                'INSERT INTO Users (uid, firstname, lastname, email, password, level)'
+                ' VALUES (%s, %s, %s, %s, %s, %s)',
+                [(uid, mystify('Bench'), mystify('User{}'.format(uid)),
+                  mystify('user{}@bench.test'.format(uid)), password, 3)
+                 for uid in chunk]
+            )
+
+        projects = range(1, volumes['projects'] + 1)
+        echo('Seeding {} projects'.format(len(projects)))
+        owners = {pid: rng.choice(users) for pid in projects}
+        dbcursor.executemany(
+            'INSERT INTO Projects (pid, title, owner, description, date_due)'
+            ' VALUES (%s, %s, %s, %s, %s)',
+            [(pid, 'Project {}'.format(pid), owners[pid], 'Benchmark project.',
+              now + datetime.timedelta(days=30)) for pid in projects]
+        )
+
+        # everyone is on a few projects; owners manage theirs
+        members = {pid: {owners[pid]} for pid in projects}
+        for uid in users:
+            for pid in rng.sample(projects, min(volumes['memberships'], len(projects))):
+                members[pid].add(uid)
+        members = {pid: sorted(uids) for pid, uids in members.items()}
+        involvements = [(uid, pid, 3 if uid == owners[pid] else 1)
+                        for pid in projects for uid in members[pid]]
+        echo('Seeding {} involvements'.format(len(involvements)))
+        for chunk in chunks(involvements):
+            dbcursor.executemany(
+                'INSERT INTO Involvements (uid, pid, `rank`) VALUES (%s, %s, %s)', chunk)
+
+        echo('Seeding {} tasks'.format(volumes['tasks']))
+        statuses = ('new', 'in progress', 'under review', 'complete')
+        tasks = []
+        for tid in range(1, volumes['tasks'] + 1):
+            pid = rng.choice(projects)
+            updated = when()
+            tasks.append((tid, pid, rng.choice(members[pid]), rng.choice(statuses),
+                          'Task {}'.format(tid), 'Something to do.\nAnd some detail.',
+                          updated, updated))
+        for chunk in chunks(tasks):
+            dbcursor.executemany(
+                'INSERT INTO Tasks (tid, pid, creator, status, title, description,'
+                ' date_submitted, date_updated) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)',
+                chunk
+            )
+
+        echo('Seeding {} messages'.format(volumes['messages']))
+        messages = [(rng.choice(users), rng.choice(users), 'Subject {}'.format(mid),
+                     'Hello there.', when(), int(rng.random() < 0.3))
+                    for mid in range(volumes['messages'])]
+        for chunk in chunks(messages):
+            dbcursor.executemany(
+                'INSERT INTO Messages (destination, source, subject, content, date_sent, unread)'
+                ' VALUES (%s, %s, %s, %s, %s, %s)',
+                chunk
+            )
+        dbcursor.execute(
+            'UPDATE Users SET unreadcount ='
+            ' (SELECT COUNT(*) FROM Messages WHERE destination=uid AND unread=1)'
+        )
+
+        echo('Seeding {} announcements'.format(volumes['announcements']))
+        announcements = []
+        for _ in range(volumes['announcements']):
+            pid = rng.choice(projects)
+            announcements.append((pid, rng.choice(members[pid]), when(), 'News.'))
+        for chunk in chunks(announcements):
+            dbcursor.executemany(
+                'INSERT INTO Announcements (pid, author, date_made, content)'
+                ' VALUES (%s, %s, %s, %s)',
+                chunk
+            )
+        echo('Filling announcement feeds')
+        feed.backfill(dbcursor)
+        if options['backend'] == 'sqlite':
+            dbcursor.execute('ANALYZE')
+        else:
+            dbcursor.execute('ANALYZE TABLE Users, Projects, Involvements, Tasks, Messages, Announcements')
+
+
+# --- running ---------------------------------------------------------------
+
+class World:
+    """
+    What the workers need to know about the seeded data.
+    """
+    def __init__(self, app):
+        from ptrak.db import get_db
+        with app.app_context():
+            dbcursor = get_db().cursor()
+            dbcursor.execute('SELECT uid, pid FROM Involvements')
+            self.projects = {}
+            for row in dbcursor.fetchall():
+                self.projects.setdefault(row['uid'], []).append(row['pid'])
+            dbcursor.execute('SELECT tid, pid FROM Tasks')
+            self.tasks = {}
+            for row in dbcursor.fetchall():
+                self.tasks.setdefault(row['pid'], []).append(row['tid'])
+        self.users = sorted(self.projects)
+
+
+def login(client, uid):
+    return client.post('/user/login', data=dict(
+        email='user{}@bench.test'.format(uid), password=PASSWORD))
+
+
+def route_login(client, uid, world, rng):
+    return login(client, uid)
+
+
+def route_dashboard(client, uid, world, rng):
+    return client.get('/my/dashboard')
+
+
+def route_project(client, uid, world, rng):
+    return client.get('/project/{}'.format(rng.choice(world.projects[uid])))
+
+
+def route_status(client, uid, world, rng):
+    pid = rng.choice([pid for pid in world.projects[uid] if pid in world.tasks] or [0])
+    if pid == 0:
+        return route_project(client, uid, world, rng)
+    return client.post('/project/{}'.format(pid), data=dict(
+        taskid=rng.choice(world.tasks[pid]),
+        status=rng.choice(('new', 'in progress', 'under review', 'complete'))))
+
+
+def route_messages(client, uid, world, rng):
+    return client.get('/my/messages')
+
+
+def route_task_edit(client, uid, world, rng):
+    pid = rng.choice([pid for pid in world.projects[uid] if pid in world.tasks] or [0])
+    if pid == 0:
+        return route_project(client, uid, world, rng)
+    tid = rng.choice(world.tasks[pid])
+    return client.post('/task/edit/{}'.format(tid), data=dict(
+        title='Task {}'.format(tid), description='Edited.\nBy the benchmark.',
+        date_due='2030-01-01', status='in progress'))
+
+
+ROUTES = dict(
+    login=route_login,
+    dashboard=route_dashboard,
+    project=route_project,
+    status=route_status,
+    messages=route_messages,
+    task_edit=route_task_edit,
+)
+
+
+def recorder(client):
+    """
+    Have ``ptrak.instrument`` record the client's next request's
+    statements in a list we keep, rather than one of its own.
+
+    :return: the list, which is complete once the response is closed
+    """
+    from ptrak.instrument import ENVIRON_KEY
+    queries = client.environ_base[ENVIRON_KEY] = []
+    return queries
+
+
+def db_timing(queries):
+    """
+    :return: (ms spent in the database, number of queries) for the
+             statements from ``recorder()``
+    """
+    return sum(seconds for _, seconds, _ in queries) * 1000, len(queries)
+
+
+def measure(app, world, route, concurrency, requests, warmup, rng_seed):
+    """
+    Run ``requests`` requests of one route, spread over ``concurrency``
+    threads, each logged in as a different user.
+
+    :return: a result dict
+    """
+    run = ROUTES[route]
+    share = [requests // concurrency + (1 if n < requests % concurrency else 0)
+             for n in range(concurrency)]
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    queries = [0] * concurrency
+    dbtime = [0.0] * concurrency
+    ready = threading.Barrier(concurrency + 1)
+    done = threading.Barrier(concurrency + 1)
+
+    def worker(n):
+        try:
+            rng = random.Random(rng_seed * 1000 + n)
+            uid = world.users[n % len(world.users)]
+            client = app.test_client()
+            login(client, uid)
+            for _ in range(warmup):
+                run(client, uid, world, rng)
+            ready.wait()
+            for _ in range(share[n]):
+                recorded = recorder(client)
+                start = time.perf_counter()
+                response = run(client, uid, world, rng)
+                # all of it, so a streamed page has done all its work
+                response.get_data()
+                response.close()
+                latencies[n].append(time.perf_counter() - start)
+                if response.status_code >= 400:
+                    errors[n] += 1
+                spent, made = db_timing(recorded)
+                dbtime[n] += spent
+                queries[n] += made
+            done.wait()
+        except BaseException:
+            # don't leave everyone else waiting
+            ready.abort()
+            done.abort()
+            raise
+
+    threads = [threading.Thread(target=worker, args=(n,), daemon=True)
+               for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    try:
+        ready.wait()
+        start = time.perf_counter()
+        done.wait()
+        elapsed = time.perf_counter() - start
+    except threading.BrokenBarrierError:
+        raise click.ClickException('a {} worker failed; see above'.format(route))
+    for thread in threads:
+        thread.join()
+
+    ordered = sorted(latency * 1000 for worker in latencies for latency in worker)
+    return dict(
+        route=route,
+        concurrency=concurrency,
+        requests=len(ordered),
+        errors=sum(errors),
+        seconds=round(elapsed, 3),
+        throughput_rps=round(len(ordered) / elapsed, 2) if elapsed else None,
+        latency_ms=dict(
+            mean=round(sum(ordered) / len(ordered), 3) if ordered else None,
+            p50=round(percentile(ordered, 0.50), 3) if ordered else None,
+            p95=round(percentile(ordered, 0.95), 3) if ordered else None,
+            p99=round(percentile(ordered, 0.99), 3) if ordered else None,
+            max=round(ordered[-1], 3) if ordered else None,
+        ),
+        queries_per_request=round(sum(queries) / len(ordered), 2) if ordered else None,
+        db_ms_per_request=round(sum(dbtime) / len(ordered), 3) if ordered else None,
+    )
+
+
+def describe_version():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# --- command line ----------------------------------------------------------
+
+def database_options(command):
+    options = [
+        click.option('--backend', type=click.Choice(['mysql', 'sqlite']),
+                     default='mysql', show_default=True),
+        click.option('--path', default='ptrak_bench.sqlite3', show_default=True,
+                     help='The SQLite file, with --backend sqlite.'),
+        click.option('--host', default='127.0.0.1', show_default=True),
+        click.option('--port', default=3306, show_default=True),
+        click.option('--user', default='root', show_default=True),
+        click.option('--password', default='', envvar='PTRAK_BENCH_PASSWORD',
+                     help='Or set PTRAK_BENCH_PASSWORD.'),
+        click.option('--db', default='ptrak_bench', show_default=True,
+                     help='Scratch database; seed drops and recreates it.'),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def parse_overrides(pairs):
+    overrides = {}
+    for pair in pairs:
+        key, _, value = pair.partition('=')
+        try:
+            overrides[key] = json.loads(value)
+        except ValueError:
+            overrides[key] = value
+    return overrides
+
+
+@click.group()
+def cli():
+    """
+    Benchmark PTrak against a local MySQL (or SQLite) database.
+    """
+
+
+@cli.command('seed')
+@database_options
+@click.option('--users', default=200, show_default=True)
+@click.option('--projects', default=20, show_default=True)
+@click.option('--memberships', default=5, show_default=True, help='Projects per user.')
+@click.option('--tasks', default=5000, show_default=True)
+@click.option('--messages', default=10000, show_default=True)
+@click.option('--announcements', default=1000, show_default=True)
+@click.option('--random-seed', default=1, show_default=True)
+def seed_command(backend, path, host, port, user, password, db, random_seed, **volumes):
+    """
+    (Re)create the bench database and fill it with random data.
+    """
+    options = dict(backend=backend, path=os.path.abspath(path), host=host, port=port,
+                   user=user, password=password, db=db)
+    start = time.perf_counter()
+    seed(options, volumes, random.Random(random_seed), click.echo)
+    click.echo('Seeded {} in {:.1f}s.'.format(path if backend == 'sqlite' else db,
+                                              time.perf_counter() - start))
+
+
+@cli.command('run')
+@database_options
+@click.option('--routes', default=','.join(DEFAULT_ROUTES), show_default=True,
+              help='Comma-separated: ' + ', '.join(ROUTES))
+@click.option('--concurrency', default='1,8', show_default=True,
+              help='Comma-separated thread counts to run each route at.')
+@click.option('--requests', default=200, show_default=True,
+              help='Measured requests per route and concurrency level.')
+@click.option('--warmup', default=5, show_default=True,
+              help='Unmeasured requests per thread first.')
+@click.option('--set', 'overrides', multiple=True, metavar='KEY=VALUE',
+              help='Override an app config value (JSON values allowed).')
+@click.option('--random-seed', default=1, show_default=True)
+@click.option('-o', '--output', type=click.File('w'), default='-',
+              help='Where to write the JSON results (default: stdout).')
+def run_command(backend, path, host, port, user, password, db, routes, concurrency,
+                requests, warmup, overrides, random_seed, output):
+    """
+    Measure each route at each concurrency level.
+    """
+    options = dict(backend=backend, path=os.path.abspath(path), host=host, port=port,
+                   user=user, password=password, db=db)
+    routes = [route.strip() for route in routes.split(',') if route.strip()]
+    unknown = [route for route in routes if route not in ROUTES]
+    if unknown:
+        raise click.BadParameter('unknown route(s): ' + ', '.join(unknown))
+    levels = [int(level) for level in concurrency.split(',')]
+    overrides = parse_overrides(overrides)
+
+    options['server_threads'] = max(levels)
+    app = make_app(options, overrides)
+    world = World(app)
+    results = []
+    for route in routes:
+        for level in levels:
+            result = measure(app, world, route, level, requests, warmup, random_seed)
+            click.echo('{route:>10} x{concurrency:<3} {throughput_rps:>9} req/s'
+                       '  p50 {p50:>8} ms  p95 {p95:>8} ms  p99 {p99:>8} ms'
+                       '  {queries_per_request} queries/req  {errors} errors'.format(
+                           p50=result['latency_ms']['p50'], p95=result['latency_ms']['p95'],
+                           p99=result['latency_ms']['p99'], **result), err=True)
+            results.append(result)
+
+    json.dump(dict(
+        version=describe_version(),
+        date=datetime.datetime.now().isoformat(timespec='seconds'),
+        python=platform.python_version(),
+        backend=backend,
+        requests=requests,
+        overrides=overrides,
+        results=results,
+    ), output, indent=2)
+    output.write('\n')
+
+
+@cli.command('compare')
+@click.argument('before', type=click.File('r'))
+@click.argument('after', type=click.File('r'))
+@click.option('--threshold', default=0.10, show_default=True,
+              help='Allowed relative slowdown before it counts as a regression.')
+def compare_command(before, after, threshold):
+    """
+    Compare two result files; exit 1 on any regression.
+    """
+    old = {(r['route'], r['concurrency']): r for r in json.load(before)['results']}
+    new = {(r['route'], r['concurrency']): r for r in json.load(after)['results']}
+    regressions = 0
+
+    def change(was, now):
+        if not was or now is None:
+            return None
+        return (now - was) / was
+
+    for key in sorted(set(old) & set(new)):
+        was, now = old[key], new[key]
+        checks = [
+            ('p95', was['latency_ms']['p95'], now['latency_ms']['p95'], False),
+            ('req/s', was['throughput_rps'], now['throughput_rps'], True),
+            ('queries', was['queries_per_request'], now['queries_per_request'], False),
+        ]
+        parts = []
+        for name, a, b, higher_is_better in checks:
+            delta = change(a, b)
+            if delta is None:
+                continue
+            worse = -delta if higher_is_better else delta
+            # an extra query per request is always a regression
+            bad = worse > threshold or (name == 'queries' and b - a >= 1)
+            regressions += bad
+            parts.append('{} {} -> {} ({:+.0%}){}'.format(name, a, b, delta, ' !' if bad else ''))
+        click.echo('{:>10} x{:<3} '.format(*key) + '  '.join(parts))
+    for key in sorted(set(old) ^ set(new)):
+        click.echo('{:>10} x{:<3} only in {}'.format(*key, 'before' if key in old else 'after'))
+
+    if regressions:
+        click.echo('{} regression(s).'.format(regressions), err=True)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,398 @@
+"""
+Small key/value caches for data that is read on (nearly) every request.
+
+Two backends are available, picked with the ``CACHE_BACKEND`` config key:
+
+* ``'lru'`` (the default) keeps entries in this process, in a
+  size-bounded LRU with per-entry expiry. It's fast, but every worker
+  process has its own copy, so an invalidation in one worker is
+  only seen by the others once their entry expires.
+* ``'redis'`` keeps entries on a shared server speaking the Redis
+  protocol (``CACHE_REDIS_HOST``/``CACHE_REDIS_PORT``/``CACHE_REDIS_DB``),
+  so all workers see the same data. Anything that speaks the protocol
+  will do, including a local ``redis-server`` for development.
+
+Both backends have the same interface (``get``, ``set``, ``delete``,
+``stats``), and a cache failure is never fatal: a broken shared cache
+just behaves like an empty one.
+"""
+import base64
+import collections
+import datetime
+import decimal
+import json
+import os
+import socket
+import threading
+import time
+
+from flask import current_app
+
+# guards cache creation, same as the connection pool in ptrak.db
+_cache_lock = threading.Lock()
+
+
+class LRUCache:
+    """
+    A thread-safe, in-process LRU cache with per-entry expiry.
+
+    :param maxsize: maximum number of entries to keep
+    :param ttl: default lifetime of an entry, in seconds
+    """
+
+    # whether a delete() is seen by every worker
+    shared = False
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = dict(hits=0, misses=0, sets=0, evictions=0, expired=0)
+
+    def get(self, key, default=None):
+        """
+        Get the value stored under ``key``.
+
+        :return: the value, or ``default`` if missing or expired
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return default
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                self._stats['expired'] += 1
+                self._stats['misses'] += 1
+                return default
+            self._data.move_to_end(key)
+            self._stats['hits'] += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store ``value`` under ``key`` for ``ttl`` seconds.
+        """
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            self._stats['sets'] += 1
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def delete(self, *keys):
+        """
+        Remove the given keys (missing keys are ignored).
+        """
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """
+        :return: dict of hit/miss counters and the current size
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(backend='lru', size=len(self._data), maxsize=self.maxsize)
+        return stats
+
+
+class RedisCache:
+    """
+    A cache kept on a server that speaks the Redis protocol, shared
+    by every worker. Values are stored as JSON (see ``dumps()``), never
+    pickled: anyone who can write to the server could otherwise run
+    code in every worker. Rows, dicts, lists and strings round-trip.
+
+    Each thread gets its own socket, and sockets are never carried
+    across a ``fork()``.
+
+    :param host: server host name
+    :param port: server port
+    :param db: database number to ``SELECT``
+    :param ttl: default lifetime of an entry, in seconds
+    :param prefix: prepended to every key, to share a server between apps
+    :param timeout: socket timeout, in seconds
+    """
+
+    shared = True
+
+    def __init__(self, host='127.0.0.1', port=6379, db=0, ttl=60,
+                 prefix='ptrak:', timeout=0.5):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.ttl = ttl
+        self.prefix = prefix
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # errors counts every failed command; failed_sets, just the writes
+        self._stats = dict(hits=0, misses=0, sets=0, failed_sets=0, errors=0)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or conn.pid != os.getpid():
+            conn = RespConnection(self.host, self.port, self.timeout)
+            if self.db:
+                conn.command('SELECT', self.db)
+            self._local.conn = conn
+        return conn
+
+    def _command(self, *args):
+        """
+        Run a command, dropping the socket if anything goes wrong.
+
+        :return: the reply, or None on error
+        """
+        try:
+            return self._connection().command(*args)
+        except (OSError, RespError):
+            conn = getattr(self._local, 'conn', None)
+            if conn is not None:
+                conn.close()
+                self._local.conn = None
+            self._count('errors')
+            return None
+
+    def get(self, key, default=None):
+        raw = self._command('GET', self.prefix + key)
+        if raw is None:
+            self._count('misses')
+            return default
+        try:
+            value = loads(raw)
+        except ValueError:
+            # not ours, or from an older version; treat it as missing
+            self._count('errors')
+            return default
+        self._count('hits')
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        reply = self._command('SET', self.prefix + key, dumps(value),
+                              'EX', max(1, int(ttl)))
+        self._count('failed_sets' if reply is None else 'sets')
+
+    def delete(self, *keys):
+        if keys:
+            self._command('DEL', *[self.prefix + key for key in keys])
+
+    def clear(self):
+        # only our own keys; other apps may share the server
+        cursor = b'0'
+        while True:
+            reply = self._command('SCAN', cursor, 'MATCH', self.prefix + '*',
+                                  'COUNT', 500)
+            if reply is None:
+                return
+            cursor, keys = reply
+            if keys:
+                self._command('DEL', *keys)
+            if cursor == b'0':
+                return
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(backend='redis', host=self.host, port=self.port)
+        return stats
+
+
+def _pack(value):
+    # JSON has no dates, bytes or non-string keys; tag them
+    if isinstance(value, dict):
+        if all(isinstance(key, str) for key in value):
+            return {key: _pack(item) for key, item in value.items()}
+        return {'__items__': [[_pack(key), _pack(item)] for key, item in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return [_pack(item) for item in value]
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'__date__': value.isoformat()}
+    if isinstance(value, decimal.Decimal):
+        return {'__decimal__': str(value)}
+    if isinstance(value, bytes):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    return value
+
+
+def _unpack(obj):
+    if len(obj) == 1:
+        (tag, value), = obj.items()
+        if tag == '__items__':
+            return {_hashable(key): item for key, item in value}
+        if tag == '__datetime__':
+            return datetime.datetime.fromisoformat(value)
+        if tag == '__date__':
+            return datetime.date.fromisoformat(value)
+        if tag == '__decimal__':
+            return decimal.Decimal(value)
+        if tag == '__bytes__':
+            return base64.b64decode(value)
+    return obj
+
+
+def _hashable(key):
+    return tuple(key) if isinstance(key, list) else key
+
+
+def dumps(value):
+    """
+    Serialize a cache value (rows from the database, dicts, lists,
+    strings, numbers, dates) for a shared cache.
+
+    :return: bytes
+    """
+    return json.dumps(_pack(value), separators=(',', ':')).encode('utf-8')
+
+
+def loads(raw):
+    """
+    The inverse of ``dumps()``. Tuples come back as lists.
+
+    :raise ValueError: if ``raw`` isn't something ``dumps()`` made
+    """
+    return json.loads(raw.decode('utf-8'), object_hook=_unpack)
+
+
+class RespError(Exception):
+    """
+    An error reply from the server (or a reply we can't parse).
+    """
+
+
+class RespConnection:
+    """
+    A minimal client for the Redis serialization protocol (RESP).
+    Only what the cache needs: send a command, read one reply.
+    """
+
+    def __init__(self, host, port, timeout=None):
+        self.pid = os.getpid()
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+
+    def command(self, *args):
+        """
+        Send a command and wait for its reply.
+        """
+        self.send(*args)
+        return self.read_reply()
+
+    def send(self, *args):
+        out = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if isinstance(arg, str):
+                arg = arg.encode('utf-8')
+            elif isinstance(arg, int):
+                arg = str(arg).encode('ascii')
+            out.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        self.sock.sendall(b''.join(out))
+
+    def read_reply(self):
+        line = self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise RespError('connection closed')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest
+        if kind == b'-':
+            raise RespError(rest.decode('utf-8', 'replace'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self.read_reply() for _ in range(length)]
+        raise RespError('unexpected reply {!r}'.format(line))
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+def make_cache(config, prefix='CACHE'):
+    """
+    Build a cache from the app config.
+
+    :param config: the app's config
+    :param prefix: config key prefix, so other caches can be sized separately
+    :return: an ``LRUCache`` or ``RedisCache``
+    """
+    backend = config.get(prefix + '_BACKEND', config['CACHE_BACKEND'])
+    ttl = config.get(prefix + '_TTL', config['CACHE_TTL'])
+    if backend == 'redis':
+        return RedisCache(
+            host=config['CACHE_REDIS_HOST'],
+            port=config['CACHE_REDIS_PORT'],
+            db=config['CACHE_REDIS_DB'],
+            ttl=ttl,
+            prefix=config['CACHE_REDIS_PREFIX'],
+        )
+    elif backend == 'lru':
+        return LRUCache(maxsize=config.get(prefix + '_SIZE', config['CACHE_SIZE']), ttl=ttl)
+    raise ValueError('unknown cache backend {!r}'.format(backend))
+
+
+def get_cache(app=None):
+    """
+    Get the app's shared cache, creating it if needed.
+
+    :param app: the Flask app (defaults to ``current_app``)
+    :return: the app's cache
+    """
+    if app is None:
+        app = current_app._get_current_object()
+    cache = app.extensions.get('ptrak_cache')
+    if cache is None:
+        with _cache_lock:
+            cache = app.extensions.get('ptrak_cache')
+            if cache is None:
+                cache = make_cache(app.config)
+                app.extensions['ptrak_cache'] = cache
+    return cache
+
+
+def init_app(app):
+    """
+    Fill in the cache defaults; override them in the instance config.
+    """
+    app.config.setdefault('CACHE_BACKEND', 'lru')     # or 'redis'
+    app.config.setdefault('CACHE_SIZE', 4096)         # entries, lru only
+    app.config.setdefault('CACHE_TTL', 60)            # seconds
+    app.config.setdefault('CACHE_REDIS_HOST', '127.0.0.1')
+    app.config.setdefault('CACHE_REDIS_PORT', 6379)
+    app.config.setdefault('CACHE_REDIS_DB', 0)
+    app.config.setdefault('CACHE_REDIS_PREFIX', 'ptrak:')
+    # how long a logged-in user's row stays cached
+    app.config.setdefault('USER_CACHE_TTL', 30)
+    # how long a user's project -> rank map stays cached (see
+    # ptrak.access); only ever cached with the redis backend
+    app.config.setdefault('RANKS_CACHE_TTL', 300)
@@ -1,48 +1,244 @@
-import pymysql
 # g is an object global to the application context
 # where we'll store the db connection
 # NOTE: I'm still not entirely sure where the app context ends,
 #       but it seems it's NOT global to all users
 #       (e.g., User1 and User2 will have different g objects)
-from flask import current_app, g, abort
+from flask import (
+    current_app, g, abort, copy_current_request_context, has_request_context
+)
 from flask.cli import with_appcontext
 import click
 import base64
+import contextlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ptrak.pool import ConnectionPool, PoolTimeout
+from ptrak.storage import make_backend
+
+# guards pool creation when several threads hit a fresh app at once
+_pool_lock = threading.Lock()
+
+def get_backend(app=None):
+    """
+    Get the app's storage backend (see ``ptrak.storage``), which knows
+    how to connect to the ``DB_BACKEND`` database and the bits of SQL
+    that differ between them.
+    """
+    if app is None:
+        app = current_app._get_current_object()
+    backend = app.extensions.get('ptrak_backend')
+    if backend is None:
+        with _pool_lock:
+            backend = app.extensions.get('ptrak_backend')
+            if backend is None:
+                backend = make_backend(app.config)
+                app.extensions['ptrak_backend'] = backend
+    return backend
+
+def get_pool(app=None):
+    """
+    Get the connection pool for the given app, creating it if needed.
+    The pool lives in ``app.extensions`` so it outlasts the app context
+    (unlike ``g``, which is thrown away after every request).
+
+    :param app: the Flask app (defaults to ``current_app``)
+    :return: the app's ``ConnectionPool``
+    """
+    if app is None:
+        app = current_app._get_current_object()
+    pool = app.extensions.get('ptrak_pool')
+    if pool is None:
+        backend = get_backend(app)
+        with _pool_lock:
+            pool = app.extensions.get('ptrak_pool')
+            if pool is None:
+                config = app.config
+                size, max_overflow = pool_sizes(config)
+                pool = ConnectionPool(
+                    backend.connect,
+                    reset=backend.reset,
+                    size=size,
+                    max_overflow=max_overflow,
+                    timeout=config['MYSQL_POOL_TIMEOUT'],
+                    recycle=config['MYSQL_POOL_RECYCLE'],
+                    pre_ping=config['MYSQL_POOL_PRE_PING'],
+                    autocommit=True
+                )
+                app.extensions['ptrak_pool'] = pool
+    return pool
+
+def side_threads(config):
+    """
+    How many threads ``fetch_concurrently()`` has per process: enough
+    for every request thread to have ``DB_CONCURRENCY - 1`` reads out
+    at once.
+    """
+    return config['DB_SERVER_THREADS'] * max(0, config['DB_CONCURRENCY'] - 1)
+
+def pool_sizes(config):
+    """
+    The pool's (size, max_overflow): unless set, one connection kept per
+    request thread, plus one more under load for each side thread, so
+    that size + max_overflow = ``DB_SERVER_THREADS * DB_CONCURRENCY``
+    and nothing ever waits for a connection.
+    """
+    size = config['MYSQL_POOL_SIZE']
+    if size is None:
+        size = config['DB_SERVER_THREADS']
+    max_overflow = config['MYSQL_POOL_MAX_OVERFLOW']
+    if max_overflow is None:
+        max_overflow = config['DB_SERVER_THREADS'] * config['DB_CONCURRENCY'] - size
+    return size, max(0, max_overflow)
 
 def get_db():
     """
-    Initialize and return a connection to the database.
+    Check out a connection from the pool for the rest of the request.
 
     :return: db connection object
     """
     # see if we already have an active connection
     if 'db' not in g:
-        # create one if not
-        # most of the options are self-explanatory; autocommit makes sure
-        # that each DB insert/update takes immediate effect
+        # borrow one from the pool if not
         try:
-            g.db = pymysql.connect(
-                host=current_app.config['MYSQL_HOST'],
-                user=current_app.config['MYSQL_USER'],
-                password=current_app.config['MYSQL_PASS'],
-                db=current_app.config['MYSQL_DB'],
-                cursorclass=pymysql.cursors.DictCursor,
-                autocommit=True
-            )
-        except: # which exception?
+            g.db = get_pool().checkout()
+        except get_backend().errors + (PoolTimeout,):
             abort(500)
 
     return g.db
 
 def close_db(e=None):
     """
-    Close the database connection.
+    Return the database connection to the pool.
     """
     # remove db from g
     db = g.pop('db', None)
     if db is not None:
-        # and close the connection
-        db.close()
+        # and hand the connection back (the pool resets it)
+        get_pool().checkin(db)
+
+@contextlib.contextmanager
+def transaction():
+    """
+    Run a group of statements as one all-or-nothing transaction.
+    Connections are in autocommit mode otherwise, so use this
+    whenever several writes have to succeed or fail together::
+
+        with transaction() as dbcursor:
+            dbcursor.execute(...)
+            dbcursor.execute(...)
+
+    Commits on success, rolls back if anything raises.
+    """
+    db = get_db()
+    db.begin()
+    try:
+        yield db.cursor()
+    except BaseException:
+        db.rollback()
+        raise
+    else:
+        db.commit()
+
+def read(query, args=(), one=False):
+    """
+    Wrap a SELECT as a read for ``fetch_concurrently()``.
+
+    :param query: the SQL
+    :param args: its arguments
+    :param one: return ``fetchone()`` instead of ``fetchall()``
+    :return: a callable taking a cursor and returning the rows
+    """
+    def run(dbcursor):
+        dbcursor.execute(query, args)
+        return dbcursor.fetchone() if one else dbcursor.fetchall()
+    return run
+
+def fetch_concurrently(*reads):
+    """
+    Run several independent reads at the same time, each on its own
+    pooled connection, and wait for all of them. A page that needs
+    four unrelated queries then waits for the slowest one instead of
+    the sum of all four.
+
+    At most ``DB_CONCURRENCY - 1`` reads are handed to other threads,
+    and only to idle ones: a read queued behind other requests' reads
+    would finish later than if it had just been run here. The rest
+    run here, one after another, on the request's own connection, so
+    under load this is never slower than not using it at all.
+
+    Each read is a callable taking a cursor (see ``read()``). They
+    run in a copy of the current request context, so they can use
+    ``request``, ``session`` and the app config, but anything they put
+    in ``g`` stays in their own thread. Outside of a request, or with
+    ``DB_CONCURRENCY`` set to 1, they just run one after another.
+
+    :return: list of the reads' results, in order
+    """
+    limit = current_app.config['DB_CONCURRENCY']
+    if limit < 2 or len(reads) < 2 or not has_request_context():
+        return [run(get_db().cursor()) for run in reads]
+
+    executor = get_executor()
+    futures = {}
+    for index, run in enumerate(reads[1:limit], 1):
+        if not executor.idle.acquire(blocking=False):
+            break
+        try:
+            future = executor.submit(copy_current_request_context(_run_read(run)))
+        except BaseException:
+            executor.idle.release()
+            raise
+        future.add_done_callback(lambda _: executor.idle.release())
+        futures[index] = future
+    results = [None] * len(reads)
+    for index, run in enumerate(reads):
+        if index not in futures:
+            results[index] = run(get_db().cursor())
+    for index, future in futures.items():
+        results[index] = future.result()
+    return results
+
+def _run_read(run):
+    def wrapped():
+        # get_db() in this thread checks out a connection into this
+        # context's own g; it goes back to the pool when the context ends
+        return run(get_db().cursor())
+    return wrapped
+
+def get_executor(app=None):
+    """
+    Get the app's thread pool for ``fetch_concurrently()``, sized by
+    ``side_threads()``; ``executor.idle`` counts its free threads.
+    Threads don't survive a fork, so each process makes its own.
+    """
+    if app is None:
+        app = current_app._get_current_object()
+    executor = app.extensions.get('ptrak_executor')
+    if executor is None or executor.pid != os.getpid():
+        with _pool_lock:
+            executor = app.extensions.get('ptrak_executor')
+            if executor is None or executor.pid != os.getpid():
+                threads = max(1, side_threads(app.config))
+                executor = ThreadPoolExecutor(
+                    max_workers=threads,
+                    thread_name_prefix='ptrak-db'
+                )
+                executor.idle = threading.BoundedSemaphore(threads)
+                executor.pid = os.getpid()
+                app.extensions['ptrak_executor'] = executor
+    return executor
+
+@click.command('pool-stats')
+@with_appcontext
+def pool_stats_command():
+    """
+    Print the connection pool's counters.
+    Note that each process has its own pool; this only shows the
+    pool of the process running the command.
+    """
+    for key, value in sorted(get_pool().stats().items()):
+        click.echo('{}: {}'.format(key, value))
 
 def init_app(app):
     """
@@ -51,7 +247,53 @@ def init_app(app):
     (``create_app()``), so the app will have to call this upon
     initialization in ``create_app()``.
     """
+    # 'mysql' or 'sqlite' (see ptrak.storage)
+    app.config.setdefault('DB_BACKEND', 'mysql')
+    app.config.setdefault('MYSQL_PORT', 3306)
+    app.config.setdefault('SQLITE_PATH', os.path.join(app.instance_path, 'ptrak.sqlite3'))
+    app.config.setdefault('SQLITE_PRAGMAS', {})         # on top of the backend's defaults
+    # the class of every cursor we hand out (None: the backend's own,
+    # which returns dicts); ptrak.instrument wraps it
+    app.config.setdefault('DB_CURSORCLASS', None)
+    # and of the unbuffered ones rows are streamed through (None: the
+    # backend's streamcursorclass); ptrak.instrument wraps it too
+    app.config.setdefault('DB_STREAMCURSORCLASS', None)
+    # threads serving requests in each worker process (gunicorn's
+    # --threads, say); the pool and fetch_concurrently() are sized by it
+    app.config.setdefault('DB_SERVER_THREADS', 8)
+    # reads a request runs at once in fetch_concurrently(), its own
+    # included; each of the others holds a pooled connection
+    app.config.setdefault('DB_CONCURRENCY', 4)
+    # connection pool defaults; override them in the instance config.
+    # a request thread can hold DB_CONCURRENCY connections at once, so
+    # keep MYSQL_POOL_SIZE + MYSQL_POOL_MAX_OVERFLOW at least
+    # DB_SERVER_THREADS * DB_CONCURRENCY (None works that out; see
+    # pool_sizes()), and mind the server's max_connections across workers
+    app.config.setdefault('MYSQL_POOL_SIZE', None)
+    app.config.setdefault('MYSQL_POOL_MAX_OVERFLOW', None)
+    app.config.setdefault('MYSQL_POOL_TIMEOUT', 10)      # seconds
+    app.config.setdefault('MYSQL_POOL_RECYCLE', 3600)    # seconds
+    app.config.setdefault('MYSQL_POOL_PRE_PING', True)
     app.teardown_appcontext(close_db)
+    app.cli.add_command(pool_stats_command)
+    # flask migrate / flask check-queries
+    from ptrak import migrate
+    migrate.init_app(app)
+    # flask sync-members
+    from ptrak import membership
+    membership.init_app(app)
+    # flask backfill-feed
+    from ptrak import feed
+    feed.init_app(app)
+    # flask reindex-tags
+    from ptrak import tags
+    tags.init_app(app)
+    # flask ptrak export / import
+    from ptrak import transfer
+    transfer.init_app(app)
+    # per-request query logs, Server-Timing and the slow-query log
+    from ptrak import instrument
+    instrument.init_app(app)
 """
 Protect the user - email and username
 """
@@ -0,0 +1,181 @@
+"""
+The user directory, for picking people by name.
+
+Recipient and member pickers used to be a ``<select>`` of every user,
+which means reading (and decoding, and sending) the whole Users table
+on every view. Instead, each worker keeps the directory in memory:
+a ``Person`` per user, and a sorted list of search keys (first name,
+last name, full name and email, lowercased) with the uid for each, so
+a prefix search is a binary search plus a walk over just the matches.
+``/api/users?q=`` serves it to the pickers.
+
+The directory is loaded on first use. ``user.new`` adds new users to
+it straight away; other workers pick them up with a cheap
+``uid > newest`` query at most every ``DIRECTORY_REFRESH`` seconds,
+and the whole thing is reloaded every ``DIRECTORY_TTL`` seconds (for
+changed names).
+"""
+import bisect
+import threading
+import time
+
+from flask import current_app
+
+from ptrak.db import get_db
+from ptrak.people import Person, person
+
+# guards directory creation, like the caches
+_directory_lock = threading.Lock()
+
+
+def search_keys(found):
+    """
+    :return: the lowercased strings a ``Person`` can be found by
+    """
+    keys = {found.firstname, found.lastname, found.name}
+    if found.email:
+        keys.add(found.email)
+    return {key.lower() for key in keys if key}
+
+
+class Directory:
+    """
+    Every user, searchable by prefix.
+
+    :param refresh: seconds between checks for new users
+    :param ttl: seconds before everything is reloaded
+    """
+
+    def __init__(self, refresh=30, ttl=3600):
+        self.refresh = refresh
+        self.ttl = ttl
+        self._people = {}
+        self._keys = []
+        self._uids = []
+        self._newest = 0
+        self._loaded = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def _insert(self, found):
+        for key in search_keys(found):
+            i = bisect.bisect_right(self._keys, key)
+            self._keys.insert(i, key)
+            self._uids.insert(i, found.uid)
+
+    def load(self, dbcursor):
+        """
+        (Re)load the whole directory.
+        """
+        dbcursor.execute('SELECT uid, firstname, lastname, email FROM Users')
+        found = people_by_uid(dbcursor.fetchall())
+        entries = sorted((key, uid) for uid, each in found.items() for key in search_keys(each))
+        with self._lock:
+            self._people = found
+            self._keys = [key for key, _ in entries]
+            self._uids = [uid for _, uid in entries]
+            self._newest = max(found, default=0)
+            self._loaded = self._checked = time.monotonic()
+
+    def catch_up(self):
+        """
+        Load anything that's out of date: everything, the first time
+        and every ``ttl`` seconds, or else the users added since the
+        last check, every ``refresh`` seconds. Most of the time there's
+        nothing to do, and no query is run.
+        """
+        now = time.monotonic()
+        if self._loaded is None or now - self._loaded > self.ttl:
+            self.load(get_db().cursor())
+        elif now - self._checked > self.refresh:
+            self._checked = now
+            dbcursor = get_db().cursor()
+            dbcursor.execute(
+                'SELECT uid, firstname, lastname, email FROM Users'
+                ' WHERE uid > %s ORDER BY uid',
+                (self._newest,)
+            )
+            for found in people_by_uid(dbcursor.fetchall()).values():
+                self.add(found)
+
+    def add(self, found):
+        """
+        Add (or update) one user.
+
+        :param found: their ``Person``
+        """
+        with self._lock:
+            old = self._people.get(found.uid)
+            if old is not None:
+                for key in search_keys(old):
+                    i = bisect.bisect_left(self._keys, key)
+                    while self._uids[i] != found.uid:
+                        i += 1
+                    del self._keys[i]
+                    del self._uids[i]
+            self._people[found.uid] = found
+            self._insert(found)
+            self._newest = max(self._newest, found.uid)
+
+    def search(self, prefix, limit=10, exclude=()):
+        """
+        Find the users with a name or email starting with ``prefix``
+        (case doesn't matter; an empty prefix matches everyone).
+
+        :param limit: the most to return
+        :param exclude: uids to leave out
+        :return: a list of ``Person``, in order of the key they matched
+        """
+        prefix = ' '.join(prefix.lower().split())
+        found, seen = [], set(exclude)
+        with self._lock:
+            i = bisect.bisect_left(self._keys, prefix)
+            while i < len(self._keys) and len(found) < limit \
+                    and self._keys[i].startswith(prefix):
+                uid = self._uids[i]
+                if uid not in seen:
+                    seen.add(uid)
+                    found.append(self._people[uid])
+                i += 1
+        return found
+
+    def stats(self):
+        with self._lock:
+            return dict(users=len(self._people), keys=len(self._keys), newest=self._newest)
+
+
+def people_by_uid(rows):
+    return {row['uid']: person(row) for row in rows}
+
+
+def get_directory(app=None):
+    """
+    Get the app's directory, up to date within ``DIRECTORY_REFRESH``.
+    """
+    if app is None:
+        app = current_app._get_current_object()
+    directory = app.extensions.get('ptrak_directory')
+    if directory is None:
+        with _directory_lock:
+            directory = app.extensions.get('ptrak_directory')
+            if directory is None:
+                directory = Directory(app.config['DIRECTORY_REFRESH'], app.config['DIRECTORY_TTL'])
+                app.extensions['ptrak_directory'] = directory
+    directory.catch_up()
+    return directory
+
+
+def add_user(uid, firstname, lastname, email):
+    """
+    Put a new user in this worker's directory, by their decoded name.
+    """
+    directory = current_app.extensions.get('ptrak_directory')
+    if directory is not None:
+        directory.add(Person(uid, firstname, lastname, email))
+
+
+def init_app(app):
+    app.config.setdefault('DIRECTORY_REFRESH', 30)    # seconds between checks for new users
+    app.config.setdefault('DIRECTORY_TTL', 3600)      # seconds before a full reload
+    app.config.setdefault('DIRECTORY_RESULTS', 10)    # matches per search by default
+    app.config.setdefault('DIRECTORY_MAX_RESULTS', 50)
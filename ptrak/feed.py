@@ -0,0 +1,155 @@
+"""
+Each user's announcement feed, for the dashboard.
+
+Finding a user's latest announcements from scratch means collecting
+the announcements of every project they're in and sorting the lot,
+which gets slower the more projects they're in. Instead, each
+announcement is copied into the ``AnnouncementFeed`` of every member
+when it's made ("fan-out on write"). The feed's primary key is
+(uid, date_made, aid), so the dashboard reads its latest N entries
+straight off the front of the user's range.
+
+Feeds are kept up to date by:
+
+- ``fan_out()``, when an announcement is made;
+- ``add_members()`` / ``drop_members()``, when people join or leave a
+  project (``ptrak.membership.apply_changes()`` calls these), which
+  copy in or take out that project's announcements.
+
+Someone joining a project gets its latest ``FEED_BACKFILL``
+announcements. ``flask backfill-feed`` rebuilds feeds from scratch
+(e.g., for data from before the feed existed).
+"""
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from ptrak.db import get_db, read, transaction
+
+# the user's latest (uid, limit) feed entries, as announcements
+LATEST_QUERY = (
+    'SELECT content, Announcements.date_made, title, uid, firstname, lastname, Announcements.aid'
+    ' FROM (SELECT aid FROM AnnouncementFeed WHERE uid = %s'
+    '       ORDER BY date_made DESC, aid DESC LIMIT %s) AS latest'
+    ' JOIN Announcements ON Announcements.aid = latest.aid'
+    ' JOIN Projects ON Projects.pid = Announcements.pid'
+    ' JOIN Users ON author = uid'
+    ' ORDER BY Announcements.date_made DESC, Announcements.aid DESC'
+)
+
+
+def fan_out(dbcursor, aid):
+    """
+    Copy a new announcement into the feed of everyone on its project.
+    Run it in the same transaction as the INSERT.
+    """
+    dbcursor.execute(
+        'INSERT IGNORE INTO AnnouncementFeed (uid, date_made, aid, pid)'
+        ' SELECT Involvements.uid, Announcements.date_made, aid, Announcements.pid'
+        ' FROM Announcements JOIN Involvements ON Involvements.pid = Announcements.pid'
+        ' WHERE aid = %s',
+        (aid,)
+    )
+
+
+def add_members(dbcursor, pid, uids=None, limit=None):
+    """
+    Copy a project's latest announcements into some members' feeds.
+    Entries they already have are left alone.
+
+    :param uids: the members to add them for (default: all of them)
+    :param limit: how many announcements (default: ``FEED_BACKFILL``)
+    """
+    if limit is None:
+        limit = current_app.config['FEED_BACKFILL']
+    query = (
+        'INSERT IGNORE INTO AnnouncementFeed (uid, date_made, aid, pid)'
+        ' SELECT Involvements.uid, latest.date_made, latest.aid, latest.pid'
+        ' FROM (SELECT aid, pid, date_made FROM Announcements WHERE pid = %s'
+        '       ORDER BY date_made DESC, aid DESC LIMIT %s) AS latest'
+        ' JOIN Involvements ON Involvements.pid = latest.pid'
+    )
+    args = [pid, limit]
+    if uids is not None:
+        uids = list(uids)
+        if not uids:
+            return
+        query += ' WHERE Involvements.uid IN ({})'.format(', '.join(['%s'] * len(uids)))
+        args += uids
+    dbcursor.execute(query, args)
+
+
+def drop_members(dbcursor, pid, uids):
+    """
+    Take a project's announcements out of some (former) members' feeds.
+    """
+    uids = list(uids)
+    if uids:
+        dbcursor.execute(
+            'DELETE FROM AnnouncementFeed WHERE pid = %s AND uid IN ({})'.format(
+                ', '.join(['%s'] * len(uids))),
+            [pid] + uids
+        )
+
+
+def latest(uid, limit):
+    """
+    A ``read()`` for the user's latest announcements, with the project
+    title and author. Only the ``limit`` feed entries are looked up.
+    """
+    return read(LATEST_QUERY, (uid, limit,))
+
+
+def backfill(dbcursor, pids=None, rebuild=False, limit=None, echo=None):
+    """
+    Fill in feeds from the announcements and memberships already in
+    the database, a project at a time. Safe to run more than once.
+
+    :param pids: the projects to do (default: all of them)
+    :param rebuild: empty those projects' feed entries first
+    :param echo: called with a progress message per project
+    :return: the number of projects done
+    """
+    if pids is None:
+        dbcursor.execute('SELECT pid FROM Projects ORDER BY pid')
+        pids = [row['pid'] for row in dbcursor.fetchall()]
+    for number, pid in enumerate(pids, 1):
+        if rebuild:
+            dbcursor.execute('DELETE FROM AnnouncementFeed WHERE pid = %s', (pid,))
+        add_members(dbcursor, pid, limit=limit)
+        if echo is not None:
+            echo('  project {} ({}/{}): {} feed entries added'.format(
+                pid, number, len(pids), max(dbcursor.rowcount, 0)))
+    return len(pids)
+
+
+@click.command('backfill-feed')
+@click.option('--project', 'pids', type=int, multiple=True,
+              help='Only this project (can be given more than once).')
+@click.option('--rebuild', is_flag=True,
+              help='Throw away the existing entries first.')
+@click.option('--limit', type=int, default=None,
+              help='Announcements per project (default: FEED_BACKFILL).')
+@with_appcontext
+def backfill_feed_command(pids, rebuild, limit):
+    """
+    Fill in users' announcement feeds from existing data.
+    """
+    dbcursor = get_db().cursor()
+    if not pids:
+        dbcursor.execute('SELECT pid FROM Projects ORDER BY pid')
+        pids = [row['pid'] for row in dbcursor.fetchall()]
+    # a transaction per project, so a big backfill doesn't hold locks
+    # on everything at once and can be stopped part way
+    for number, pid in enumerate(pids, 1):
+        with transaction() as dbcursor:
+            backfill(dbcursor, [pid], rebuild, limit)
+            added = max(dbcursor.rowcount, 0)
+        click.echo('  project {} ({}/{}): {} feed entries added'.format(
+            pid, number, len(pids), added))
+    click.echo('Done: {} projects.'.format(len(pids)))
+
+
+def init_app(app):
+    app.config.setdefault('FEED_BACKFILL', 50)  # announcements copied in per project joined
+    app.cli.add_command(backfill_feed_command)
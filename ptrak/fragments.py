@@ -0,0 +1,142 @@
+"""
+Rendered-fragment cache for project pages.
+
+A project page is read far more often than it changes, so the
+expensive parts of it (the team card, the announcements, the task
+board) are kept as rendered HTML. Every cached fragment's key includes
+the project's current *version*; any write that changes what a project
+page shows calls ``bump_project()``, which gives the project a new
+version, so the old fragments are simply never asked for again (and
+age out of the size-bounded cache).
+
+Versions are kept in the database (``Projects.version``), not in a
+cache, so every worker sees a bump as soon as it's committed, whatever
+the cache backend; bumping in the same transaction as the write means
+no one can see the new version before the new data. A repeat view of
+an unchanged project then costs one primary key lookup plus one cache
+hit per fragment.
+
+Fragments live in their own cache (``FRAGMENT_CACHE_*`` config keys,
+falling back to ``CACHE_*``).
+"""
+import threading
+
+from flask import current_app
+from markupsafe import Markup
+
+from ptrak.cache import make_cache
+from ptrak.db import fetch_concurrently, get_db
+
+# guards fragment cache creation, like the other caches
+_fragment_lock = threading.Lock()
+
+
+def get_fragment_cache(app=None):
+    if app is None:
+        app = current_app._get_current_object()
+    cache = app.extensions.get('ptrak_fragments')
+    if cache is None:
+        with _fragment_lock:
+            cache = app.extensions.get('ptrak_fragments')
+            if cache is None:
+                cache = make_cache(app.config, 'FRAGMENT_CACHE')
+                app.extensions['ptrak_fragments'] = cache
+    return cache
+
+
+def project_version(pid):
+    """
+    Get the project's current version (0 if there's no such project).
+    """
+    dbcursor = get_db().cursor()
+    dbcursor.execute('SELECT version FROM Projects WHERE pid=%s', (pid,))
+    row = dbcursor.fetchone()
+    return row['version'] if row is not None else 0
+
+
+def bump_project(pid, dbcursor=None):
+    """
+    Mark everything cached for the project as out of date. Call this
+    for any write that changes what its page shows: inside the write's
+    transaction if it has one (passing its cursor), or right after.
+
+    Versions only ever count up, so an old version never comes back to
+    revive fragments cached under it.
+    """
+    if dbcursor is None:
+        dbcursor = get_db().cursor()
+    dbcursor.execute(
+        'UPDATE Projects SET version = version + 1 WHERE pid=%s', (pid,)
+    )
+
+
+def fragment_key(pid, version, name, *vary):
+    """
+    :param vary: anything else the fragment depends on (e.g., page cursors)
+    """
+    return 'frag:{}:{}:{}:{}'.format(pid, version, name, '|'.join(str(v) for v in vary))
+
+
+def get_fragments(keys):
+    """
+    Look up several fragments.
+
+    :param keys: dict mapping fragment name to cache key
+    :return: dict mapping name to cached value, for the ones found
+    """
+    cache = get_fragment_cache()
+    found = {}
+    for name, key in keys.items():
+        value = cache.get(key)
+        if value is not None:
+            found[name] = Markup(value) if isinstance(value, str) else value
+    return found
+
+
+def store_fragment(key, value):
+    """
+    Cache a rendered fragment (or any other value the page needs).
+
+    :return: the value, marked safe if it's HTML
+    """
+    get_fragment_cache().set(key, value)
+    return Markup(value) if isinstance(value, str) else value
+
+
+class LazyFragments:
+    """
+    A page's fragments, for a streamed page (see ``ptrak.streaming``):
+    the ones found in the cache, plus the rest, which are read (all at
+    once, with ``fetch_concurrently()``), rendered and cached the first
+    time the template uses any of them.
+
+    :param found: the cached fragments, from ``get_fragments()``
+    :param keys: dict mapping fragment name to cache key
+    :param reads: dict mapping fragment name to a list of reads
+    :param render: called with (name, list of read results) to get
+                   the fragment's value
+    """
+
+    def __init__(self, found, keys, reads, render):
+        self.found = found
+        self.keys = keys
+        self.reads = reads
+        self.render = render
+
+    def __getitem__(self, name):
+        if name not in self.found:
+            self.load()
+        return self.found[name]
+
+    def load(self):
+        missing = [name for name in self.reads if name not in self.found]
+        results = fetch_concurrently(*[run for name in missing for run in self.reads[name]])
+        for name in missing:
+            count = len(self.reads[name])
+            data, results = results[:count], results[count:]
+            self.found[name] = store_fragment(self.keys[name], self.render(name, data))
+
+
+def init_app(app):
+    app.config.setdefault('FRAGMENT_CACHE_SIZE', 512)   # entries, lru only
+    app.config.setdefault('FRAGMENT_CACHE_TTL', 300)    # seconds
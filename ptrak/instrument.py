@@ -0,0 +1,229 @@
+"""
+What each request does in the database.
+
+Every cursor handed out by ``ptrak.db`` is of the class in the
+``DB_CURSORCLASS`` config key (or the backend's own class), or for
+streamed reads ``DB_STREAMCURSORCLASS``. With ``SQL_INSTRUMENT`` on (the
+default), ``init_app()`` wraps those classes so every statement is timed
+and recorded, with its literals and parameters taken out so that the
+same query always looks the same ("normalized"). Then:
+
+- each response gets a ``Server-Timing`` header with the number of
+  statements the request ran and the time spent in them (browsers
+  show it in their dev tools);
+- a statement that took longer than ``SQL_SLOW_MS`` is logged to the
+  ``ptrak.sql`` logger, with its arguments;
+- a statement that ran ``SQL_REPEAT_WARN`` or more times in one
+  request is logged as a possible N+1 query;
+- totals per normalized statement are kept for the whole process, and
+  shown (top ones first) at ``/admin/sqlstats`` if
+  ``SQL_DEBUG_ENDPOINT`` is on.
+
+Statements run by ``fetch_concurrently()`` count towards the request
+that ran them, since they share its environ. So do the statements a
+streamed page (``ptrak.streaming``) runs as it's sent, but those come
+after the headers, so its ``Server-Timing`` only counts the ones before;
+its repeats are checked once the response is closed, and
+``request_queries()`` has them all by then.
+"""
+import collections
+import functools
+import logging
+import re
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request
+
+from ptrak.storage import BACKENDS
+
+logger = logging.getLogger('ptrak.sql')
+
+# where a request's statements are kept; the environ (unlike g) is
+# shared with the copies of the request context fetch_concurrently() uses
+ENVIRON_KEY = 'ptrak.sql'
+
+_strings = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_params = re.compile(r'%s|%\(\w+\)s')
+_numbers = re.compile(r'\b\d+(?:\.\d+)?\b')
+_lists = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_rows = re.compile(r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+')
+_space = re.compile(r'\s+')
+
+
+@functools.lru_cache(maxsize=2048)
+def normalize(statement):
+    """
+    Reduce a statement to its shape: every literal and parameter becomes
+    ``?``, lists of them (``IN (...)``, multi-row ``VALUES``) become one
+    ``(...)``, and whitespace is collapsed. E.g.::
+
+        SELECT * FROM Tasks WHERE pid IN (3, 4, 5) AND status='new'
+        SELECT * FROM Tasks WHERE pid IN (...) AND status=?
+    """
+    if isinstance(statement, bytes):
+        statement = statement.decode('utf-8', 'replace')
+    statement = _strings.sub('?', statement)
+    statement = _params.sub('?', statement)
+    statement = _numbers.sub('?', statement)
+    statement = _lists.sub('(...)', statement)
+    statement = _rows.sub('(...)', statement)
+    return _space.sub(' ', statement).strip()
+
+
+class Monitor:
+    """
+    Collects the statements run by one app's cursors.
+    """
+    def __init__(self, config):
+        self.slow = config['SQL_SLOW_MS'] / 1000
+        self.size = config['SQL_STATS_SIZE']
+        self._lock = threading.Lock()
+        # normalized statement -> [calls, total seconds, max seconds, rows]
+        self._totals = {}
+
+    def record(self, statement, args, seconds, rows):
+        shape = normalize(statement)
+        if seconds >= self.slow:
+            logger.warning('slow query (%.1f ms, %s rows): %s; args=%r',
+                           seconds * 1000, rows, shape, args)
+        if has_request_context():
+            queries = request.environ.get(ENVIRON_KEY)
+            if queries is not None:
+                queries.append((shape, seconds, rows))
+        with self._lock:
+            totals = self._totals.get(shape)
+            if totals is None:
+                if len(self._totals) >= self.size:
+                    # full up; lump the rest together rather than grow forever
+                    shape = '(other statements)'
+                    totals = self._totals.setdefault(shape, [0, 0.0, 0.0, 0])
+                else:
+                    totals = self._totals[shape] = [0, 0.0, 0.0, 0]
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+            totals[3] += max(rows or 0, 0)
+
+    def top(self, limit=20, by='total'):
+        """
+        :param by: ``total``, ``calls``, ``mean`` or ``max``
+        :return: list of dicts, biggest first
+        """
+        with self._lock:
+            items = [
+                dict(statement=shape, calls=calls, total_ms=round(total * 1000, 3),
+                     mean_ms=round(total * 1000 / calls, 3), max_ms=round(most * 1000, 3),
+                     rows=rows)
+                for shape, (calls, total, most, rows) in self._totals.items()
+            ]
+        key = dict(total='total_ms', calls='calls', mean='mean_ms', max='max_ms')[by]
+        items.sort(key=lambda item: item[key], reverse=True)
+        return items[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._totals.clear()
+
+
+def instrumented(cursorclass, monitor):
+    """
+    Wrap a cursor class so its statements are reported to ``monitor``.
+    An ``executemany()`` counts as one statement, however it's run.
+    """
+    class InstrumentedCursor(cursorclass):
+        _batch = False
+
+        def execute(self, query, args=None):
+            if self._batch:
+                # pymysql's executemany() runs its batches through here
+                return super().execute(query, args)
+            start = time.perf_counter()
+            try:
+                return super().execute(query, args)
+            finally:
+                monitor.record(query, args, time.perf_counter() - start, self.rowcount)
+
+        def executemany(self, query, args):
+            start = time.perf_counter()
+            self._batch = True
+            try:
+                return super().executemany(query, args)
+            finally:
+                self._batch = False
+                monitor.record(query, None, time.perf_counter() - start, self.rowcount)
+
+    InstrumentedCursor.__name__ = 'Instrumented' + cursorclass.__name__
+    return InstrumentedCursor
+
+
+def get_monitor(app=None):
+    if app is None:
+        app = current_app._get_current_object()
+    return app.extensions.get('ptrak_sql')
+
+
+def request_queries():
+    """
+    :return: the (normalized statement, seconds, rows) run so far in
+             this request
+    """
+    return list(request.environ.get(ENVIRON_KEY, ()))
+
+
+def start_request():
+    # whoever called the app may have passed in a list to record into
+    # (ptrak.bench does, to count a streamed page's statements)
+    request.environ.setdefault(ENVIRON_KEY, [])
+    g.request_started = time.perf_counter()
+
+
+def warn_repeats(queries, endpoint, threshold):
+    repeats = collections.Counter(shape for shape, _, _ in queries)
+    for shape, count in repeats.items():
+        if count >= threshold:
+            logger.warning('possible N+1 in %s: %d x %s', endpoint, count, shape)
+
+
+def finish_request(response):
+    queries = request.environ.get(ENVIRON_KEY)
+    if queries is None:
+        return response
+    config = current_app.config
+
+    check = functools.partial(warn_repeats, queries, request.endpoint, config['SQL_REPEAT_WARN'])
+    if response.is_streamed:
+        # most of its statements haven't run yet
+        response.call_on_close(check)
+    else:
+        check()
+
+    if config['SQL_SERVER_TIMING']:
+        spent = sum(seconds for _, seconds, _ in queries) * 1000
+        timings = ['db;dur={:.2f};desc="{} queries"'.format(spent, len(queries))]
+        if 'request_started' in g:
+            total = (time.perf_counter() - g.request_started) * 1000
+            timings.append('app;dur={:.2f}'.format(total))
+        response.headers.add('Server-Timing', ', '.join(timings))
+    return response
+
+
+def init_app(app):
+    app.config.setdefault('SQL_INSTRUMENT', True)
+    app.config.setdefault('SQL_SERVER_TIMING', True)
+    app.config.setdefault('SQL_SLOW_MS', 200)       # log statements slower than this
+    app.config.setdefault('SQL_REPEAT_WARN', 5)     # same statement this often = N+1?
+    app.config.setdefault('SQL_STATS_SIZE', 500)    # distinct statements to keep totals for
+    app.config.setdefault('SQL_DEBUG_ENDPOINT', False)
+    if not app.config['SQL_INSTRUMENT']:
+        return
+
+    monitor = Monitor(app.config)
+    app.extensions['ptrak_sql'] = monitor
+    backend = BACKENDS[app.config['DB_BACKEND']]
+    cursorclass = app.config['DB_CURSORCLASS'] or backend.cursorclass
+    app.config['DB_CURSORCLASS'] = instrumented(cursorclass, monitor)
+    streamcursorclass = app.config['DB_STREAMCURSORCLASS'] or backend.streamcursorclass
+    app.config['DB_STREAMCURSORCLASS'] = instrumented(streamcursorclass, monitor)
+    app.before_request(start_request)
+    app.after_request(finish_request)
@@ -0,0 +1,204 @@
+"""
+Bulk changes to project membership (the ``Involvements`` table).
+
+Adding a whole team one INSERT at a time means one round trip per
+person, and if anything fails halfway the team is left half-added.
+``apply_changes()`` does any number of adds, removes and rank changes
+with a handful of multi-row statements, and is meant to be run inside
+``ptrak.db.transaction()`` so it's all-or-nothing.
+
+The same thing is available as ``flask sync-members`` for syncing large
+teams from a file (the JSON endpoint lives with the project views).
+"""
+import functools
+import json
+
+import click
+from flask.cli import with_appcontext
+
+from ptrak import feed
+from ptrak.access import forget_ranks
+from ptrak.fragments import bump_project
+from ptrak.db import get_backend, mystify, transaction
+
+# project ranks: 1 = contributor, 2 = (unused so far), 3 = manager
+RANKS = (1, 2, 3)
+
+
+def apply_changes(dbcursor, add=(), remove=(), rerank=()):
+    """
+    Apply a batch of membership changes.
+
+    Adding someone who is already involved leaves their rank alone;
+    use ``rerank`` to change it (which also adds them if needed).
+    Their announcement feeds (see ``ptrak.feed``) are updated to match.
+    Call ``forget_ranks()`` on the returned uids once committed.
+
+    :param dbcursor: a cursor, ideally inside ``transaction()``
+    :param add: (uid, pid, rank) triples to add
+    :param remove: (uid, pid) pairs to remove
+    :param rerank: (uid, pid, rank) triples to set the rank of
+    :return: the set of uids whose involvements may have changed
+    """
+    add = [(int(uid), int(pid), int(rank)) for uid, pid, rank in add]
+    rerank = [(int(uid), int(pid), int(rank)) for uid, pid, rank in rerank]
+    remove = [(int(uid), int(pid)) for uid, pid in remove]
+    for _, _, rank in add + rerank:
+        if rank not in RANKS:
+            raise ValueError('invalid project rank {}'.format(rank))
+
+    # executemany() turns these into multi-row INSERTs (on MySQL)
+    upsert = functools.partial(get_backend().upsert, 'Involvements',
+                               ('uid', 'pid', '`rank`'), ('uid', 'pid'))
+    if add:
+        dbcursor.executemany(upsert(), add)
+    if rerank:
+        dbcursor.executemany(upsert(update=('`rank`',)), rerank)
+    # one DELETE per project, served by the (pid, uid) index
+    byproject = {}
+    for uid, pid in remove:
+        byproject.setdefault(pid, []).append(uid)
+    for pid, uids in byproject.items():
+        dbcursor.execute(
+            'DELETE FROM Involvements WHERE pid=%s AND uid IN ({})'.format(
+                ', '.join(['%s'] * len(uids))),
+            [pid] + uids
+        )
+        feed.drop_members(dbcursor, pid, uids)
+
+    # and one INSERT ... SELECT per project for the feeds of anyone
+    # (possibly) new; entries they already have are skipped
+    joined = {}
+    for uid, pid, _ in add + rerank:
+        joined.setdefault(pid, set()).add(uid)
+    for pid, uids in joined.items():
+        feed.add_members(dbcursor, pid, sorted(uids))
+
+    return {uid for uid, _, _ in add + rerank} | {uid for uid, _ in remove}
+
+
+def sync(add=(), remove=(), rerank=()):
+    """
+    Apply membership changes in their own transaction (bumping the
+    projects' versions) and drop the affected users' cached ranks.
+
+    :return: the set of affected uids
+    """
+    with transaction() as dbcursor:
+        changed = apply_changes(dbcursor, add, remove, rerank)
+        for pid in {change[1] for change in (*add, *remove, *rerank)}:
+            bump_project(pid, dbcursor)
+    forget_ranks(*changed)
+    return changed
+
+
+def _lookup_uids(dbcursor, emails):
+    """
+    :return: dict mapping (plain) email to uid, for the ones that exist
+    """
+    found = {}
+    emails = list(emails)
+    for start in range(0, len(emails), 500):
+        chunk = emails[start:start + 500]
+        dbcursor.execute(
+            'SELECT uid, email FROM Users WHERE email IN ({})'.format(
+                ', '.join(['%s'] * len(chunk))),
+            [mystify(email) for email in chunk]
+        )
+        byencoded = {mystify(email): email for email in chunk}
+        for row in dbcursor.fetchall():
+            encoded = row['email']
+            if isinstance(encoded, str):
+                encoded = encoded.encode('utf-8')
+            found[byencoded[encoded]] = row['uid']
+    return found
+
+
+def _entry_problem(entry):
+    """
+    :return: what's wrong with a ``sync-members`` entry, or None
+    """
+    def is_id(value):
+        return isinstance(value, int) and not isinstance(value, bool)
+
+    if not isinstance(entry, dict):
+        return 'not a JSON object'
+    if not is_id(entry.get('pid')):
+        return 'needs a numeric "pid"'
+    if 'uid' in entry:
+        if not is_id(entry['uid']):
+            return '"uid" must be a number'
+    elif not isinstance(entry.get('email'), str):
+        return 'needs a "uid" or an "email"'
+    if 'rank' in entry and not is_id(entry['rank']):
+        return '"rank" must be a number'
+    return None
+
+
+@click.command('sync-members')
+@click.argument('source', type=click.File('r'))
+@click.option('--exact', is_flag=True,
+              help='Also remove anyone not listed from the projects in the file.')
+@click.option('--dry-run', is_flag=True, help='Roll back instead of committing.')
+@with_appcontext
+def sync_members_command(source, exact, dry_run):
+    """
+    Sync project membership from a JSON-lines file. Each line is e.g.
+
+        {"pid": 3, "uid": 12, "rank": 1}
+        {"pid": 3, "email": "someone@example.com", "rank": 3}
+        {"pid": 4, "uid": 12, "remove": true}
+
+    Listed users get the given rank (default 1). Everything is applied
+    in a single transaction.
+    """
+    entries = []
+    for number, line in enumerate(source, 1):
+        line = line.strip()
+        if line:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                raise click.ClickException('line {}: not valid JSON'.format(number))
+            problem = _entry_problem(entry)
+            if problem:
+                raise click.ClickException('line {}: {}'.format(number, problem))
+            entries.append((number, entry))
+
+    with transaction() as dbcursor:
+        uids = _lookup_uids(dbcursor, {e['email'] for _, e in entries if 'uid' not in e})
+        rerank, remove = [], []
+        for number, entry in entries:
+            uid = entry.get('uid', uids.get(entry.get('email')))
+            if uid is None:
+                raise click.ClickException('line {}: unknown user {}'.format(number, entry['email']))
+            if entry.get('remove'):
+                remove.append((uid, entry['pid']))
+            else:
+                rerank.append((uid, entry['pid'], entry.get('rank', 1)))
+
+        if exact:
+            # anyone on a listed project who isn't in the file goes
+            keep = {(uid, pid) for uid, pid, _ in rerank}
+            for pid in {pid for _, pid, _ in rerank}:
+                dbcursor.execute('SELECT uid FROM Involvements WHERE pid=%s', (pid,))
+                remove.extend((row['uid'], pid) for row in dbcursor.fetchall()
+                              if (row['uid'], pid) not in keep)
+
+        try:
+            changed = apply_changes(dbcursor, rerank=rerank, remove=remove)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        for pid in {pid for _, pid, _ in rerank} | {pid for _, pid in remove}:
+            bump_project(pid, dbcursor)
+        if dry_run:
+            dbcursor.connection.rollback()
+
+    if not dry_run:
+        forget_ranks(*changed)
+    click.echo('{} {} memberships set, {} removed, {} users affected.'.format(
+        'Would have' if dry_run else 'Done:', len(rerank), len(remove), len(changed)))
+
+
+def init_app(app):
+    app.cli.add_command(sync_members_command)
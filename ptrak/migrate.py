@@ -0,0 +1,461 @@
+"""
+Versioned schema migrations.
+
+Each migration is a function that takes a cursor and brings the
+database from one version to the next. The versions that have been
+applied are recorded in the ``SchemaVersion`` table, so running
+``flask migrate`` again only applies the new ones. Migrations only
+ever add to the schema or rename things in place, so they are safe
+to run against a database that already has data in it.
+
+To change the schema, add a new function to the end of ``MIGRATIONS``
+(never edit one that has already shipped) and update ``schema.sql``
+to match.
+
+SQLite databases (see ``ptrak.storage``) start out from
+``schema_sqlite.sql``, which is the schema as of version
+``SQLITE_BASELINE``; only the migrations after that are run on them,
+so those have to be written in SQL both databases understand (the
+helpers below work on both), or go through the backend.
+
+``flask check-queries`` EXPLAINs the queries our routes run most and
+fails if any of them would scan a whole table.
+"""
+import sys
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from ptrak.db import get_backend, get_db
+
+# the version schema_sqlite.sql is at
+SQLITE_BASELINE = 4
+
+
+def table_exists(dbcursor, table):
+    return table in get_backend().tables(dbcursor)
+
+
+def column_exists(dbcursor, table, column):
+    return column.lower() in get_backend().columns(dbcursor, table)
+
+
+def index_exists(dbcursor, table, columns):
+    """
+    Check whether some index on ``table`` starts with ``columns``
+    (in order). We don't go by index name, since databases that were
+    set up by hand may have the right index under another name.
+    """
+    indexes = get_backend().indexes(dbcursor, table)
+    wanted = [column.lower() for column in columns]
+    return any(cols[:len(wanted)] == wanted for cols in indexes.values())
+
+
+def add_column(dbcursor, table, column, definition):
+    if not column_exists(dbcursor, table, column):
+        dbcursor.execute(
+            'ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, definition)
+        )
+
+
+def add_index(dbcursor, table, name, columns):
+    if not index_exists(dbcursor, table, columns):
+        dbcursor.execute(
+            'CREATE INDEX {} ON {} ({})'.format(name, table, ', '.join(columns))
+        )
+
+
+def baseline(dbcursor):
+    """
+    The tables as originally defined in schema.sql. Existing tables
+    are left alone; later migrations fix them up.
+    """
+    dbcursor.execute(
+        'CREATE TABLE IF NOT EXISTS Users ('
+        ' uid INT AUTO_INCREMENT,'
+        ' firstname VARCHAR(50) NOT NULL,'
+        ' lastname VARCHAR(50) NOT NULL,'
+        ' email VARCHAR(50) UNIQUE NOT NULL,'
+        ' password VARCHAR(200) NOT NULL,'
+        ' projects TEXT,'
+        ' level INT DEFAULT 1,'
+        ' lastlogin TIMESTAMP NULL DEFAULT NULL,'
+        ' PRIMARY KEY (uid)'
+        ') ENGINE=InnoDB'
+    )
+    dbcursor.execute(
+        'CREATE TABLE IF NOT EXISTS Projects ('
+        ' pid INT AUTO_INCREMENT,'
+        ' title VARCHAR(500) NOT NULL,'
+        ' owner INT NOT NULL,'
+        ' description TEXT NOT NULL,'
+        ' date_due TIMESTAMP NULL DEFAULT NULL,'
+        ' PRIMARY KEY (pid),'
+        ' FOREIGN KEY (owner) REFERENCES Users (uid)'
+        ') ENGINE=InnoDB'
+    )
+    dbcursor.execute(
+        'CREATE TABLE IF NOT EXISTS Tasks ('
+        ' tid INT AUTO_INCREMENT,'
+        ' pid INT NOT NULL,'
+        ' creator INT NOT NULL,'
+        " status ENUM('new', 'in progress', 'under review', 'complete') NOT NULL DEFAULT 'new',"
+        ' title VARCHAR(250) NOT NULL,'
+        ' description TEXT,'
+        ' due_date TIMESTAMP NULL DEFAULT NULL,'
+        ' date_submitted TIMESTAMP DEFAULT CURRENT_TIMESTAMP,'
+        ' date_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,'
+        ' tags TEXT,'
+        ' PRIMARY KEY (tid),'
+        ' FOREIGN KEY (pid) REFERENCES Projects (pid),'
+        ' FOREIGN KEY (creator) REFERENCES Users (uid)'
+        ') ENGINE=InnoDB'
+    )
+    dbcursor.execute(
+        'CREATE TABLE IF NOT EXISTS Notes ('
+        ' nid INT AUTO_INCREMENT,'
+        ' tid INT NOT NULL,'
+        ' content TEXT NOT NULL,'
+        ' author INT NOT NULL,'
+        ' date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,'
+        ' PRIMARY KEY (nid),'
+        ' FOREIGN KEY (tid) REFERENCES Tasks (tid),'
+        ' FOREIGN KEY (author) REFERENCES Users (uid)'
+        ') ENGINE=InnoDB'
+    )
+    dbcursor.execute(
+        'CREATE TABLE IF NOT EXISTS Messages ('
+        ' mid INT AUTO_INCREMENT,'
+        ' destination INT NOT NULL,'
+        ' source INT NOT NULL,'
+        ' content TEXT NOT NULL,'
+        ' date_sent TIMESTAMP DEFAULT CURRENT_TIMESTAMP,'
+        ' PRIMARY KEY (mid),'
+        ' FOREIGN KEY (source) REFERENCES Users (uid),'
+        ' FOREIGN KEY (destination) REFERENCES Users (uid)'
+        ') ENGINE=InnoDB'
+    )
+    dbcursor.execute(
+        'CREATE TABLE IF NOT EXISTS Announcements ('
+        ' aid INT AUTO_INCREMENT,'
+        ' pid INT NOT NULL,'
+        ' author INT NOT NULL,'
+        ' date_made TIMESTAMP DEFAULT CURRENT_TIMESTAMP,'
+        ' content TEXT NOT NULL,'
+        ' PRIMARY KEY (aid),'
+        ' FOREIGN KEY (pid) REFERENCES Projects (pid),'
+        ' FOREIGN KEY (author) REFERENCES Users (uid)'
+        ') ENGINE=InnoDB'
+    )
+
+
+def match_code(dbcursor):
+    """
+    Add the tables and columns the code uses but schema.sql never had.
+    """
+    dbcursor.execute(
+        'CREATE TABLE IF NOT EXISTS Involvements ('
+        ' uid INT NOT NULL,'
+        ' pid INT NOT NULL,'
+        ' `rank` INT NOT NULL DEFAULT 1,'
+        ' PRIMARY KEY (uid, pid),'
+        ' FOREIGN KEY (uid) REFERENCES Users (uid),'
+        ' FOREIGN KEY (pid) REFERENCES Projects (pid)'
+        ') ENGINE=InnoDB'
+    )
+    add_column(dbcursor, 'Messages', 'subject', "VARCHAR(250) NOT NULL DEFAULT ''")
+    add_column(dbcursor, 'Messages', 'unread', 'TINYINT(1) NOT NULL DEFAULT 1')
+
+    # the code has always said date_due
+    if column_exists(dbcursor, 'Tasks', 'due_date') \
+            and not column_exists(dbcursor, 'Tasks', 'date_due'):
+        dbcursor.execute(
+            'ALTER TABLE Tasks CHANGE due_date date_due TIMESTAMP NULL DEFAULT NULL'
+        )
+
+    # without explicit defaults, MySQL makes the first TIMESTAMP in a
+    # table auto-update on every UPDATE, which would e.g. bump lastlogin
+    # every time someone sends the user a message
+    dbcursor.execute('ALTER TABLE Users MODIFY lastlogin TIMESTAMP NULL DEFAULT NULL')
+    dbcursor.execute('ALTER TABLE Projects MODIFY date_due TIMESTAMP NULL DEFAULT NULL')
+    dbcursor.execute('ALTER TABLE Tasks MODIFY date_due TIMESTAMP NULL DEFAULT NULL')
+
+    # the unread badge counter, filled in from the messages we have
+    if not column_exists(dbcursor, 'Users', 'unreadcount'):
+        add_column(dbcursor, 'Users', 'unreadcount', 'INT NOT NULL DEFAULT 0')
+        dbcursor.execute(
+            'UPDATE Users SET unreadcount ='
+            ' (SELECT COUNT(*) FROM Messages WHERE destination=uid AND unread=1)'
+        )
+
+
+def hot_path_indexes(dbcursor):
+    """
+    Composite indexes for the queries that run on every page view.
+    Each one is laid out as (equality filters..., sort columns...),
+    so pages come straight off the index in order.
+    """
+    # the inbox, newest first; and unread previews
+    add_index(dbcursor, 'Messages', 'Messages_inbox', ('destination', 'date_sent', 'mid'))
+    add_index(dbcursor, 'Messages', 'Messages_unread', ('destination', 'unread', 'date_sent'))
+    # the project board: a page per status tab, and all tasks by update time
+    add_index(dbcursor, 'Tasks', 'Tasks_board', ('pid', 'status', 'date_updated', 'tid'))
+    add_index(dbcursor, 'Tasks', 'Tasks_updated', ('pid', 'date_updated', 'tid'))
+    add_index(dbcursor, 'Announcements', 'Announcements_feed', ('pid', 'date_made', 'aid'))
+    # involvement checks go by (uid, pid), team lists by pid
+    add_index(dbcursor, 'Involvements', 'Involvements_user', ('uid', 'pid'))
+    add_index(dbcursor, 'Involvements', 'Involvements_project', ('pid', 'uid'))
+    add_index(dbcursor, 'Notes', 'Notes_task', ('tid', 'date_added', 'nid'))
+    add_index(dbcursor, 'Users', 'Users_name', ('lastname', 'firstname'))
+
+
+def announcement_feed(dbcursor):
+    """
+    Per-user announcement feeds for the dashboard (see ``ptrak.feed``),
+    filled in from the existing announcements.
+    """
+    # DATETIME rather than TIMESTAMP: it's in the primary key, so it
+    # can't be NULL, and a NOT NULL TIMESTAMP may get MySQL's
+    # auto-update behaviour
+    dbcursor.execute(
+        'CREATE TABLE IF NOT EXISTS AnnouncementFeed ('
+        ' uid INT NOT NULL,'
+        ' date_made DATETIME NOT NULL,'
+        ' aid INT NOT NULL,'
+        ' pid INT NOT NULL,'
+        ' PRIMARY KEY (uid, date_made, aid),'
+        ' INDEX AnnouncementFeed_member (pid, uid),'
+        ' FOREIGN KEY (uid) REFERENCES Users (uid),'
+        ' FOREIGN KEY (aid) REFERENCES Announcements (aid),'
+        ' FOREIGN KEY (pid) REFERENCES Projects (pid)'
+        ') ENGINE=InnoDB'
+    )
+    from ptrak.feed import backfill
+    backfill(dbcursor)
+
+
+def full_text_search(dbcursor):
+    """
+    Full-text indexes for search (see ``ptrak.search``). On MySQL,
+    the first FULLTEXT index on a table rebuilds it, so this can take
+    a while on a big database.
+    """
+    from ptrak.search import SOURCES
+    backend = get_backend()
+    for table, name, columns, key, _ in SOURCES.values():
+        backend.add_full_text_index(dbcursor, table, name, columns, key)
+
+
+def task_tags(dbcursor):
+    """
+    The tag index (see ``ptrak.tags``), filled in from ``Tasks.tags``.
+    """
+    # the primary key serves "tasks with this tag in these projects" and
+    # the per-project counts; the tid index, replacing a task's tags
+    dbcursor.execute(
+        'CREATE TABLE IF NOT EXISTS TaskTags ('
+        ' pid INT NOT NULL,'
+        ' tag VARCHAR(50) NOT NULL,'
+        ' tid INT NOT NULL,'
+        ' PRIMARY KEY (pid, tag, tid),'
+        ' FOREIGN KEY (pid) REFERENCES Projects (pid),'
+        ' FOREIGN KEY (tid) REFERENCES Tasks (tid)'
+        ')'
+    )
+    add_index(dbcursor, 'TaskTags', 'TaskTags_task', ('tid',))
+    from ptrak.tags import backfill
+    backfill(dbcursor)
+
+
+def project_versions(dbcursor):
+    """
+    ``Projects.version``, counted up by every change to a project's
+    page, so all workers agree on which cached fragments are current
+    (see ``ptrak.fragments``).
+    """
+    add_column(dbcursor, 'Projects', 'version', 'INT NOT NULL DEFAULT 0')
+
+
+def binary_tags(dbcursor):
+    """
+    Compare ``TaskTags.tag`` byte for byte, the way ``tags.parse()``
+    tells tags apart: under MySQL's default (accent- and
+    case-insensitive) collation, ``resume`` and ``résumé`` are the same
+    key. SQLite compares them exactly already.
+    """
+    if get_backend().name == 'mysql':
+        dbcursor.execute(
+            'ALTER TABLE TaskTags MODIFY tag VARCHAR(50)'
+            ' CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL'
+        )
+
+
+# (version, description, function), in order. Append only!
+MIGRATIONS = [
+    (1, 'baseline schema', baseline),
+    (2, 'bring schema in line with the code', match_code),
+    (3, 'hot-path indexes', hot_path_indexes),
+    (4, 'announcement feeds', announcement_feed),
+    (5, 'full-text search', full_text_search),
+    (6, 'task tags', task_tags),
+    (7, 'project versions', project_versions),
+    (8, 'binary task tags', binary_tags),
+]
+
+
+def current_version(dbcursor):
+    """
+    :return: the highest applied migration version (0 for a fresh database)
+    """
+    # (InnoDB is MySQL's default engine; leaving it out keeps this portable)
+    dbcursor.execute(
+        'CREATE TABLE IF NOT EXISTS SchemaVersion ('
+        ' version INT NOT NULL,'
+        ' description VARCHAR(200) NOT NULL,'
+        ' applied TIMESTAMP DEFAULT CURRENT_TIMESTAMP,'
+        ' PRIMARY KEY (version)'
+        ')'
+    )
+    dbcursor.execute('SELECT MAX(version) AS version FROM SchemaVersion')
+    return dbcursor.fetchone()['version'] or 0
+
+
+def upgrade(dbcursor, target=None, echo=None):
+    """
+    Apply every migration newer than the database, up to ``target``.
+    Each version is recorded as soon as it's applied, so an
+    interrupted run picks up where it left off.
+
+    :param target: the version to stop at (default: the latest)
+    :param echo: called with a progress message per migration
+    :return: the list of versions applied
+    """
+    version = current_version(dbcursor)
+    applied = []
+    if version == 0 and get_backend().name == 'sqlite':
+        if echo is not None:
+            echo('Creating schema (version {})'.format(SQLITE_BASELINE))
+        with current_app.open_resource('schema_sqlite.sql') as f:
+            dbcursor.connection.executescript(f.read().decode('utf8'))
+        version = SQLITE_BASELINE
+        applied.append(version)
+    for number, description, migration in MIGRATIONS:
+        if number <= version or (target is not None and number > target):
+            continue
+        if echo is not None:
+            echo('Applying {}: {}'.format(number, description))
+        migration(dbcursor)
+        dbcursor.execute(
+            'INSERT INTO SchemaVersion (version, description) VALUES (%s, %s)',
+            (number, description,)
+        )
+        applied.append(number)
+    return applied
+
+
+@click.command('migrate')
+@click.option('--to', 'target', type=int, default=None,
+              help='Stop at this version instead of the latest.')
+@click.option('--status', is_flag=True,
+              help='Only show which migrations are pending.')
+@with_appcontext
+def migrate_command(target, status):
+    """
+    Create the database, or bring an existing one up to date.
+    """
+    dbcursor = get_db().cursor()
+    version = current_version(dbcursor)
+    if status:
+        click.echo('Database is at version {}.'.format(version))
+        for number, description, _ in MIGRATIONS:
+            if number > version:
+                click.echo('  pending {}: {}'.format(number, description))
+        return
+    applied = upgrade(dbcursor, target, echo=click.echo)
+    if not applied:
+        click.echo('Already up to date (version {}).'.format(version))
+    else:
+        click.echo('Now at version {}.'.format(applied[-1]))
+
+
+def route_queries():
+    """
+    The queries our routes run on nearly every request, with sample
+    arguments to EXPLAIN them with. The SQL comes from the views
+    themselves (their module-level queries and query builders), so
+    what's checked is what runs. Queries that deliberately read a
+    whole table (e.g., the full user list for the message form) don't
+    belong here.
+
+    :return: list of (name, query, args)
+    """
+    from ptrak import access, api, feed, my, notes, project, tags, task, user
+    from ptrak.paging import page_query
+    return [
+        ('user.load_logged_in_user', user.USER_QUERY, (1,)),
+        ('access.project_ranks', access.RANKS_QUERY, (1,)),
+        ('my.dashboard projects', my.PROJECTS_QUERY, (1,)),
+        ('my.dashboard unread previews', my.UNREAD_PREVIEWS_QUERY, (1, 5)),
+        ('my.dashboard announcements', feed.LATEST_QUERY, (1, 5)),
+        ('my.messages inbox', *page_query(my.INBOX_QUERY, (1,), my.INBOX_SORT)),
+        ('my.messages mark read', my.mark_read_query(2), (1, 1, 2)),
+        ('my.tagged', *page_query(*tags.tagged_tasks_query('backend', [1, 2]),
+                                  tags.TAGGED_SORT)),
+        ('project.project details', project.DETAILS_QUERY, (1,)),
+        ('project.project team', project.TEAM_QUERY, (1,)),
+        ('project.project announcements',
+         *page_query(project.ANNOUNCEMENTS_QUERY, (1,), project.ANNOUNCEMENT_SORT)),
+        ('project.project tasks',
+         *page_query(*project.tasktab_query(1, 'new'), project.TASK_SORT)),
+        ('project.project tasks by tag',
+         *page_query(*project.tasktab_query(1, 'new', 'backend'), project.TASK_SORT)),
+        ('project.project status counts', *project.status_counts_query(1)),
+        ('project.project tag counts', tags.COUNTS_QUERY, (1, 30)),
+        ('project.project note summaries', *notes.summaries_query([1, 2])),
+        ('task.edit', task.TASK_QUERY, (1,)),
+        ('task.notes', *page_query(notes.THREAD_QUERY, (1,), notes.THREAD_SORT)),
+        ('api.tasks validators', api.TASK_VALIDATORS.format('pid=%s AND status=%s'),
+         (1, 'new')),
+        ('api.announcements validators', api.ANNOUNCEMENT_VALIDATORS, (1,)),
+        ('api.messages validators', api.MESSAGE_VALIDATORS, (1,)),
+    ]
+
+
+def explain_scans(dbcursor, queries=None):
+    """
+    EXPLAIN each query and find the ones that scan a whole table.
+
+    :param queries: (name, query, args) triples (default: ``route_queries()``)
+    :return: list of (query name, table) pairs that do a full scan
+    """
+    if queries is None:
+        queries = route_queries()
+    backend = get_backend()
+    scans = []
+    for name, query, args in queries:
+        for table in backend.full_scans(dbcursor, query, args):
+            scans.append((name, table))
+    return scans
+
+
+@click.command('check-queries')
+@with_appcontext
+def check_queries_command():
+    """
+    Fail if any hot route query does a full table scan.
+    Run it against a migrated database.
+    """
+    dbcursor = get_db().cursor()
+    queries = route_queries()
+    scans = explain_scans(dbcursor, queries)
+    for name, table in scans:
+        click.echo('FULL SCAN: {} reads all of {}'.format(name, table), err=True)
+    if scans:
+        sys.exit(1)
+    click.echo('{} queries checked, no full table scans.'.format(len(queries)))
+
+
+def init_app(app):
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(check_queries_command)
@@ -6,25 +6,102 @@ the dashboard, recent messages, involved projects, and so on.
 """
 
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, url_for
+    Blueprint, current_app, flash, g, redirect, render_template, request,
+    session, url_for
 )
-from ptrak.db import get_db
-from ptrak.user import login_required
+from ptrak.db import get_db, fetch_concurrently, read, transaction
+from ptrak.streaming import PageRows, stream_page
+from ptrak.user import login_required, forget_user
+from ptrak.people import attach, person
+from ptrak.access import project_ranks
+from ptrak import feed, notify
+from ptrak import search as fulltext
+from ptrak import tags
 # init the blueprint
 bp = Blueprint('my', __name__, url_prefix='/my')
 
+# the hot queries below are EXPLAINed by ``flask check-queries``
+# a user's messages, with the sender; paged on INBOX_SORT
+INBOX_QUERY = (
+    'SELECT mid, source, firstname, lastname, email, content, date_sent, subject, unread'
+    ' FROM Messages JOIN Users ON Messages.source = Users.uid'
+    ' WHERE Messages.destination = (%s)'
+)
+INBOX_SORT = ('Messages.date_sent', 'Messages.mid')
+# the user's projects, for the dashboard
+PROJECTS_QUERY = (
+    'SELECT * FROM Involvements JOIN Projects ON Involvements.pid = Projects.pid '
+    'WHERE uid = (%s) '
+)
+# the latest (uid, limit) unread messages, for the dashboard
+UNREAD_PREVIEWS_QUERY = (
+    'SELECT subject, date_sent, uid, firstname, lastname'
+    ' FROM Messages JOIN Users ON source=uid'
+    ' WHERE destination = (%s) AND unread=1'
+    ' ORDER BY date_sent DESC LIMIT %s'
+)
+
+def mark_read_query(count):
+    """
+    The UPDATE for ``mark_read()``, for ``count`` mids; its arguments
+    are the uid, then the mids.
+    """
+    return ('UPDATE Messages SET unread=0'
+            ' WHERE destination=(%s) AND unread=1 AND mid IN ({})'.format(
+                ', '.join(['%s'] * count)))
+
+def load_inbox(uid):
+    """
+    One page of a user's messages (with sender info, as ``sender``),
+    newest first, read as the page is sent (see ptrak.streaming). The
+    cursor comes from the ``after`` query arg. Once the page has been
+    read, the new messages on it are marked as read.
+
+    :return: a ``PageRows``
+    """
+    return PageRows(
+        INBOX_QUERY,
+        (uid,),
+        sort=INBOX_SORT,
+        after=request.args.get('after'),
+        limit=current_app.config['MESSAGE_PAGE_SIZE'],
+        each=lambda row: dict(row, sender=person(row, 'source')),
+        keep=lambda row: row['mid'] if row['unread'] else None,
+        done=lambda mids: mark_read(uid, [mid for mid in mids if mid is not None])
+    )
+
+def mark_read(uid, unread):
+    """
+    Mark some of a user's new messages as read. Only those rows are
+    written, however long the inbox is.
+
+    :param unread: the mids
+    """
+    if not unread:
+        return
+    with transaction() as dbcursor:
+        marked = dbcursor.execute(mark_read_query(len(unread)), [uid] + unread)
+        # take them off the notification; a subtraction, not a
+        # reset, so a message that arrives meanwhile still counts
+        if marked:
+            dbcursor.execute(
+                'UPDATE Users SET unreadcount = unreadcount - %s WHERE uid=(%s)',
+                (marked, uid,)
+            )
+    if marked:
+        g.unreadcount = max(0, (g.unreadcount or 0) - marked)
+        forget_user(uid)
+
 @bp.route('/messages', methods=('GET', 'POST'))
 @login_required
 def messages():
     """
-    This view first gets all messages addressed to the current user,
-    along with some basic info about the sender.
-    Then it loads some basic info about all users to be used
-    to provide options for addressing new outgoing messages.
-    It passes both of these lists of dictionaries to the template as arguments
-    (``messages`` and ``users``, respectively).
+    This view gets a page of the messages addressed to the
+    current user (newest first; ``?after=`` continues from the cursor
+    of the previous page), along with some basic info about the sender,
+    and passes them to the template as ``messages``. The form for
+    new messages looks up recipients with ``api.users``.
     """
-    dbcursor = get_db().cursor()
     if request.method == 'POST':
         # of course, the source is the current uid
         source = session['uid']
@@ -40,54 +117,44 @@ def messages():
             destination = int(destination)
         except ValueError:
             error = "Invalid destination."
-        # check that the destination user actually exists as well
-        rows = dbcursor.execute(
-            'SELECT firstname FROM Users WHERE uid=(%s)',
-            (destination,)
-        )
-        if rows < 1:
-            error = "Invalid destination."
+        # check that the destination user actually exists as well;
+        # bumping their unread counter does that in the same round trip.
+        # the counter and the message go in together, so a failed
+        # INSERT can't leave the counter off for good
+        if error is None:
+            with transaction() as dbcursor:
+                rows = dbcursor.execute(
+                    'UPDATE Users SET unreadcount = unreadcount + 1'
+                    ' WHERE uid=(%s)',
+                    (destination,)
+                )
+                if rows > 0:
+                    dbcursor.execute(
+                        'INSERT INTO Messages'
+                        ' (destination, source, subject, content) VALUES'
+                        ' (%s, %s, %s, %s)',
+                        (destination, source, subject, content,)
+                    )
+                    mid = dbcursor.lastrowid
+            if rows < 1:
+                error = "Invalid destination."
 
         if error is None:
-            dbcursor.execute(
-                'INSERT INTO Messages'
-                ' (destination, source, subject, content) VALUES'
-                ' (%s, %s, %s, %s)',
-                (destination, source, subject, content,)
-            )
+            # the recipient has a new unread message (now committed)
+            forget_user(destination)
+            notify.publish(notify.user_channel(destination), 'message',
+                           mid=mid, source=source, subject=subject)
             flash("Message sent!", category="success")
         else:
             flash(error, category="danger")
 
 
-    # load some items from the DB to pass to the template
-    # get all messages addressed to the current user, newest first
-    dbcursor.execute(
-        'SELECT mid, source, firstname, lastname, email, content, date_sent, subject, unread'
-        ' FROM Messages JOIN Users ON Messages.source = Users.uid '
-        ' WHERE Messages.destination = (%s)'
-        ' ORDER BY date_sent DESC',
-        (session['uid'],)
-    )
-    messages = dbcursor.fetchall()
-
-    # and mark all messages as read, AFTER getting the unread ones
-    dbcursor.execute(
-        'UPDATE Messages SET unread=0'
-        ' WHERE destination=(%s)',
-        (session['uid'],)
-    )
-    # also, clear the notification
-    g.unreadmsgs = []
-
-    # get a list of users for addressing outgoing messages
-    dbcursor.execute(
-        'SELECT uid, firstname, lastname, email FROM Users WHERE uid <> %s'
-        ' ORDER BY lastname, firstname ASC', (g.user['uid'],)
-    )
-    users = dbcursor.fetchall()
-
-    return render_template('my/messages.html', messages=messages, users=users)
+    # a page of the messages addressed to the current user, newest
+    # first (straight off the (destination, date_sent, mid) index),
+    # read as the page is sent, and then marked as read;
+    # recipients are picked through /api/users, not listed here
+    return stream_page('my/messages.html', messages=load_inbox(session['uid']),
+                       newest=request.args.get('after') is None)
 
 @bp.route('/dashboard')
 @login_required
@@ -98,20 +165,27 @@ def dashboard():
     it just gets a few values out of the database
     and renders the dashboard template.
     """
-    # get a db connection
-    dbcursor = get_db().cursor()
-
     error = None
-    dbcursor = get_db().cursor()
-
-    dbcursor.execute(
-    #Will need to be changed to search by uid once db schema is updated
-    #Currently just grabs projects with owner as 1
-        'SELECT * FROM Involvements JOIN Projects ON Involvements.pid = Projects.pid '
-        'WHERE uid = (%s) ',
-        (session['uid'],)
-    )
-    userProjects = dbcursor.fetchall()
+
+    reads = [
+        # the user's projects
+        read(PROJECTS_QUERY, (session['uid'],)),
+        # the most recent announcements made on projects with which
+        # the current user is involved, from their feed (see ptrak.feed)
+        feed.latest(session['uid'], current_app.config['DASHBOARD_ANNOUNCEMENTS']),
+    ]
+    # previews for the messages tab: just who sent what, and only
+    # if there's anything unread (the count comes with g.user)
+    if g.unreadcount:
+        reads.append(read(
+            UNREAD_PREVIEWS_QUERY,
+            (session['uid'], current_app.config['UNREAD_PREVIEWS'],)
+        ))
+    # none of these depend on each other, so run them all at once
+    userProjects, announcements, *unreadmsgs = fetch_concurrently(*reads)
+    unreadmsgs = unreadmsgs[0] if unreadmsgs else []
+    attach(announcements, 'author')
+    attach(unreadmsgs, 'sender')
 
     # every user is expected to belong to at least one project
     # IDEA: maybe redirect to the pit page instead? Or nowhere at all?
@@ -120,18 +194,61 @@ def dashboard():
         flash(error, category='danger')
         return redirect(url_for('my.messages'))
 
-    # I don't...I don't really want to think too much about this one.
-    # This beastly query gets 5 of the most recent announcements
-    # made on projects with which the current user is involved.
-    # It took a surprising amount of thought to assemble.
-    dbcursor.execute(
-        'SELECT content, date_made, title, firstname, lastname, aid '
-        ' FROM Projects natural join Announcements JOIN Users ON author=uid'
-        ' WHERE pid IN'
-        ' (select pid from Users NATURAL JOIN Involvements where uid=(%s))'
-        ' ORDER BY date_made DESC LIMIT 5',
-        (session['uid'],)
-    )
-    announcements = dbcursor.fetchall()
+    return render_template('my/dashboard.html', userProjects=userProjects, announcements=announcements, unreadmsgs=unreadmsgs)
+
+@bp.route('/search')
+@login_required
+def search():
+    """
+    Search the tasks, notes and announcements of the user's projects
+    (see ptrak.search). ``?q=`` is what to look for; ``?kind=`` narrows
+    it to one kind of thing, ``?project=`` to one project, and
+    ``?page=`` picks the page of results.
+    """
+    q = request.args.get('q', '').strip()
+    kind = request.args.get('kind', '')
+    kinds = (kind,) if kind in fulltext.KINDS else fulltext.KINDS
+    page = request.args.get('page', 1, type=int)
+
+    # only ever the projects the user is involved in; asking for
+    # another one is an error (as in api.search), not a wider search
+    ranks = project_ranks()
+    project = request.args.get('project') or None
+    if project is not None:
+        project = int(project) if project.isdigit() else None
+        if project not in ranks:
+            return 'You aren\'t involved in that project.', 404
+    pids = [project] if project is not None else list(ranks)
+
+    results, more = [], False
+    if q:
+        results, more = fulltext.search(q, pids, kinds, page)
+
+    return render_template('my/search.html', q=q, kind=kind, project=project,
+                           page=page, results=results, more=more, kinds=fulltext.KINDS)
+
+
+@bp.route('/tagged')
+@login_required
+def tagged():
+    """
+    The tasks with a tag (``?tag=``) in all of the user's projects, most
+    recently updated first, a page at a time (``?after=``).
+    """
+    tag = (tags.parse(request.args.get('tag')) or [None])[0]
+    if tag is None:
+        return redirect(url_for('my.dashboard'))
 
-    return render_template('my/dashboard.html', userProjects=userProjects, announcements=announcements)
+    tasks, more = tags.tagged_tasks(get_db().cursor(), tag, list(project_ranks()),
+                                    after=request.args.get('after'))
+    return render_template('my/tagged.html', tag=tag, tasks=tasks, more=more)
+
+
+@bp.route('/events')
+@login_required
+def events():
+    """
+    The user's live notifications (see ptrak.notify), as Server-Sent
+    Events: a ``message`` event for each message sent to them.
+    """
+    return notify.stream(notify.user_channel(session['uid']))
@@ -0,0 +1,118 @@
+"""
+Task notes.
+
+A task's notes are a thread of comments (``Notes``), newest first. The
+board shows, on each task card, how many notes the task has and the
+latest one; those come from ``summaries()``, one query for a whole
+page of tasks (grouped off the ``Notes_task`` index), never one per
+card. The threads themselves are only read when someone asks for
+them, a page at a time (``task.notes``).
+
+Adding a note (``add_note()``) also touches the task's
+``date_updated``, so a task being discussed moves up the board, and
+bumps the project's version, so the board's cached fragments are
+rebuilt with the new count.
+"""
+from flask import current_app
+
+from ptrak.paging import fetch_page
+from ptrak.people import attach
+
+# one task's notes, with the author; paged on THREAD_SORT
+THREAD_QUERY = (
+    'SELECT nid, tid, content, date_added, uid, firstname, lastname'
+    ' FROM Notes JOIN Users ON Notes.author = Users.uid'
+    ' WHERE Notes.tid=(%s)'
+)
+THREAD_SORT = ('Notes.date_added', 'Notes.nid')
+
+
+def summaries_query(tids):
+    """
+    The query for ``summaries()``, and its arguments.
+
+    :return: (query, args)
+    """
+    # the latest note is the one with the highest nid, as notes are
+    # never back-dated
+    return (
+        'SELECT Notes.tid, counts.num, Notes.nid, Notes.content, Notes.date_added,'
+        ' uid, firstname, lastname'
+        ' FROM (SELECT tid, COUNT(*) AS num, MAX(nid) AS latest FROM Notes'
+        '       WHERE tid IN ({}) GROUP BY tid) AS counts'
+        ' JOIN Notes ON Notes.nid = counts.latest'
+        ' JOIN Users ON Notes.author = Users.uid'.format(', '.join(['%s'] * len(tids))),
+        tuple(tids)
+    )
+
+
+def summaries(dbcursor, tids):
+    """
+    Count the notes on some tasks and get the latest one of each (with
+    author info), in one query.
+
+    :param tids: the tasks, e.g. the ones on a page of the board
+    :return: dict mapping tid to (count, latest note); tasks without
+             notes are left out
+    """
+    if not tids:
+        return {}
+    dbcursor.execute(*summaries_query(tids))
+    rows = attach(dbcursor.fetchall(), 'author')
+    return {row['tid']: (row['num'], row) for row in rows}
+
+
+def attach_summaries(dbcursor, tasks):
+    """
+    Add ``notecount`` and ``latestnote`` (None if there are no notes)
+    to each task row.
+
+    :return: the tasks, for convenience
+    """
+    found = summaries(dbcursor, [task['tid'] for task in tasks])
+    for task in tasks:
+        task['notecount'], task['latestnote'] = found.get(task['tid'], (0, None))
+    return tasks
+
+
+def load_thread(dbcursor, tid, after=None, limit=None):
+    """
+    Get one page of a task's notes (with author info), newest first.
+
+    :param after: the page cursor (see ``ptrak.paging``)
+    :param limit: the page size (default: ``NOTE_PAGE_SIZE``)
+    :return: (notes, cursor for the next page or None)
+    """
+    if limit is None:
+        limit = current_app.config['NOTE_PAGE_SIZE']
+    notes, more = fetch_page(
+        dbcursor, THREAD_QUERY, (tid,),
+        sort=THREAD_SORT,
+        after=after,
+        limit=limit
+    )
+    return attach(notes, 'author'), more
+
+
+def add_note(dbcursor, tid, uid, content):
+    """
+    Add a note to a task, and mark the task as updated. Run it in a
+    transaction, and ``bump_project()`` in it too.
+
+    :return: the new note's nid
+    """
+    dbcursor.execute(
+        'INSERT INTO Notes (tid, content, author) VALUES (%s, %s, %s)',
+        (tid, content, uid)
+    )
+    nid = dbcursor.lastrowid
+    dbcursor.execute(
+        'UPDATE Tasks SET date_updated=CURRENT_TIMESTAMP WHERE tid=%s',
+        (tid,)
+    )
+    return nid
+
+
+def init_app(app):
+    app.config.setdefault('NOTE_PAGE_SIZE', 10)         # notes per page of a thread
+    app.config.setdefault('NOTE_MAX_LENGTH', 10000)     # characters per note
@@ -0,0 +1,390 @@
+"""
+Live notifications, pushed to browsers with Server-Sent Events.
+
+Instead of reloading a page to find out whether anything changed, a
+browser keeps one ``text/event-stream`` connection open (``my.events``
+for the user's own messages, ``project.events`` for a project's tasks
+and announcements) and is sent a small event whenever something
+happens. Views call ``publish()`` after their writes, with the channel
+the event belongs on (``user_channel()`` / ``project_channel()``).
+
+Events go through a *broker*, picked with ``NOTIFY_BROKER``:
+
+* ``'local'`` (the default) hands them straight to this process's hub,
+  so only the streams held by the same worker see them;
+* ``'redis'`` publishes them on a server speaking the Redis protocol
+  (the ``CACHE_REDIS_*`` settings), and each worker runs one listener
+  thread that feeds them to its hub, so every worker sees every event.
+
+The hub keeps, per open stream, a bounded queue and an event to wake
+it with, and per channel the set of streams listening; a publish only
+touches the streams on its channel. An idle stream wakes up every
+``NOTIFY_HEARTBEAT`` seconds to send a comment, which is how a closed
+connection is noticed. Each stream still occupies a worker thread,
+so to hold thousands of them per worker, run under an async worker
+(e.g. ``gunicorn -k gevent``).
+
+Each channel's last ``NOTIFY_BACKLOG`` events are kept, so a browser
+that reconnects (with ``Last-Event-ID``) is sent what it missed; if
+it missed too much, it gets a ``reset`` event and should reload.
+"""
+import collections
+import json
+import threading
+import time
+import uuid
+
+from flask import Response, current_app, request
+
+from ptrak.cache import RespConnection, RespError
+from ptrak.db import close_db
+
+# guards broker creation, like the caches
+_broker_lock = threading.Lock()
+
+
+def user_channel(uid):
+    return 'user:{}'.format(uid)
+
+
+def project_channel(pid):
+    return 'project:{}'.format(pid)
+
+
+class Subscription:
+    """
+    One open stream: its channels and the events waiting to be sent.
+    """
+    __slots__ = ('channels', 'events', 'ready', 'reset', 'closed')
+
+    def __init__(self, channels, size):
+        self.channels = tuple(channels)
+        self.events = collections.deque(maxlen=size)
+        self.ready = threading.Event()
+        # set when events were lost (a full queue, or too long away)
+        self.reset = False
+        # set by Hub.unsubscribe(), which may be called more than once
+        self.closed = False
+
+    def put(self, event):
+        if len(self.events) == self.events.maxlen:
+            self.reset = True
+        self.events.append(event)
+        self.ready.set()
+
+    def get(self, timeout):
+        """
+        Wait up to ``timeout`` seconds for events.
+
+        :return: the waiting events, oldest first (maybe none)
+        """
+        if not self.events:
+            self.ready.wait(timeout)
+        self.ready.clear()
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+        return events
+
+
+class Hub:
+    """
+    This process's subscriptions, by channel.
+
+    :param backlog: events kept per channel, for reconnecting streams
+    :param channels: channels to keep a backlog for (least recent dropped)
+    :param queue_size: events a stream can fall behind by before it's reset
+    :param max_subscribers: open streams allowed at once
+    """
+
+    def __init__(self, backlog=50, channels=1024, queue_size=100, max_subscribers=5000):
+        self.backlog = backlog
+        self.channels = channels
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self._subscribers = {}
+        self._recent = collections.OrderedDict()
+        self._count = 0
+        # orders the backlogs across channels
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._stats = dict(published=0, delivered=0, refused=0)
+
+    def subscribe(self, channels, last_id=None):
+        """
+        Start listening on ``channels``. If ``last_id`` is given, the
+        events after it are queued up first.
+
+        :return: a ``Subscription``, or None if there are too many
+        """
+        subscription = Subscription(channels, self.queue_size)
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                self._stats['refused'] += 1
+                return None
+            self._count += 1
+            for channel in subscription.channels:
+                self._subscribers.setdefault(channel, set()).add(subscription)
+            if last_id:
+                self._catch_up(subscription, last_id)
+        return subscription
+
+    def _catch_up(self, subscription, last_id):
+        # the id belongs to whichever of the channels sent the last
+        # event; what was missed is everything after it, on any of them
+        backlogs = [self._recent.get(channel, ()) for channel in subscription.channels]
+        last = next((event for recent in backlogs for event in recent
+                     if event[0] == last_id), None)
+        if last is None:
+            # too long ago; we don't know what they missed
+            if any(backlogs):
+                subscription.reset = True
+            return
+        missed = []
+        for recent in backlogs:
+            after = [event for event in recent if event[3] > last[3]]
+            # a full backlog that starts after it may have lost some
+            if after and after[0] is recent[0] and len(recent) == recent.maxlen:
+                subscription.reset = True
+            missed += after
+        for event in sorted(missed, key=lambda event: event[3]):
+            subscription.put(event[:3])
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription.closed:
+                return
+            subscription.closed = True
+            self._count -= 1
+            for channel in subscription.channels:
+                listeners = self._subscribers.get(channel)
+                if listeners is not None:
+                    listeners.discard(subscription)
+                    if not listeners:
+                        del self._subscribers[channel]
+
+    def dispatch(self, channel, event):
+        """
+        Queue ``event`` (an (id, type, data) tuple) for everything
+        listening on ``channel``.
+        """
+        with self._lock:
+            recent = self._recent.get(channel)
+            if recent is None:
+                recent = self._recent[channel] = collections.deque(maxlen=self.backlog)
+                while len(self._recent) > self.channels:
+                    self._recent.popitem(last=False)
+            else:
+                self._recent.move_to_end(channel)
+            self._sequence += 1
+            recent.append(tuple(event) + (self._sequence,))
+            listeners = list(self._subscribers.get(channel, ()))
+            self._stats['published'] += 1
+            self._stats['delivered'] += len(listeners)
+        for subscription in listeners:
+            subscription.put(event)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(subscribers=self._count, channels=len(self._subscribers))
+        return stats
+
+
+class LocalBroker:
+    """
+    Delivers events to this process's hub only.
+    """
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def publish(self, channel, event):
+        self.hub.dispatch(channel, event)
+
+    def subscribe(self, channels, last_id=None):
+        return self.hub.subscribe(channels, last_id)
+
+    def unsubscribe(self, subscription):
+        self.hub.unsubscribe(subscription)
+
+    def stats(self):
+        stats = self.hub.stats()
+        stats.update(broker='local')
+        return stats
+
+
+class RedisBroker(LocalBroker):
+    """
+    Delivers events to every worker's hub, through the Redis protocol's
+    PUBLISH / PSUBSCRIBE. The listener thread is started by the first
+    stream opened in a process (so never before a ``fork()``), and
+    reconnects on its own if the server goes away.
+
+    :param prefix: prepended to every channel, to share a server between apps
+    """
+
+    def __init__(self, hub, host='127.0.0.1', port=6379, prefix='ptrak:', timeout=0.5):
+        super().__init__(hub)
+        self.host = host
+        self.port = port
+        self.prefix = prefix + 'events:'
+        self.timeout = timeout
+        self._local = threading.local()
+        self._listener = None
+        self._lock = threading.Lock()
+        self.errors = 0
+
+    def publish(self, channel, event):
+        # a notification is never worth failing a request over
+        try:
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                conn = self._local.conn = RespConnection(self.host, self.port, self.timeout)
+            conn.command('PUBLISH', self.prefix + channel, json.dumps(event))
+        except (OSError, RespError):
+            conn = getattr(self._local, 'conn', None)
+            if conn is not None:
+                conn.close()
+                self._local.conn = None
+            with self._lock:
+                self.errors += 1
+
+    def subscribe(self, channels, last_id=None):
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self.listen, name='ptrak-notify',
+                                                  daemon=True)
+                self._listener.start()
+        return super().subscribe(channels, last_id)
+
+    def listen(self):
+        """
+        Feed everything published (by any worker) to our hub, forever.
+        """
+        while True:
+            conn = None
+            try:
+                conn = RespConnection(self.host, self.port, None)
+                conn.command('PSUBSCRIBE', self.prefix + '*')
+                while True:
+                    reply = conn.read_reply()
+                    if isinstance(reply, list) and len(reply) == 4 and reply[0] == b'pmessage':
+                        channel = reply[2].decode('utf-8')[len(self.prefix):]
+                        self.hub.dispatch(channel, tuple(json.loads(reply[3].decode('utf-8'))))
+            except (OSError, RespError, ValueError):
+                with self._lock:
+                    self.errors += 1
+            finally:
+                if conn is not None:
+                    conn.close()
+            time.sleep(1)
+
+    def stats(self):
+        stats = self.hub.stats()
+        with self._lock:
+            stats.update(broker='redis', host=self.host, port=self.port, errors=self.errors,
+                         listening=self._listener is not None and self._listener.is_alive())
+        return stats
+
+
+def make_broker(config):
+    hub = Hub(
+        backlog=config['NOTIFY_BACKLOG'],
+        queue_size=config['NOTIFY_QUEUE_SIZE'],
+        max_subscribers=config['NOTIFY_MAX_SUBSCRIBERS'],
+    )
+    backend = config['NOTIFY_BROKER']
+    if backend == 'redis':
+        return RedisBroker(
+            hub,
+            host=config['CACHE_REDIS_HOST'],
+            port=config['CACHE_REDIS_PORT'],
+            prefix=config['CACHE_REDIS_PREFIX'],
+        )
+    elif backend == 'local':
+        return LocalBroker(hub)
+    raise ValueError('unknown notification broker {!r}'.format(backend))
+
+
+def get_broker(app=None):
+    if app is None:
+        app = current_app._get_current_object()
+    broker = app.extensions.get('ptrak_notify')
+    if broker is None:
+        with _broker_lock:
+            broker = app.extensions.get('ptrak_notify')
+            if broker is None:
+                broker = make_broker(app.config)
+                app.extensions['ptrak_notify'] = broker
+    return broker
+
+
+def publish(channel, kind, **data):
+    """
+    Send an event to everything listening on ``channel``. Call it after
+    the write it announces has been committed. Keep ``data`` small
+    (ids and the like); it's sent to every listener as JSON.
+
+    :param kind: the event type, e.g. ``'message'``
+    """
+    if not current_app.config['NOTIFY_ENABLED']:
+        return
+    event = (uuid.uuid4().hex[:16], kind, json.dumps(data, default=str, separators=(',', ':')))
+    get_broker().publish(channel, event)
+
+
+def stream(*channels):
+    """
+    The ``text/event-stream`` response for a view: every event published
+    on ``channels`` from now on (and any missed since ``Last-Event-ID``),
+    for up to ``NOTIFY_MAX_AGE`` seconds, after which the browser
+    reconnects on its own.
+    """
+    config = current_app.config
+    broker = get_broker()
+    subscription = broker.subscribe(channels, request.headers.get('Last-Event-ID'))
+    if subscription is None:
+        return Response('Too many open streams.', 503, {'Retry-After': '30'})
+    heartbeat, retry = config['NOTIFY_HEARTBEAT'], config['NOTIFY_RETRY']
+    deadline = time.monotonic() + config['NOTIFY_MAX_AGE']
+    # the stream stays open long after the view returns; give the
+    # database connection back to the pool now, not at the end
+    close_db()
+
+    def generate():
+        # (the response's close also unsubscribes, for a client that
+        # goes away before this ever starts)
+        try:
+            yield 'retry: {}\n\n'.format(int(retry * 1000))
+            while time.monotonic() < deadline:
+                events = subscription.get(heartbeat)
+                if subscription.reset:
+                    subscription.reset = False
+                    yield 'event: reset\ndata: {}\n\n'
+                if not events:
+                    yield ': keepalive\n\n'
+                for event_id, kind, data in events:
+                    yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(event_id, kind, data)
+        finally:
+            broker.unsubscribe(subscription)
+
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # don't let nginx buffer the stream
+        'X-Accel-Buffering': 'no',
+    })
+    response.call_on_close(lambda: broker.unsubscribe(subscription))
+    return response
+
+
+def init_app(app):
+    app.config.setdefault('NOTIFY_ENABLED', True)
+    app.config.setdefault('NOTIFY_BROKER', 'local')         # or 'redis'
+    app.config.setdefault('NOTIFY_HEARTBEAT', 20)           # seconds between keepalives
+    app.config.setdefault('NOTIFY_RETRY', 5)                # seconds before a browser reconnects
+    app.config.setdefault('NOTIFY_MAX_AGE', 600)            # seconds a stream stays open
+    app.config.setdefault('NOTIFY_BACKLOG', 50)             # events kept per channel
+    app.config.setdefault('NOTIFY_QUEUE_SIZE', 100)         # events waiting per stream
+    app.config.setdefault('NOTIFY_MAX_SUBSCRIBERS', 5000)   # open streams per worker
@@ -0,0 +1,121 @@
+"""
+Keyset ("cursor") pagination.
+
+Instead of ``LIMIT n OFFSET k`` (which makes the database walk past
+``k`` rows every time), each page picks up where the last one stopped:
+a page is sorted newest-first on a (timestamp, id) pair, and the
+cursor for the next page is just the pair from the last row shown.
+With an index on the filter columns plus the sort columns, every page
+costs the same no matter how deep into the list it is.
+
+Cursors are opaque strings, safe to put in a URL.
+"""
+import base64
+import datetime
+import json
+
+
+def encode_cursor(row, keys):
+    """
+    Build the cursor that continues after ``row``.
+
+    :param row: the last row on the current page
+    :param keys: the row keys the page is sorted on, e.g. ``('date_updated', 'tid')``
+    :return: an URL-safe cursor string
+    """
+    values = []
+    for key in keys:
+        value = row[key]
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat(' ')
+        values.append(value)
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, size):
+    """
+    Turn a cursor back into its sort values.
+
+    :param cursor: a string from ``encode_cursor()`` (or junk from a URL)
+    :param size: the number of sort keys expected
+    :return: a list of values, or None if the cursor is missing or invalid
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw.decode('utf-8'))
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    # only what encode_cursor() makes; anything else would go to the driver
+    if not all(isinstance(value, (str, int, float)) for value in values):
+        return None
+    return values
+
+
+def sort_keys(sort):
+    """
+    :return: the row keys for the sort columns, e.g. ``('date_updated', 'tid')``
+    """
+    return tuple(name.rsplit('.', 1)[-1] for name in sort)
+
+
+def page_query(query, args, sort, after=None, limit=25):
+    """
+    Add the keyset condition, ordering and limit for one page to a
+    query (see ``fetch_page()``). One row more than ``limit`` is asked
+    for, to find out if there's another page.
+
+    :return: (query, args)
+    """
+    column, tiebreak = sort
+    args = tuple(args)
+
+    values = decode_cursor(after, 2)
+    if values is not None:
+        # spelled out rather than as a row comparison, which
+        # older MySQL versions won't use an index for
+        query += ' AND ({0} < %s OR ({0} = %s AND {1} < %s))'.format(column, tiebreak)
+        args += (values[0], values[0], values[1])
+
+    query += ' ORDER BY {0} DESC, {1} DESC LIMIT %s'.format(column, tiebreak)
+    return query, args + (limit + 1,)
+
+
+def fetch_page(dbcursor, query, args, sort, after=None, limit=25):
+    """
+    Fetch one page of rows, newest first.
+
+    ``query`` is a SELECT with a WHERE clause but no ORDER BY or LIMIT;
+    the keyset condition and ordering are added here. ``sort`` names
+    the two sort columns as they appear in SQL (e.g. ``Tasks.tid``);
+    the part after the dot must be how they come back in the row.
+
+    For example::
+
+        tasks, more = fetch_page(
+            dbcursor,
+            'SELECT tid, title, date_updated FROM Tasks WHERE pid=%s',
+            (pid,),
+            sort=('Tasks.date_updated', 'Tasks.tid'),
+            after=request.args.get('after'))
+
+    :param dbcursor: the cursor to run the query on
+    :param query: the SELECT ... WHERE ... to page through
+    :param args: the query's arguments
+    :param sort: (timestamp column, id column)
+    :param after: the cursor for this page (None for the first page)
+    :param limit: the page size
+    :return: (rows, cursor for the next page or None if this is the last)
+    """
+    keys = sort_keys(sort)
+    dbcursor.execute(*page_query(query, args, sort, after, limit))
+    rows = dbcursor.fetchall()
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1], keys)
+    return rows, None
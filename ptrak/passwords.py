@@ -0,0 +1,157 @@
+"""
+Password hashing, off the request threads.
+
+Hashing a password is slow on purpose, and it holds the GIL while it
+runs, so a burst of logins would otherwise stall every other request
+in the worker. Hashes are computed in a small pool of separate
+processes instead (``PASSWORD_WORKERS`` of them, per app process).
+
+The pool only takes ``PASSWORD_QUEUE`` more jobs than it has workers.
+Past that, ``PasswordBusy`` is raised straight away rather than letting
+requests pile up behind each other; the views turn it into a "try
+again" page with a 503.
+
+The method and cost come from ``PASSWORD_METHOD`` (any method string
+``werkzeug.security.generate_password_hash`` takes, e.g.
+``pbkdf2:sha256:600000`` or ``scrypt:32768:8:1``). When it changes,
+each user's stored hash is upgraded the next time they log in (see
+``needs_rehash()``).
+
+Set ``PASSWORD_WORKERS`` to 0 to hash inline (e.g., for tests).
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# guards pool creation, like the other per-app singletons
+_pool_lock = threading.Lock()
+
+
+class PasswordBusy(Exception):
+    """
+    Raised when the hashing pool is full (or too slow to answer, or
+    its processes keep dying).
+    """
+
+
+class HashPool:
+    """
+    A process pool that refuses work instead of queueing without limit.
+    If the pool breaks (a worker process died, or couldn't be started),
+    it's replaced with a new one.
+    """
+    def __init__(self, workers, queue, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._executor = self._start()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(workers + queue)
+
+    def _start(self):
+        # spawn rather than fork: forking a threaded web server is asking
+        # for trouble, and it's what Windows does anyway
+        return ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def _restart(self, broken):
+        with self._lock:
+            # another thread may have replaced it already
+            if self._executor is broken:
+                self._executor = self._start()
+        broken.shutdown(wait=False)
+
+    def run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordBusy()
+        future = None
+        try:
+            # a broken pool is replaced once; if the new one breaks
+            # too, something is wrong with starting them at all
+            for attempt in range(2):
+                executor = self._executor
+                try:
+                    future = executor.submit(function, *args)
+                    return future.result(self.timeout)
+                except BrokenProcessPool:
+                    future = None
+                    self._restart(executor)
+            raise PasswordBusy()
+        except TimeoutError:
+            raise PasswordBusy()
+        finally:
+            if future is None:
+                self._slots.release()
+            else:
+                # a job that timed out still holds its slot until it finishes
+                future.add_done_callback(lambda _: self._slots.release())
+
+
+def get_hash_pool(app=None):
+    """
+    Get the app's hashing pool, or None if hashing is done inline.
+    A forked child makes its own.
+    """
+    if app is None:
+        app = current_app._get_current_object()
+    if app.config['PASSWORD_WORKERS'] < 1:
+        return None
+    pool = app.extensions.get('ptrak_passwords')
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            pool = app.extensions.get('ptrak_passwords')
+            if pool is None or pool.pid != os.getpid():
+                pool = HashPool(app.config['PASSWORD_WORKERS'],
+                                app.config['PASSWORD_QUEUE'],
+                                app.config['PASSWORD_TIMEOUT'])
+                app.extensions['ptrak_passwords'] = pool
+    return pool
+
+
+def _run(function, *args):
+    pool = get_hash_pool()
+    if pool is None:
+        return function(*args)
+    return pool.run(function, *args)
+
+
+def hash_password(password):
+    """
+    :return: a hash of ``password`` with the configured method
+    :raises PasswordBusy: if the pool is full
+    """
+    config = current_app.config
+    return _run(generate_password_hash, password,
+                config['PASSWORD_METHOD'], config['PASSWORD_SALT_LENGTH'])
+
+
+def check_password(pwhash, password):
+    """
+    :return: whether ``password`` matches the stored ``pwhash``
+    :raises PasswordBusy: if the pool is full
+    """
+    return _run(check_password_hash, pwhash, password)
+
+
+def needs_rehash(pwhash):
+    """
+    Whether a stored hash was made with some other method or cost than
+    the configured one. A method without a cost (e.g. ``pbkdf2:sha256``)
+    accepts any cost.
+    """
+    method = current_app.config['PASSWORD_METHOD']
+    stored = pwhash.split('$', 1)[0]
+    return not (stored == method or stored.startswith(method + ':'))
+
+
+def init_app(app):
+    app.config.setdefault('PASSWORD_METHOD', 'pbkdf2:sha256:600000')
+    app.config.setdefault('PASSWORD_SALT_LENGTH', 16)
+    app.config.setdefault('PASSWORD_WORKERS', 2)    # processes, per app process
+    app.config.setdefault('PASSWORD_QUEUE', 8)      # jobs waiting, beyond those running
+    app.config.setdefault('PASSWORD_TIMEOUT', 10)   # seconds
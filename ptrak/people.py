@@ -0,0 +1,84 @@
+"""
+Decoded user names.
+
+Names and emails are stored mystified (see ``ptrak.db.mystify()``),
+so every time a page shows a name it has to be decoded. Rather than
+doing that in the templates, once per field per row, user columns are
+turned into a ``Person`` when rows come out of the database, and the
+decoded ``Person`` for each uid is remembered for the life of the
+process.
+
+A remembered ``Person`` is only reused while the row it came from
+still holds the same (encoded) values, so a changed name is picked up
+the next time the row is read. ``forget_person()`` drops one early.
+"""
+from collections import namedtuple
+
+from ptrak.cache import LRUCache
+from ptrak.db import demystify
+
+# uid -> (encoded firstname, lastname, email), Person
+_memo = LRUCache(maxsize=20000, ttl=24 * 3600)
+
+
+class Person(namedtuple('Person', 'uid firstname lastname email')):
+    """
+    A user's decoded name (and email, if it was selected).
+    """
+    __slots__ = ()
+
+    @property
+    def name(self):
+        return self.firstname + ' ' + self.lastname
+
+    def __str__(self):
+        return self.name
+
+
+def person(row, uid='uid'):
+    """
+    Get the ``Person`` for the user columns in ``row``.
+
+    :param row: a row with ``firstname``, ``lastname`` and optionally ``email``
+    :param uid: the key holding the user's uid (e.g. ``'source'``)
+    :return: a ``Person``
+    """
+    key = row[uid]
+    raw = (row['firstname'], row['lastname'], row.get('email'))
+    known = _memo.get(key)
+    if known is not None:
+        knownraw, found = known
+        # a row without the email can still use an entry with one
+        if knownraw[:2] == raw[:2] and raw[2] in (None, knownraw[2]):
+            return found
+
+    found = Person(
+        key,
+        demystify(raw[0]),
+        demystify(raw[1]),
+        demystify(raw[2]) if raw[2] is not None else None
+    )
+    _memo.set(key, (raw, found))
+    return found
+
+
+def attach(rows, key, uid='uid'):
+    """
+    Add a ``Person`` to each row, under ``row[key]``.
+
+    :return: the rows, for convenience
+    """
+    for row in rows:
+        row[key] = person(row, uid)
+    return rows
+
+
+def people(rows, uid='uid'):
+    """
+    :return: a list of ``Person`` for rows that are just users
+    """
+    return [person(row, uid) for row in rows]
+
+
+def forget_person(uid):
+    _memo.delete(uid)
@@ -0,0 +1,278 @@
+"""
+A small connection pool for ``ptrak.db``.
+
+Opening a MySQL connection costs a TCP handshake plus authentication,
+which is far more than most of our queries. The pool keeps a handful
+of connections open and hands them out to requests instead.
+
+A few things worth knowing:
+
+* ``size`` connections are kept around; up to ``max_overflow`` more
+  are opened under load and closed again as soon as they're returned.
+* connections older than ``recycle`` seconds are thrown away on checkout
+  (MySQL drops idle connections after ``wait_timeout`` anyway), and
+  ``pre_ping`` makes sure a connection is still alive before handing it out.
+* returned connections are rolled back, have their session state
+  cleared by ``reset`` (for MySQL: temporary tables, locks, user and
+  session variables, prepared statements) and are put back into
+  autocommit mode, so one request can't leak any of that into the next.
+  A connection that can't be reset is closed instead of being reused.
+* the pool remembers which process created it. After a ``fork()`` (e.g.,
+  gunicorn's pre-fork workers) the child throws away everything it
+  inherited *without* talking to the server, so it never shares a socket
+  with its parent.
+"""
+import collections
+import os
+import threading
+import time
+import weakref
+
+# every pool created in this process, so we can reset them after a fork
+_pools = weakref.WeakSet()
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection became available within ``timeout`` seconds.
+    """
+
+
+class ConnectionPool:
+    """
+    A thread-safe pool of database connections.
+
+    :param connect: callable that opens and returns a new connection
+    :param reset: callable that clears a returned connection's session
+                  state, or None to only roll it back
+    :param size: number of idle connections to keep open
+    :param max_overflow: number of extra connections allowed under load
+    :param timeout: seconds to wait for a free connection before giving up
+    :param recycle: maximum age (in seconds) of a connection; 0 disables
+    :param pre_ping: whether to ping connections on checkout
+    :param autocommit: the autocommit mode connections are reset to
+    """
+
+    def __init__(self, connect, reset=None, size=5, max_overflow=10, timeout=10,
+                 recycle=3600, pre_ping=True, autocommit=True):
+        self._connect = connect
+        self._reset_session = reset
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.pre_ping = pre_ping
+        self.autocommit = autocommit
+
+        self._cond = threading.Condition(threading.Lock())
+        self._reset_state()
+        _pools.add(self)
+
+    def _reset_state(self):
+        """
+        (Re)initialize the bookkeeping. Called on creation and after a fork.
+        """
+        self._pid = os.getpid()
+        # idle connections as (connection, time opened); used LIFO so
+        # the busiest connections stay warm and the rest can age out
+        self._idle = collections.deque()
+        self._born = {}
+        self._in_use = 0
+        self._stats = dict(
+            checkouts=0, waits=0, wait_time=0.0, timeouts=0,
+            opened=0, closed=0, recycled=0, ping_failures=0,
+        )
+
+    def _after_fork(self):
+        """
+        Drop everything inherited from the parent process.
+        The sockets are closed on our side only; sending COM_QUIT here
+        would hang up the parent's connections too.
+        """
+        for conn, _ in self._idle:
+            _close_quietly(conn, force=True)
+        self._cond = threading.Condition(threading.Lock())
+        self._reset_state()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._after_fork()
+
+    def checkout(self):
+        """
+        Get a connection from the pool, opening a new one if needed.
+
+        :return: a live connection
+        :raises PoolTimeout: if the pool is exhausted for ``timeout`` seconds
+        """
+        self._check_pid()
+        conn = None
+        started = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, born = self._idle.pop()
+                    break
+                if self._in_use < self.size + self.max_overflow:
+                    break
+                # everything is checked out; wait for someone to return one
+                now = time.monotonic()
+                if started is None:
+                    started = now
+                    self._stats['waits'] += 1
+                remaining = self.timeout - (now - started)
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    self._stats['wait_time'] += now - started
+                    raise PoolTimeout('no database connection available'
+                                      ' after {}s'.format(self.timeout))
+                self._cond.wait(remaining)
+
+            self._in_use += 1
+            self._stats['checkouts'] += 1
+            if started is not None:
+                self._stats['wait_time'] += time.monotonic() - started
+
+        # do the (slow) network work outside of the lock
+        try:
+            if conn is not None:
+                conn = self._validate(conn, born)
+            if conn is None:
+                conn = self._open()
+        except BaseException:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def checkin(self, conn, discard=False):
+        """
+        Return a connection to the pool.
+
+        :param conn: a connection previously handed out by ``checkout()``
+        :param discard: close the connection instead of keeping it
+        """
+        if self._pid != os.getpid():
+            # checked out before a fork; it isn't ours to keep
+            _close_quietly(conn, force=True)
+            return
+
+        if not discard:
+            try:
+                self._reset(conn)
+            except Exception:
+                discard = True
+
+        with self._cond:
+            self._in_use -= 1
+            born = self._born.get(id(conn))
+            keep = not discard and born is not None \
+                and len(self._idle) < self.size
+            if keep:
+                self._idle.append((conn, born))
+            else:
+                self._born.pop(id(conn), None)
+                self._stats['closed'] += 1
+            self._cond.notify()
+
+        if not keep:
+            _close_quietly(conn)
+
+    def _open(self):
+        conn = self._connect()
+        with self._cond:
+            self._born[id(conn)] = time.monotonic()
+            self._stats['opened'] += 1
+        return conn
+
+    def _validate(self, conn, born):
+        """
+        Make sure an idle connection is still worth using.
+
+        :return: the connection, or None if it had to be thrown away
+        """
+        if self.recycle and time.monotonic() - born > self.recycle:
+            self._discard(conn, 'recycled')
+            return None
+        if self.pre_ping:
+            try:
+                conn.ping(reconnect=False)
+            except Exception:
+                self._discard(conn, 'ping_failures')
+                return None
+        return conn
+
+    def _discard(self, conn, reason):
+        with self._cond:
+            self._born.pop(id(conn), None)
+            self._stats[reason] += 1
+            self._stats['closed'] += 1
+        _close_quietly(conn)
+
+    def _reset(self, conn):
+        """
+        Undo anything the last user of ``conn`` may have left behind.
+        Raises if it can't, and ``checkin()`` closes the connection.
+        """
+        conn.rollback()
+        if self._reset_session is not None:
+            self._reset_session(conn)
+        if conn.get_autocommit() != self.autocommit:
+            conn.autocommit(self.autocommit)
+
+    def stats(self):
+        """
+        Get a snapshot of the pool's counters, for sizing it.
+
+        :return: dict of pool statistics
+        """
+        self._check_pid()
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(
+                pid=self._pid,
+                size=self.size,
+                max_overflow=self.max_overflow,
+                in_use=self._in_use,
+                idle=len(self._idle),
+            )
+        stats['wait_time'] = round(stats['wait_time'], 6)
+        return stats
+
+    def dispose(self):
+        """
+        Close all idle connections. Checked-out ones are closed on return.
+        """
+        self._check_pid()
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            for conn, _ in idle:
+                self._born.pop(id(conn), None)
+            self._stats['closed'] += len(idle)
+        for conn, _ in idle:
+            _close_quietly(conn)
+
+
+def _close_quietly(conn, force=False):
+    """
+    Close a connection, ignoring errors (it's probably dead already).
+    ``force`` just closes our end of the socket without saying goodbye.
+    """
+    try:
+        if force and hasattr(conn, '_force_close'):
+            conn._force_close()
+        else:
+            conn.close()
+    except Exception:
+        pass
+
+
+def _reset_after_fork():
+    for pool in list(_pools):
+        pool._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -3,14 +3,168 @@ The ``project`` template.
 """
 
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, url_for
+    Blueprint, current_app, flash, g, jsonify, redirect, render_template,
+    request, session, url_for
 )
-from ptrak.db import get_db
+from ptrak.db import get_backend, get_db, transaction, read
+from ptrak import feed, membership, notes, notify, tags
 from ptrak.user import login_required
+from ptrak.access import involvement_required, forget_ranks, project_rank
+from ptrak.paging import fetch_page
+from ptrak.people import attach, people, person
+from ptrak.fragments import (
+    LazyFragments, bump_project, fragment_key, get_fragments, project_version,
+    store_fragment
+)
+from ptrak.streaming import Rows, stream_page
+import functools
 import time, datetime   #
 
 bp = Blueprint('project', __name__, url_prefix='/project')
 
+# the task statuses, in board order
+STATUSES = ('new', 'in progress', 'under review', 'complete')
+
+# the page's hot queries, EXPLAINed by ``flask check-queries``
+# the project, with its owner
+DETAILS_QUERY = (
+    'SELECT pid, uid, firstname, lastname, lastlogin, title, description, date_due'
+    ' FROM Projects JOIN Users ON owner=uid'
+    ' WHERE pid=(%s)'
+)
+# everyone involved, for the team card
+TEAM_QUERY = (
+    'SELECT Users.uid, firstname, lastname, `rank`'
+    ' FROM Involvements JOIN Users ON Involvements.uid=Users.uid'
+    ' WHERE pid=(%s)'
+)
+# the announcements, with their authors; paged on ANNOUNCEMENT_SORT
+ANNOUNCEMENTS_QUERY = (
+    'SELECT aid, uid, firstname, lastname, content, date_made, lastlogin'
+    ' FROM Announcements JOIN Users ON author=uid'
+    ' WHERE pid=(%s)'
+)
+ANNOUNCEMENT_SORT = ('Announcements.date_made', 'Announcements.aid')
+# the order a status tab pages in
+TASK_SORT = ('Tasks.date_updated', 'Tasks.tid')
+
+def tasktab_query(pid, status, tag=None):
+    """
+    The query for a status tab (before paging), and its arguments.
+
+    :return: (query, args)
+    """
+    query = 'SELECT tid, uid, firstname, lastname, title, status, date_submitted, date_due, date_updated, tags, description' \
+        ' FROM Tasks JOIN Users ON Tasks.creator=Users.uid' \
+        ' WHERE Tasks.pid=(%s) AND Tasks.status=(%s)'
+    args = (pid, status,)
+    if tag is not None:
+        condition, tagargs = tags.tagged(pid, tag)
+        query, args = query + ' AND ' + condition, args + tagargs
+    return query, args
+
+def status_counts_query(pid, tag=None):
+    """
+    The query for ``load_status_counts()``, and its arguments.
+
+    :return: (query, args)
+    """
+    query, args = 'SELECT status, COUNT(*) AS num FROM Tasks WHERE pid=(%s)', (pid,)
+    if tag is not None:
+        condition, tagargs = tags.tagged(pid, tag)
+        query, args = query + ' AND ' + condition, args + tagargs
+    return query + ' GROUP BY status', args
+
+def status_slug(status):
+    """
+    The tab id / query arg name for a status, e.g. 'inprogress'.
+    """
+    return status.replace(' ', '')
+
+def load_tasktab(dbcursor, pid, status, tag=None):
+    """
+    Get one page of tasks (with submitter info, and a summary of their
+    notes) for a status tab. Each tab pages on its own: the cursor for a tab comes from the
+    query arg named after it (e.g. ``?inprogress=...``), and its page
+    size from ``TASK_PAGE_SIZE``.
+
+    :param tag: only the tasks with this tag (see ``ptrak.tags``)
+    :return: dict with ``status``, ``slug``, ``tasks``, ``more``
+    """
+    slug = status_slug(status)
+    query, args = tasktab_query(pid, status, tag)
+    tasks, more = fetch_page(
+        dbcursor, query, args,
+        sort=TASK_SORT,
+        after=request.args.get(slug),
+        limit=current_app.config['TASK_PAGE_SIZE'][status]
+    )
+    for task in tasks:
+        task['paragraphs'] = paragraphs(task['description'])
+        task['taglist'] = tags.parse(task['tags'])
+    attach(tasks, 'creator')
+    # the note counts and latest notes for the whole page, in one query
+    notes.attach_summaries(dbcursor, tasks)
+    return dict(status=status, slug=slug, tasks=tasks, more=more)
+
+def paragraphs(text):
+    """
+    Split a description into its non-blank lines, once, so the
+    template doesn't have to.
+    """
+    if not text:
+        return []
+    return [line for line in text.replace('\r', '').split('\n') if line != '']
+
+def load_status_counts(dbcursor, pid, tag=None):
+    """
+    Count the project's tasks in each status, without loading them
+    (this is answered straight from the (pid, status, ...) index).
+
+    :param tag: only count the tasks with this tag
+    :return: dict mapping every status to its task count
+    """
+    dbcursor.execute(*status_counts_query(pid, tag))
+    counts = dict.fromkeys(STATUSES, 0)
+    counts.update((row['status'], row['num']) for row in dbcursor.fetchall())
+    return counts
+
+def taskboard_reads(pid, tag=None):
+    """
+    The reads for a whole task board (the counts, then one per status
+    tab), to be run with ``fetch_concurrently()`` and put together
+    with ``taskboard()``.
+
+    :param tag: only show the tasks with this tag
+    """
+    return [functools.partial(load_status_counts, pid=pid, tag=tag)] + \
+        [functools.partial(load_tasktab, pid=pid, status=status, tag=tag)
+         for status in STATUSES]
+
+def taskboard(counts, *tabs):
+    """
+    Put the results of ``taskboard_reads()`` together: the tabs,
+    in board order, each with its task count.
+    """
+    for tab in tabs:
+        tab['count'] = counts[tab['status']]
+    return list(tabs)
+
+def load_announcements(dbcursor, pid):
+    """
+    Get one page of announcements (with author info), newest first.
+    The cursor comes from the ``announcements`` query arg.
+
+    :return: (announcements, cursor for the next page or None)
+    """
+    announcements, more = fetch_page(
+        dbcursor, ANNOUNCEMENTS_QUERY, (pid,),
+        sort=ANNOUNCEMENT_SORT,
+        after=request.args.get('announcements'),
+        limit=current_app.config['ANNOUNCEMENT_PAGE_SIZE']
+    )
+    return attach(announcements, 'author'), more
+
 @bp.route('/')
 @login_required
 def index():
@@ -24,16 +178,17 @@ def index():
 
 @bp.route('/<int:pid>', methods=('GET', 'POST'))
 @login_required
+@involvement_required(message='You aren\'t assigned to that project.')
 def project(pid):
     """
     The main project view. This will show info,
     including tasks and announcements
     for the given pid.
     """
-    # get a cursor to the DB
-    dbcursor = get_db().cursor()
-
     if request.method == 'POST':
+        # get a cursor to the DB
+        dbcursor = get_db().cursor()
+
         statusupdate = request.form['status']
         taskupdate = request.form['taskid']
 
@@ -45,12 +200,16 @@ def project(pid):
             error = "No task id"
 
         if error is None:
-            dbcursor.execute(
+            updated = dbcursor.execute(
                 ' UPDATE Tasks'
                 ' SET status = (%s), date_updated = CURRENT_TIMESTAMP'
-                ' WHERE tid = (%s)',
-                (statusupdate, taskupdate,)
+                ' WHERE tid = (%s) AND pid = (%s)',
+                (statusupdate, taskupdate, pid,)
             )
+            bump_project(pid)
+            if updated:
+                notify.publish(notify.project_channel(pid), 'task',
+                               tid=int(taskupdate), status=statusupdate, by=session['uid'])
             flash('Task status updated.')
             return redirect(url_for('project.project', pid=pid))
 
@@ -60,68 +219,77 @@ def project(pid):
 
     else:
 
-        # get db data in several stages, resisting the urge
-        # to mash them all into one massive table
-        # note that not all information *has* to be used;
-        # it's just gathered in case it's needed
-        # first get the details for the project (with creator info)
-        num = dbcursor.execute(
-            'SELECT pid, uid, firstname, lastname, lastlogin, title, description, CAST(date_due AS char) AS date_due'
-            ' FROM Projects JOIN Users ON owner=uid'
-            ' WHERE pid=(%s)',
-            (pid,)
+        # ?tag= narrows the board down to the tasks with that tag
+        tag = (tags.parse(request.args.get('tag')) or [None])[0]
+
+        # most of the page is cached as rendered fragments, keyed on
+        # the project's version (and the page cursors, where they matter)
+        version = project_version(pid)
+        keys = dict(
+            details=fragment_key(pid, version, 'details'),
+            team=fragment_key(pid, version, 'team'),
+            announcements=fragment_key(pid, version, 'announcements',
+                                       request.args.get('announcements', '')),
+            tasks=fragment_key(pid, version, 'tasks', tag or '',
+                               *[request.args.get(status_slug(s), '') for s in STATUSES]),
+            tags=fragment_key(pid, version, 'tags'),
         )
-        thisproject = dbcursor.fetchone()
-
-        if thisproject is None:
-            flash('That project doesn\'t exist.', category='danger')
-            return redirect(url_for('my.dashboard'))
-
-        # involvement check: is the user actually assigned to this project?
-        # for bonus points, we're going to also get the other users involved
-        dbcursor.execute(
-            ' SELECT *'
-            ' FROM Involvements'
-            ' NATURAL JOIN Users'
-            ' NATURAL JOIN Projects'
-            ' WHERE pid=(%s)',
-            (pid,)
-        )
-
-        projectteam = dbcursor.fetchall()
-
-        # admittedly, these next parts are a little difficult to read
-        # first, see if any of the people involved has the current user's uid
-        if not any(user['uid'] == session['uid'] for user in projectteam) :
-            flash('You aren\'t assigned to that project.', category='danger')
-            return redirect(url_for('my.dashboard'))
-        else:
-            # don't ask about the syntax of this one. It uses a 'generator expression'
-            # to extract the row that matches the current user, then extracts
-            # his/her rank from that row. That's all I know.
-            g.rank = next(row for row in projectteam if row["uid"] == session['uid'])['rank']
-
-        # then get the announcements with author info
-        dbcursor.execute(
-            'SELECT aid, uid, firstname, lastname, content, CAST(date_made AS char) AS date_made, lastlogin'
-            ' FROM Announcements JOIN Users ON author=uid'
-            ' WHERE pid=(%s) ORDER BY date_made DESC',
-            (pid,)
-        )
-        announcements = dbcursor.fetchall()
+        fragments = get_fragments(keys)
+
+        # the details for the project (with creator info) are needed
+        # before anything else, for the title; they're small
+        if 'details' not in fragments:
+            details = read(DETAILS_QUERY, (pid,), one=True)(get_db().cursor())
+            if details is None:
+                flash('That project doesn\'t exist.', category='danger')
+                return redirect(url_for('my.dashboard'))
+            fragments['details'] = store_fragment(keys['details'], details)
 
-        # next get the task list and submitter info
-        dbcursor.execute(
-            'SELECT tid, uid, firstname, lastname, title, status, date_submitted, date_due, CAST(date_updated AS char) AS date_updated, tags, description'
-            ' FROM Tasks JOIN Users ON Tasks.creator=Users.uid'
-            ' WHERE Tasks.pid=(%s)'
-            ' ORDER BY Tasks.date_updated DESC',
-            (pid,)
+        # get db data for whatever else wasn't cached, in several stages,
+        # resisting the urge to mash them all into one massive table;
+        # none of them depend on each other, so they all run at the same
+        # time, once the top of the page has been sent
+        # note that not all information *has* to be used;
+        # it's just gathered in case it's needed
+        reads = dict(
+            # the involvement check was done by involvement_required();
+            # this gets the other users involved, for the team card
+            team=[read(TEAM_QUERY, (pid,))],
+            # the announcements with author info
+            announcements=[functools.partial(load_announcements, pid=pid)],
+            # and the task list and submitter info, a page per status
+            tasks=taskboard_reads(pid, tag),
+            # the project's most used tags, for the board's tag filter
+            tags=[tags.tag_counts(pid)],
         )
-        tasks = dbcursor.fetchall()
-
-        # and pass all of this data to the template
-        return render_template('project/project.html', announcements=announcements, tasks=tasks, thisproject=thisproject, projectteam=projectteam)
+        # render (and cache) a missing fragment
+        def render(name, data):
+            if name == 'team':
+                return render_template('project/_team.html', projectteam=people(data[0]))
+            elif name == 'announcements':
+                announcements, moreannouncements = data[0]
+                return render_template('project/_announcements.html', pid=pid,
+                                       announcements=announcements, moreannouncements=moreannouncements)
+            elif name == 'tags':
+                return render_template('project/_tags.html', pid=pid, tagcounts=data[0])
+            return render_template('project/_tasks.html', pid=pid, tag=tag, taskboard=taskboard(*data))
+
+        # and put the page together, sending the top of it straight away
+        return stream_page('project/project.html', thisproject=fragments['details'], tag=tag,
+                           fragments=LazyFragments(fragments, keys, reads, render))
+
+@bp.route('/<int:pid>/events')
+@login_required
+@involvement_required
+def events(pid):
+    """
+    The project's live notifications (see ptrak.notify), as Server-Sent
+    Events: ``task`` when a task is added or changes, and
+    ``announcement`` for new announcements. The user's own events
+    (see ``my.events``) come through here too, so a project page
+    needs only the one stream.
+    """
+    return notify.stream(notify.project_channel(pid), notify.user_channel(session['uid']))
 
 @bp.route('/new', methods=('GET', 'POST'))
 @login_required(level=3)
@@ -154,53 +322,51 @@ def new():
                 (owner, description, tsdue, name,)
             )
 
-            #Grab newest pid added to the Project table
-            dbcursor.execute(
-                'SELECT LAST_INSERT_ID() AS pid'
-            )
-            newpid = dbcursor.fetchone()
+            #Grab the pid the project was just given
+            newpid = dbcursor.lastrowid
 
             #Add the user and project to the Involvements TABLE, set creator to project rank 3
             dbcursor.execute(
-                'INSERT INTO Involvements (uid, pid, rank)'
+                'INSERT INTO Involvements (uid, pid, `rank`)'
                 ' VALUES (%s, %s, %s)',
-                (session['uid'], newpid['pid'], 3,)
+                (session['uid'], newpid, 3,)
             )
+            forget_ranks(session['uid'])
 
             # return the user to the newly-inserted project
-            return redirect(url_for('project.project', pid=newpid['pid']))
+            return redirect(url_for('project.project', pid=newpid))
 
     #return render_template('project/new.html')
     return render_template('project/new.html')
 
 @bp.route('/<int:pid>/newtask', methods=('GET', 'POST'))
 @login_required
+@involvement_required
 def newtask(pid):
     dbcursor = get_db().cursor()
-    # involvement check: is the user actually assigned to this project?
-    res = dbcursor.execute(
-        'SELECT * FROM Involvements WHERE pid=(%s) AND uid=(%s)',
-        (pid, session['uid'],)
-    )
-    if not res:
-        flash('You aren\'t involved in that project.', category='warning')
-        return redirect(url_for('my.dashboard'))
 
     if request.method == 'POST':
         title = request.form['title']
         date_due = request.form['date_due']
         description = request.form['description']
         status = request.form['status'] 
+        tasktags = tags.parse(request.form.get('tags'))
 
         error = None
         # TODO: add validation
         if error is None:
-            dbcursor.execute(
-                'INSERT INTO Tasks'
-                ' (title, date_due, description, status, pid, creator)'
-                ' VALUES (%s, %s, %s, %s, %s, %s)',
-                (title, date_due, description, status, pid, session['uid'],)
-            )
+            with transaction() as dbcursor:
+                dbcursor.execute(
+                    'INSERT INTO Tasks'
+                    ' (title, date_due, description, status, pid, creator)'
+                    ' VALUES (%s, %s, %s, %s, %s, %s)',
+                    (title, date_due, description, status, pid, session['uid'],)
+                )
+                tid = dbcursor.lastrowid
+                tags.set_tags(dbcursor, tid, pid, tasktags)
+                bump_project(pid, dbcursor)
+            notify.publish(notify.project_channel(pid), 'task',
+                           tid=tid, status=status, by=session['uid'])
             return redirect(url_for('project.project', pid=pid))
         flash(error, category='warning')
 
@@ -208,47 +374,39 @@ def newtask(pid):
 
 @bp.route('/<int:pid>/edit', methods=('GET', 'POST'))
 @login_required(level=3)
+# the user has to be at least project manager
+@involvement_required(rank=2, message='You don\'t have permission to edit that project.',
+                      fallback='project.project')
 def edit(pid):
     dbcursor = get_db().cursor()
-    # involvement check: is the user actually assigned to this project?
-    # and is (s)he at least project manager?
-    res = dbcursor.execute(
-        'SELECT * FROM Involvements WHERE pid=(%s) AND uid=(%s)'
-        ' AND rank > 1',
-        (pid, session['uid'],)
-    )
-    if not res:
-        flash('You don\'t have permission to edit that project.', category='warning')
-        return redirect(url_for('project.project', pid=pid))
 
 
     if request.method == 'POST':
         title = request.form['title']
         description = request.form['description']
         date_due = request.form['date_due']
-        toremove = request.form.getlist('toremove')
-        toadd = request.form.getlist('toadd')
-
-        # commit changes
-        dbcursor.execute(
-            'UPDATE Projects SET title=%s, description=%s, date_due=%s'
-            ' WHERE pid=%s',
-            (title, description, date_due, pid,)
-        )
-
-        # add new users (as rank 1!)
-        for uid in toadd:
-            dbcursor.execute(
-                'INSERT INTO Involvements (uid, pid, rank)'
-                ' VALUES (%s, %s, %s)',
-                (uid, pid, 1)
-            )
-        # remove old users
-        for uid in toremove:
+        try:
+            toremove = [(int(uid), pid) for uid in request.form.getlist('toremove')]
+            toadd = [(int(uid), pid, 1) for uid in request.form.getlist('toadd')]
+        except ValueError:
+            toremove = toadd = None
+        error = 'Invalid members.' if toadd is None else \
+            membership_error(pid, g.rank, add=toadd, remove=toremove)
+        if error is not None:
+            flash(error, category='danger')
+            return redirect(url_for('project.edit', pid=pid))
+
+        # commit changes, all at once
+        with transaction() as dbcursor:
             dbcursor.execute(
-                'DELETE FROM Involvements WHERE uid=%s AND pid=%s',
-                (uid, pid,)
+                'UPDATE Projects SET title=%s, description=%s, date_due=%s'
+                ' WHERE pid=%s',
+                (title, description, date_due, pid,)
             )
+            # add new users (as rank 1!) and remove old ones
+            changed = membership.apply_changes(dbcursor, add=toadd, remove=toremove)
+            bump_project(pid, dbcursor)
+        forget_ranks(*changed)
 
         return redirect(url_for('project.project', pid=pid))
 
@@ -258,47 +416,111 @@ def edit(pid):
     )
     thisproject = dbcursor.fetchone()
 
-    # get info for users currently involved in this project
-    dbcursor.execute(
-        'SELECT firstname, lastname, uid, email'
-        ' FROM Users NATURAL JOIN Involvements'
+    # info for users currently involved in this project, read as the
+    # page is sent (there can be a lot of them);
+    # users to add are looked up with api.users as they're typed
+    projectteam = Rows(
+        'SELECT firstname, lastname, Users.uid, email'
+        ' FROM Users JOIN Involvements ON Involvements.uid = Users.uid'
         ' WHERE pid=%s',
-        (pid,)
+        (pid,), each=person
     )
-    projectteam = dbcursor.fetchall()
 
-    # get info for users who aren't currently involved in this project
-    dbcursor.execute(
-        'SELECT firstname, lastname, uid, email'
-        ' FROM Users WHERE uid NOT IN'
-        ' (SELECT uid FROM Involvements WHERE pid=%s)',
-        (pid,)
-    )
-    otherusers = dbcursor.fetchall()
+    return stream_page('project/edit.html', thisproject=thisproject, projectteam=projectteam)
+
+def membership_error(pid, myrank, add=(), remove=(), rerank=()):
+    """
+    Check that a user of rank ``myrank`` may make these membership
+    changes: nobody can give out a rank above their own, or change
+    anyone whose rank is as high as theirs (themselves included).
+
+    :return: what's wrong, or None if they may
+    """
+    if any(rank > myrank for _, _, rank in rerank):
+        return 'You can\'t give out a rank above your own.'
+    touched = {uid for uid, _, _ in list(add) + list(rerank)} | {uid for uid, _ in remove}
+    if session['uid'] in touched:
+        return 'You can\'t change your own membership.'
+    if touched:
+        dbcursor = get_db().cursor()
+        dbcursor.execute(
+            'SELECT uid FROM Involvements WHERE pid=%s AND `rank` >= %s AND uid IN ({})'.format(
+                ', '.join(['%s'] * len(touched))),
+            [pid, myrank] + sorted(touched)
+        )
+        if dbcursor.fetchone() is not None:
+            return 'You can\'t change members ranked as high as you.'
+    return None
+
+@bp.route('/<int:pid>/members', methods=('POST',))
+@login_required
+def members(pid):
+    """
+    Change the project's team in one go, for scripts and big teams.
+    Takes a JSON body like::
+
+        {"add": [12, 13], "remove": [7], "rank": {"12": 3}}
 
-    return render_template('project/edit.html', thisproject=thisproject, projectteam=projectteam, otherusers=otherusers)
+    ``add`` users join as contributors; ``rank`` sets (or adds with)
+    a specific rank. Everything is applied in one transaction.
+
+    Needs the same as ``edit()`` (a rank of at least 2), but answers
+    with JSON errors instead of redirecting. See ``membership_error()``
+    for who can be changed.
+    """
+    myrank = project_rank(pid)
+    if g.user['level'] < 3 or myrank is None or myrank < 2:
+        return jsonify(error='You don\'t have permission to edit that project.'), 403
+    changes = request.get_json(silent=True)
+    if not isinstance(changes, dict):
+        return jsonify(error='Expected a JSON object.'), 400
+    try:
+        add = [(int(uid), pid, 1) for uid in changes.get('add', [])]
+        remove = [(int(uid), pid) for uid in changes.get('remove', [])]
+        rerank = [(int(uid), pid, int(rank)) for uid, rank in changes.get('rank', {}).items()]
+    except (TypeError, ValueError, AttributeError):
+        return jsonify(error='Invalid membership changes.'), 400
+    if any(rank not in membership.RANKS for _, _, rank in rerank):
+        return jsonify(error='Invalid membership changes.'), 400
+
+    error = membership_error(pid, myrank, add, remove, rerank)
+    if error is not None:
+        return jsonify(error=error), 403
+
+    try:
+        affected = membership.sync(add=add, remove=remove, rerank=rerank)
+    except ValueError:
+        return jsonify(error='Invalid membership changes.'), 400
+    except get_backend().integrity_errors:
+        # e.g. a uid that doesn't exist
+        return jsonify(error='No such user.'), 400
+    return jsonify(
+        added=len(changes.get('add', [])),
+        removed=len(changes.get('remove', [])),
+        reranked=len(changes.get('rank', {})),
+        affected=sorted(affected)
+    )
 
 @bp.route('/<int:pid>/announce', methods=('GET', 'POST'))
 @login_required(level=3)
+@involvement_required
 def announce(pid):
     dbcursor = get_db().cursor()
-    # involvement check: is the user actually assigned to this project?
-    res = dbcursor.execute(
-        'SELECT * FROM Involvements WHERE pid=(%s) AND uid=(%s)',
-        (pid, session['uid'],)
-    )
-    if not res:
-        flash('You aren\'t involved in that project.', category='warning')
-        return redirect(url_for('my.dashboard'))
 
     if request.method == 'POST':
         content = request.form['content']
 
-        dbcursor.execute(
-            'INSERT INTO Announcements (pid, author, content)'
-            ' VALUES (%s, %s, %s)',
-            (pid, session['uid'], content,)
-        )
+        # the announcement, and a copy in each member's feed
+        with transaction() as dbcursor:
+            dbcursor.execute(
+                'INSERT INTO Announcements (pid, author, content)'
+                ' VALUES (%s, %s, %s)',
+                (pid, session['uid'], content,)
+            )
+            aid = dbcursor.lastrowid
+            feed.fan_out(dbcursor, aid)
+            bump_project(pid, dbcursor)
+        notify.publish(notify.project_channel(pid), 'announcement', aid=aid, by=session['uid'])
 
         return redirect(url_for('project.project', pid=pid))
 
@@ -307,6 +529,9 @@ def announce(pid):
 # TODO fix this up. right now it's a copy of project.project
 @bp.route('/<int:pid>/settings', methods=('GET', 'POST'))
 @login_required(level=3)
+# make sure the user has the correct rank to edit this project
+@involvement_required(rank=3, message='You don\'t have permission to edit this project.',
+                      fallback='project.project')
 def settings(pid):
     if request.method == 'POST':
         return 'STUB: editing project settings {}'.format(pid)
@@ -324,58 +549,16 @@ def settings(pid):
             flash('That project doesn\'t exist.', category='danger')
             return redirect(url_for('my.dashboard'))
 
-        # involvement check: is the user actually assigned to this project?
-        dbcursor.execute(
-            ' SELECT *'
-            ' FROM Involvements'
-            ' WHERE Involvements.uid = (%s) AND Involvements.pid = (%s)'
-            ' ORDER BY Involvements.pid DESC',
-            (session['uid'], pid,)
-        )
-
-        projectscheck = dbcursor.fetchone()
-
-        # make sure the user has the correct rank to edit this project
-        if projectscheck is None or projectscheck['rank'] < 3:
-            flash('You don\'t have permission to edit this project.', category='warning')
-            return redirect(url_for('project.project', pid=pid))
-
-        # then get the announcements with author info
-        dbcursor.execute(
-            'SELECT aid, uid, firstname, lastname, content, CAST(date_made AS char) AS date_made, lastlogin'
-            ' FROM Announcements JOIN Users ON author=uid'
-            ' WHERE pid=(%s)',
-            (pid,)
-        )
-        announcements = dbcursor.fetchall()
-
-        # next get the task list and submitter info
-        dbcursor.execute(
-            'SELECT tid, uid, firstname, lastname, title, status, date_submitted, date_due, CAST(date_updated AS char) AS date_updated, tags, description'
-            ' FROM Tasks JOIN Users ON Tasks.creator=Users.uid'
-            ' WHERE Tasks.pid=(%s)'
-            ' ORDER BY Tasks.date_updated DESC',
-            (pid,)
-        )
-        tasks = dbcursor.fetchall()
-
-        # and pass all of this data to the template
-        return render_template('project/settings.html', announcements=announcements, tasks=tasks, thisproject=thisproject)
+        # the settings page only shows the project itself
+        return render_template('project/settings.html', thisproject=thisproject)
 
 @bp.route('/<int:pid>/leave', methods=('GET', 'POST'))
+@login_required
+@involvement_required
 def leave(pid):
     # as always, start with a cursor
     dbcursor = get_db().cursor()
 
-    # involvement check
-    res = dbcursor.execute(
-        'SELECT * FROM Involvements WHERE pid=(%s) AND uid=(%s)',
-        (pid, session['uid'],)
-    )
-    if not res:
-        flash('You aren\'t involved in that project.', category='warning')
-        return redirect(url_for('my.dashboard'))
-
     if request.method == 'POST':
         name1 = request.form['name1']
         name2 = request.form['name2']
@@ -389,11 +572,8 @@ def leave(pid):
             title = dbcursor.fetchone()['title']
             # now make sure they're the title for this project
             if name1 == title:
-                dbcursor.execute(
-                    'DELETE FROM Involvements '
-                    ' WHERE pid=%s AND uid=%s',
-                    (pid, session['uid'],)
-                )
+                # (this also clears the project out of their feed)
+                membership.sync(remove=[(session['uid'], pid)])
                 flash('Successfully left '+title+'.', category='success')
                 return redirect(url_for('my.dashboard'))
             flash('Failed to leave project.',category='warning')
@@ -1,7 +1,17 @@
--- Users->Messages->Projects->Announcements->Tasks->Notes
+-- The full schema, as of the latest migration in ptrak/migrate.py.
+-- This drops and recreates everything, so it's only for setting up a
+-- fresh (development) database. To create or upgrade a database that
+-- has data in it, run `flask migrate` instead.
+-- Keep this file in step with ptrak/migrate.py.
+
+-- Users->Messages->Projects->Involvements->Announcements->Tasks->Notes
+DROP TABLE IF EXISTS SchemaVersion;
+DROP TABLE IF EXISTS AnnouncementFeed;
+DROP TABLE IF EXISTS TaskTags;
 DROP TABLE IF EXISTS Notes;
 DROP TABLE IF EXISTS Tasks;
 DROP TABLE IF EXISTS Announcements;
+DROP TABLE IF EXISTS Involvements;
 DROP TABLE IF EXISTS Projects;
 DROP TABLE IF EXISTS Messages;
 DROP TABLE IF EXISTS Users;
@@ -15,8 +25,10 @@ CREATE TABLE Users (
   password VARCHAR(200) NOT NULL,
   projects TEXT,
   level INT DEFAULT 1,
-  lastlogin TIMESTAMP,
-  PRIMARY KEY (uid)
+  lastlogin TIMESTAMP NULL DEFAULT NULL,
+  unreadcount INT NOT NULL DEFAULT 0, -- kept in step with Messages.unread
+  PRIMARY KEY (uid),
+  INDEX Users_name (lastname, firstname)
 );
 
 -- table for project data
@@ -25,11 +37,24 @@ CREATE TABLE Projects (
   title VARCHAR(500) NOT NULL,
   owner INT NOT NULL,
   description TEXT NOT NULL,
-  date_due TIMESTAMP,   -- not a typo - this *can* be NULL
+  date_due TIMESTAMP NULL DEFAULT NULL,   -- not a typo - this *can* be NULL
+  version INT NOT NULL DEFAULT 0,         -- see ptrak/fragments.py
   PRIMARY KEY (pid),
   FOREIGN KEY (owner) REFERENCES Users (uid)
 );
 
+-- which users are on which projects, and their rank there
+-- (1 = contributor, 3 = manager)
+CREATE TABLE Involvements (
+  uid INT NOT NULL,
+  pid INT NOT NULL,
+  `rank` INT NOT NULL DEFAULT 1,
+  PRIMARY KEY (uid, pid),
+  INDEX Involvements_project (pid, uid),
+  FOREIGN KEY (uid) REFERENCES Users (uid),
+  FOREIGN KEY (pid) REFERENCES Projects (pid)
+);
+
 -- table for task data
 CREATE TABLE Tasks (
   tid INT AUTO_INCREMENT,
@@ -38,11 +63,14 @@ CREATE TABLE Tasks (
   status ENUM('new', 'in progress', 'under review', 'complete') NOT NULL DEFAULT 'new',
   title VARCHAR(250) NOT NULL,
   description TEXT,   -- not a typo
-  due_date TIMESTAMP, -- also not a typo
+  date_due TIMESTAMP NULL DEFAULT NULL, -- also not a typo
   date_submitted TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
   date_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
   tags TEXT,
   PRIMARY KEY (tid),
+  INDEX Tasks_board (pid, status, date_updated, tid),
+  INDEX Tasks_updated (pid, date_updated, tid),
+  FULLTEXT INDEX Tasks_search (title, description, tags),
   FOREIGN KEY (pid) REFERENCES Projects (pid),
   FOREIGN KEY (creator) REFERENCES Users (uid)
 );
@@ -56,6 +84,8 @@ CREATE TABLE Notes (
   author INT NOT NULL,
   date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
   PRIMARY KEY (nid),
+  INDEX Notes_task (tid, date_added, nid),
+  FULLTEXT INDEX Notes_search (content),
   FOREIGN KEY (tid) REFERENCES Tasks (tid),
   FOREIGN KEY (author) REFERENCES Users (uid)
 );
@@ -65,9 +95,13 @@ CREATE TABLE Messages (
   mid INT AUTO_INCREMENT,
   destination INT NOT NULL,
   source INT NOT NULL,
+  subject VARCHAR(250) NOT NULL DEFAULT '',
   content TEXT NOT NULL,
   date_sent TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  unread TINYINT(1) NOT NULL DEFAULT 1,
   PRIMARY KEY (mid),
+  INDEX Messages_inbox (destination, date_sent, mid),
+  INDEX Messages_unread (destination, unread, date_sent),
   FOREIGN KEY (source) REFERENCES Users (uid),
   FOREIGN KEY (destination) REFERENCES Users (uid)
 );
@@ -80,6 +114,51 @@ CREATE TABLE Announcements (
   date_made TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
   content TEXT NOT NULL,
   PRIMARY KEY (aid),
+  INDEX Announcements_feed (pid, date_made, aid),
+  FULLTEXT INDEX Announcements_search (content),
   FOREIGN KEY (pid) REFERENCES Projects (pid),
   FOREIGN KEY (author) REFERENCES Users (uid)
 );
+
+-- each user's announcement feed: a copy of every announcement made
+-- on their projects, kept up to date on write (see ptrak/feed.py)
+CREATE TABLE AnnouncementFeed (
+  uid INT NOT NULL,
+  date_made DATETIME NOT NULL,
+  aid INT NOT NULL,
+  pid INT NOT NULL,
+  PRIMARY KEY (uid, date_made, aid),
+  INDEX AnnouncementFeed_member (pid, uid),
+  FOREIGN KEY (uid) REFERENCES Users (uid),
+  FOREIGN KEY (aid) REFERENCES Announcements (aid),
+  FOREIGN KEY (pid) REFERENCES Projects (pid)
+);
+
+-- one row per tag per task, kept in step with Tasks.tags
+-- (see ptrak/tags.py)
+CREATE TABLE TaskTags (
+  pid INT NOT NULL,
+  tag VARCHAR(50) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+  tid INT NOT NULL,
+  PRIMARY KEY (pid, tag, tid),
+  INDEX TaskTags_task (tid),
+  FOREIGN KEY (pid) REFERENCES Projects (pid),
+  FOREIGN KEY (tid) REFERENCES Tasks (tid)
+);
+
+-- migrations already reflected above (see ptrak/migrate.py)
+CREATE TABLE SchemaVersion (
+  version INT NOT NULL,
+  description VARCHAR(200) NOT NULL,
+  applied TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (version)
+);
+INSERT INTO SchemaVersion (version, description) VALUES
+  (1, 'baseline schema'),
+  (2, 'bring schema in line with the code'),
+  (3, 'hot-path indexes'),
+  (4, 'announcement feeds'),
+  (5, 'full-text search'),
+  (6, 'task tags'),
+  (7, 'project versions'),
+  (8, 'binary task tags');
@@ -0,0 +1,111 @@
+-- The schema.sql schema for SQLite (DB_BACKEND = 'sqlite'), as of
+-- migration 4 (migrate.SQLITE_BASELINE). `flask migrate` runs this on
+-- a fresh SQLite database, then any migrations after it.
+-- Keep this file in step with schema.sql.
+
+DROP TABLE IF EXISTS SchemaVersion;
+DROP TABLE IF EXISTS AnnouncementFeed;
+DROP TABLE IF EXISTS Notes;
+DROP TABLE IF EXISTS Tasks;
+DROP TABLE IF EXISTS Announcements;
+DROP TABLE IF EXISTS Involvements;
+DROP TABLE IF EXISTS Projects;
+DROP TABLE IF EXISTS Messages;
+DROP TABLE IF EXISTS Users;
+
+-- INTEGER PRIMARY KEY is SQLite's AUTO_INCREMENT (the rowid)
+CREATE TABLE Users (
+  uid INTEGER PRIMARY KEY,
+  firstname VARCHAR(50) NOT NULL,
+  lastname VARCHAR(50) NOT NULL,
+  email VARCHAR(50) UNIQUE NOT NULL,
+  password VARCHAR(200) NOT NULL,
+  projects TEXT,
+  level INT DEFAULT 1,
+  lastlogin TIMESTAMP NULL DEFAULT NULL,
+  unreadcount INT NOT NULL DEFAULT 0
+);
+CREATE INDEX Users_name ON Users (lastname, firstname);
+
+CREATE TABLE Projects (
+  pid INTEGER PRIMARY KEY,
+  title VARCHAR(500) NOT NULL,
+  owner INT NOT NULL REFERENCES Users (uid),
+  description TEXT NOT NULL,
+  date_due TIMESTAMP NULL DEFAULT NULL
+);
+
+-- WITHOUT ROWID: stored in primary key order, like an InnoDB table
+CREATE TABLE Involvements (
+  uid INT NOT NULL REFERENCES Users (uid),
+  pid INT NOT NULL REFERENCES Projects (pid),
+  `rank` INT NOT NULL DEFAULT 1,
+  PRIMARY KEY (uid, pid)
+) WITHOUT ROWID;
+CREATE INDEX Involvements_project ON Involvements (pid, uid);
+
+CREATE TABLE Tasks (
+  tid INTEGER PRIMARY KEY,
+  pid INT NOT NULL REFERENCES Projects (pid),
+  creator INT NOT NULL REFERENCES Users (uid),
+  status VARCHAR(20) NOT NULL DEFAULT 'new'
+    CHECK (status IN ('new', 'in progress', 'under review', 'complete')),
+  title VARCHAR(250) NOT NULL,
+  description TEXT,
+  date_due TIMESTAMP NULL DEFAULT NULL,
+  date_submitted TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  date_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  tags TEXT
+);
+CREATE INDEX Tasks_board ON Tasks (pid, status, date_updated, tid);
+CREATE INDEX Tasks_updated ON Tasks (pid, date_updated, tid);
+
+CREATE TABLE Notes (
+  nid INTEGER PRIMARY KEY,
+  tid INT NOT NULL REFERENCES Tasks (tid),
+  content TEXT NOT NULL,
+  author INT NOT NULL REFERENCES Users (uid),
+  date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX Notes_task ON Notes (tid, date_added, nid);
+
+CREATE TABLE Messages (
+  mid INTEGER PRIMARY KEY,
+  destination INT NOT NULL REFERENCES Users (uid),
+  source INT NOT NULL REFERENCES Users (uid),
+  subject VARCHAR(250) NOT NULL DEFAULT '',
+  content TEXT NOT NULL,
+  date_sent TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  unread TINYINT(1) NOT NULL DEFAULT 1
+);
+CREATE INDEX Messages_inbox ON Messages (destination, date_sent, mid);
+CREATE INDEX Messages_unread ON Messages (destination, unread, date_sent);
+
+CREATE TABLE Announcements (
+  aid INTEGER PRIMARY KEY,
+  pid INT NOT NULL REFERENCES Projects (pid),
+  author INT NOT NULL REFERENCES Users (uid),
+  date_made TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  content TEXT NOT NULL
+);
+CREATE INDEX Announcements_feed ON Announcements (pid, date_made, aid);
+
+CREATE TABLE AnnouncementFeed (
+  uid INT NOT NULL REFERENCES Users (uid),
+  date_made DATETIME NOT NULL,
+  aid INT NOT NULL REFERENCES Announcements (aid),
+  pid INT NOT NULL REFERENCES Projects (pid),
+  PRIMARY KEY (uid, date_made, aid)
+) WITHOUT ROWID;
+CREATE INDEX AnnouncementFeed_member ON AnnouncementFeed (pid, uid);
+
+CREATE TABLE SchemaVersion (
+  version INT NOT NULL PRIMARY KEY,
+  description VARCHAR(200) NOT NULL,
+  applied TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+INSERT INTO SchemaVersion (version, description) VALUES
+  (1, 'baseline schema'),
+  (2, 'bring schema in line with the code'),
+  (3, 'hot-path indexes'),
+  (4, 'announcement feeds');
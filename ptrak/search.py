@@ -0,0 +1,130 @@
+"""
+Full-text search over tasks, notes and announcements.
+
+Each kind of thing has a full-text index (migration 5): a FULLTEXT
+index on MySQL, an FTS5 table on SQLite (see ``ptrak.storage``). Both
+are kept up to date by the database on every insert, update and
+delete, so nothing here has to remember to reindex.
+
+A search is split into words, each of which has to appear (as a word
+or the start of one). Each kind is searched separately, in parallel,
+for its best matches in the given projects, and the lists are merged
+by relevance. Pages are numbered; only the first ``SEARCH_MAX_PAGES``
+can be asked for, which keeps every query bounded however common the
+words are.
+"""
+import re
+
+from flask import current_app
+
+from ptrak.db import fetch_concurrently, get_backend, read
+
+KINDS = ('task', 'note', 'announcement')
+
+# kind -> (table, index, indexed columns, key, query); the query gets
+# the backend's join, condition and score, and the projects to look in
+SOURCES = dict(
+    task=('Tasks', 'Tasks_search', ('title', 'description', 'tags'), 'tid',
+          'SELECT Tasks.tid AS id, Tasks.tid, Tasks.pid, Projects.title AS project,'
+          ' Tasks.title, Tasks.description AS body, Tasks.date_updated AS date,'
+          ' {score} AS score'
+          ' FROM Tasks{join} JOIN Projects ON Projects.pid = Tasks.pid'
+          ' WHERE {condition} AND Tasks.pid IN ({pids})'
+          ' ORDER BY score DESC, Tasks.tid DESC LIMIT %s'),
+    note=('Notes', 'Notes_search', ('content',), 'nid',
+          'SELECT Notes.nid AS id, Tasks.tid, Tasks.pid, Projects.title AS project,'
+          ' Tasks.title, Notes.content AS body, Notes.date_added AS date,'
+          ' {score} AS score'
+          ' FROM Notes{join} JOIN Tasks ON Tasks.tid = Notes.tid'
+          ' JOIN Projects ON Projects.pid = Tasks.pid'
+          ' WHERE {condition} AND Tasks.pid IN ({pids})'
+          ' ORDER BY score DESC, Notes.nid DESC LIMIT %s'),
+    announcement=('Announcements', 'Announcements_search', ('content',), 'aid',
+                  'SELECT Announcements.aid AS id, NULL AS tid, Announcements.pid,'
+                  ' Projects.title AS project, Projects.title,'
+                  ' Announcements.content AS body, Announcements.date_made AS date,'
+                  ' {score} AS score'
+                  ' FROM Announcements{join} JOIN Projects ON Projects.pid = Announcements.pid'
+                  ' WHERE {condition} AND Announcements.pid IN ({pids})'
+                  ' ORDER BY score DESC, Announcements.aid DESC LIMIT %s'),
+)
+
+_words = re.compile(r'\w+', re.UNICODE)
+
+
+def words(query):
+    """
+    :return: the words to search for, lowercased, at most ``SEARCH_MAX_TERMS``
+    """
+    found = []
+    for word in _words.findall(query.lower()):
+        if word not in found:
+            found.append(word)
+    return found[:current_app.config['SEARCH_MAX_TERMS']]
+
+
+def excerpt(text, length=200):
+    text = ' '.join((text or '').split())
+    if len(text) <= length:
+        return text
+    return text[:length].rsplit(' ', 1)[0] + '...'
+
+
+def search_read(kind, terms, pids, limit):
+    """
+    A ``read()`` for the best ``limit`` matches of one kind.
+    """
+    table, name, columns, key, query = SOURCES[kind]
+    fulltext = get_backend().match(table, name, columns, key)
+    sql = query.format(join=fulltext.join, condition=fulltext.condition,
+                       score=fulltext.score, pids=', '.join(['%s'] * len(pids)))
+    args = [terms] * fulltext.score_params + [terms] + list(pids) + [limit]
+    return read(sql, args)
+
+
+def search(query, pids, kinds=KINDS, page=1):
+    """
+    Search the given projects.
+
+    :param query: what the user typed
+    :param pids: the projects to look in (the ones they're involved in)
+    :param kinds: which of ``KINDS`` to look for
+    :param page: which page of results, from 1
+    :return: (the page of results, whether there are more); each result
+             is a dict with its ``kind``, ``id``, ``tid`` (None for
+             announcements), ``pid``, ``project``, ``title``,
+             ``excerpt``, ``date`` and ``score``
+    """
+    config = current_app.config
+    found = words(query)
+    pids = sorted(pids)
+    page = max(1, min(page, config['SEARCH_MAX_PAGES']))
+    if not found or not pids or not kinds:
+        return [], False
+
+    size = config['SEARCH_PAGE_SIZE']
+    # the top page * size of everything is among the top page * size of
+    # each kind; one more tells us whether there's another page
+    limit = page * size + 1
+    terms = get_backend().search_terms(found)
+    lists = fetch_concurrently(*[search_read(kind, terms, pids, limit) for kind in kinds])
+
+    results = []
+    for kind, rows in zip(kinds, lists):
+        for row in rows:
+            results.append(dict(
+                kind=kind, id=row['id'], tid=row['tid'], pid=row['pid'],
+                project=row['project'], title=row['title'],
+                excerpt=excerpt(row['body']), date=row['date'],
+                score=round(float(row['score']), 4),
+            ))
+    results.sort(key=lambda result: result['score'], reverse=True)
+    start = (page - 1) * size
+    more = len(results) > page * size and page < config['SEARCH_MAX_PAGES']
+    return results[start:start + size], more
+
+
+def init_app(app):
+    app.config.setdefault('SEARCH_PAGE_SIZE', 20)
+    app.config.setdefault('SEARCH_MAX_PAGES', 10)   # deeper than this isn't offered
+    app.config.setdefault('SEARCH_MAX_TERMS', 8)    # words per search
@@ -0,0 +1,17 @@
+// Note threads are loaded a page at a time from task.notes (see
+// ptrak/notes.py): a `.load-notes` button is replaced by the page of
+// notes at its data-url, which ends with a button for the next page,
+// if there is one. On the board, the button and the latest note it
+// sits with (a `[data-notes]` element) are replaced together.
+document.addEventListener('click', function (e) {
+  var button = e.target.closest('.load-notes');
+  if (!button) {
+    return;
+  }
+  button.disabled = true;
+  fetch(button.dataset.url, {credentials: 'same-origin'})
+    .then(function (response) { return response.text(); })
+    .then(function (html) {
+      (button.closest('[data-notes]') || button).outerHTML = html;
+    });
+});
@@ -0,0 +1,32 @@
+// Typeahead for people pickers: as the user types into `input`, fill
+// `select` with the matching users from /api/users (see
+// ptrak/directory.py), keeping any already picked in a multiple select.
+// `extra` is added to the query string, e.g. '&exclude_project=3'.
+function userPicker(input, select, extra) {
+  var timer = null;
+  function lookup() {
+    var url = input.dataset.url + '?q=' + encodeURIComponent(input.value) + (extra || '');
+    fetch(url, {credentials: 'same-origin'})
+      .then(function (response) { return response.json(); })
+      .then(function (data) {
+        var kept = {};
+        Array.prototype.slice.call(select.options).forEach(function (option) {
+          if (select.multiple && option.selected) {
+            kept[option.value] = true;
+          } else {
+            option.remove();
+          }
+        });
+        data.items.forEach(function (user) {
+          if (!kept[user.uid]) {
+            select.add(new Option(user.name + ' (' + user.email + ')', user.uid));
+          }
+        });
+      });
+  }
+  input.addEventListener('input', function () {
+    clearTimeout(timer);
+    timer = setTimeout(lookup, 150);
+  });
+  lookup();
+}
@@ -0,0 +1,509 @@
+"""
+Storage backends: MySQL (the default) and SQLite.
+
+Everything goes through ``ptrak.db``, which asks the backend picked by
+``DB_BACKEND`` for connections. Both kinds of connection look like
+pymysql's: ``cursor()`` gives a cursor whose rows are dicts,
+``execute()`` takes ``%s`` placeholders and returns the row count, and
+``begin()`` / ``commit()`` / ``rollback()`` work as usual. So the views
+can be written once, in the SQL both databases understand.
+
+What they don't share is kept here, behind a few methods:
+
+- ``upsert()`` for "insert, or update on a duplicate key";
+- ``tables()`` / ``columns()`` / ``indexes()`` for the migrations;
+- ``full_scans()`` for ``flask check-queries``;
+- ``add_full_text_index()`` / ``match()`` / ``search_terms()`` for
+  full-text search (a FULLTEXT index on MySQL, an FTS5 table kept up
+  to date by triggers on SQLite).
+
+SQLite also gets ``INSERT IGNORE`` rewritten to ``INSERT OR IGNORE``
+and a ``UNIX_TIMESTAMP()`` function, so that they can be used anywhere.
+Its cursors convert arguments and timestamps the way pymysql does,
+themselves: nothing is registered with the ``sqlite3`` module, so other
+users of it in the process are left alone.  Since ``sqlite3`` only
+hands out declared column types to registered converters, a timestamp
+is recognised by the form it is stored in (``YYYY-MM-DD HH:MM:SS``,
+with optional microseconds), whatever the column is called.
+
+The SQLite backend is meant for small single-server installs, CI and
+tests: the database is a file (``SQLITE_PATH``, or ``:memory:``) in WAL
+mode, so readers never wait for the writer, and the ``SQLITE_PRAGMAS``
+tune it for a web app's mix of many small reads and few writes.
+"""
+import calendar
+import collections
+import datetime
+import functools
+import re
+import sqlite3
+import uuid
+
+import pymysql
+
+# not in pymysql.constants.COMMAND; needs MySQL 5.7.3+ or MariaDB 10.2.4+
+COM_RESET_CONNECTION = 0x1f
+
+# how to search a full-text index: JOIN it in with ``join``, filter by
+# ``condition`` (one %s: the search_terms()), and rank by ``score``
+# (higher is better; takes the search terms ``score_params`` times)
+FullText = collections.namedtuple('FullText', 'join condition score score_params')
+
+
+class MySQLBackend:
+    name = 'mysql'
+    errors = (pymysql.MySQLError,)
+    # a key or constraint was violated (e.g. a uid that doesn't exist)
+    integrity_errors = (pymysql.IntegrityError,)
+    cursorclass = pymysql.cursors.DictCursor
+    # unbuffered: rows come off the server as they're fetched
+    streamcursorclass = pymysql.cursors.SSDictCursor
+
+    def __init__(self, config):
+        self.config = config
+
+    def connect(self):
+        config = self.config
+        # autocommit makes sure that each insert/update takes immediate effect
+        return pymysql.connect(
+            host=config['MYSQL_HOST'],
+            port=config['MYSQL_PORT'],
+            user=config['MYSQL_USER'],
+            password=config['MYSQL_PASS'],
+            db=config['MYSQL_DB'],
+            cursorclass=config['DB_CURSORCLASS'] or self.cursorclass,
+            autocommit=True
+        )
+
+    def reset(self, conn):
+        """
+        Clear the session state a pooled connection's last user left
+        behind, with COM_RESET_CONNECTION: it rolls back, drops
+        temporary tables, releases locks (``GET_LOCK()`` and ``LOCK
+        TABLES``), forgets user variables and prepared statements, and
+        sets session variables back to their global values. That
+        includes the character set, so ours is set again afterwards.
+
+        Raises if the server can't (e.g. it's too old), in which case
+        the pool closes the connection rather than reuse it.
+        """
+        conn._execute_command(COM_RESET_CONNECTION, b'')
+        conn._read_ok_packet()
+        conn.set_character_set(conn.charset, conn.collation)
+
+    def upsert(self, table, columns, key, update=()):
+        """
+        An INSERT (one row of ``%s`` placeholders) that updates the
+        ``update`` columns instead when a row with the same ``key``
+        exists, or leaves it alone if there are none.
+        """
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            table, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+        if update:
+            return sql + ' ON DUPLICATE KEY UPDATE ' + ', '.join(
+                '{0}=VALUES({0})'.format(column) for column in update)
+        # not INSERT IGNORE, which would also hide e.g. foreign key errors
+        return sql + ' ON DUPLICATE KEY UPDATE {0}={0}'.format(key[0])
+
+    def tables(self, dbcursor):
+        dbcursor.execute(
+            'SELECT TABLE_NAME FROM information_schema.TABLES'
+            ' WHERE TABLE_SCHEMA = DATABASE()'
+        )
+        return {row['TABLE_NAME'] for row in dbcursor.fetchall()}
+
+    def columns(self, dbcursor, table):
+        dbcursor.execute(
+            'SELECT COLUMN_NAME FROM information_schema.COLUMNS'
+            ' WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s',
+            (table,)
+        )
+        return {row['COLUMN_NAME'].lower() for row in dbcursor.fetchall()}
+
+    def indexes(self, dbcursor, table):
+        """
+        :return: dict mapping index name to its (lowercase) columns, in order
+        """
+        dbcursor.execute(
+            'SELECT INDEX_NAME, COLUMN_NAME FROM information_schema.STATISTICS'
+            ' WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s'
+            ' ORDER BY INDEX_NAME, SEQ_IN_INDEX',
+            (table,)
+        )
+        indexes = {}
+        for row in dbcursor.fetchall():
+            indexes.setdefault(row['INDEX_NAME'], []).append(row['COLUMN_NAME'].lower())
+        return indexes
+
+    def full_scans(self, dbcursor, query, args):
+        """
+        :return: the tables the query would read in full
+        """
+        dbcursor.execute('EXPLAIN ' + query, args)
+        scans = []
+        for row in dbcursor.fetchall():
+            table = row.get('table') or ''
+            # reading back a (small, LIMITed) derived table, e.g. <derived2>,
+            # is fine; it's the base tables we care about
+            if row.get('type') == 'ALL' and not table.startswith('<'):
+                scans.append(table)
+        return scans
+
+    def add_full_text_index(self, dbcursor, table, name, columns, key):
+        """
+        Index ``columns`` of ``table`` for ``match()``. The database keeps
+        it up to date as rows are inserted, updated and deleted.
+        """
+        if name not in self.indexes(dbcursor, table):
+            dbcursor.execute('CREATE FULLTEXT INDEX {} ON {} ({})'.format(
+                name, table, ', '.join(columns)))
+
+    def match(self, table, name, columns, key):
+        against = 'MATCH ({}) AGAINST (%s IN BOOLEAN MODE)'.format(
+            ', '.join('{}.{}'.format(table, column) for column in columns))
+        return FullText('', against, against, 1)
+
+    def search_terms(self, words):
+        # every word has to be there, as a prefix
+        return ' '.join('+{}*'.format(word) for word in words)
+
+
+# --- SQLite ----------------------------------------------------------------
+
+_placeholders = re.compile(r'%%|%s|%\((\w+)\)s')
+_insert_ignore = re.compile(r'^\s*INSERT\s+IGNORE\b', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def translate(query, placeholders=True):
+    """
+    Turn our (pymysql-flavoured) SQL into SQLite's.
+    Like pymysql, ``%`` is only special when there are arguments.
+    """
+    if placeholders:
+        query = _placeholders.sub(
+            lambda m: '%' if m.group(0) == '%%' else ':' + m.group(1) if m.group(1) else '?',
+            query)
+    return _insert_ignore.sub('INSERT OR IGNORE', query)
+
+
+_TIMESTAMP = re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?:\.\d{6})?\Z')
+
+
+def _to_datetime(value):
+    """
+    Read back a stored timestamp as a datetime, as pymysql would give it.
+    """
+    if isinstance(value, str) and len(value) in (19, 26) and _TIMESTAMP.match(value):
+        try:
+            return datetime.datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    return value
+
+
+def _adapt(value):
+    """
+    Pass an argument the way pymysql would: bytes (e.g. from
+    ``mystify()``) as text, if they are text, and dates in ISO format.
+    """
+    if isinstance(value, bytes):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value    # binary data stays a BLOB
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(' ')
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
+def _adapt_args(args):
+    if isinstance(args, dict):
+        return {name: _adapt(value) for name, value in args.items()}
+    return [_adapt(value) for value in args]
+
+
+def _unix_timestamp(value):
+    """
+    ``UNIX_TIMESTAMP()``, for the timestamps SQLite stores (UTC text).
+    """
+    if value is None:
+        return None
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.fromisoformat(str(value))
+    return calendar.timegm(value.timetuple())
+
+
+class SQLiteCursor:
+    """
+    A pymysql-style (buffered, dict) cursor over an SQLite connection.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self._cursor = connection._conn.cursor()
+        self._rows = []
+        self._next = 0
+        self.rowcount = -1
+        self.lastrowid = None
+        self.description = None
+
+    def execute(self, query, args=None):
+        self._cursor.execute(translate(query, args is not None),
+                             _adapt_args(args) if args is not None else ())
+        return self._collect()
+
+    def executemany(self, query, args):
+        self._cursor.executemany(translate(query), (_adapt_args(row) for row in args))
+        return self._collect()
+
+    def _start(self):
+        self.description = self._cursor.description
+        self.lastrowid = self._cursor.lastrowid
+        self._names = [column[0] for column in self.description or ()]
+
+    def _row(self, row):
+        return dict(zip(self._names, map(_to_datetime, row)))
+
+    def _collect(self):
+        self._start()
+        if self.description is None:
+            self._rows = []
+            self.rowcount = self._cursor.rowcount
+        else:
+            # buffered, like pymysql's default cursors
+            self._rows = [self._row(row) for row in self._cursor.fetchall()]
+            self.rowcount = len(self._rows)
+        self._next = 0
+        return self.rowcount
+
+    def fetchone(self):
+        if self._next >= len(self._rows):
+            return None
+        self._next += 1
+        return self._rows[self._next - 1]
+
+    def fetchmany(self, size=None):
+        size = size or 1
+        rows = self._rows[self._next:self._next + size]
+        self._next += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._rows[self._next:]
+        self._next = len(self._rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def close(self):
+        self._cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SQLiteStreamCursor(SQLiteCursor):
+    """
+    Like ``SQLiteCursor``, but rows are only read as they're fetched,
+    like pymysql's ``SSDictCursor``. ``rowcount`` isn't known for SELECTs.
+    """
+    def _collect(self):
+        self._start()
+        self.rowcount = self._cursor.rowcount
+        return self.rowcount
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        return None if row is None else self._row(row)
+
+    def fetchmany(self, size=None):
+        return [self._row(row) for row in self._cursor.fetchmany(size or self._cursor.arraysize)]
+
+    def fetchall(self):
+        return [self._row(row) for row in self._cursor.fetchall()]
+
+
+class SQLiteConnection:
+    """
+    An SQLite connection with the bits of pymysql's interface we use.
+    Outside of ``begin()`` ... ``commit()``, every statement commits on
+    its own (autocommit), as with MySQL.
+    """
+    def __init__(self, database, pragmas, cursorclass, uri=False):
+        # pooled connections move between threads (one at a time)
+        self._conn = sqlite3.connect(
+            database, uri=uri, isolation_level=None, check_same_thread=False
+        )
+        for name, value in pragmas.items():
+            self._conn.execute('PRAGMA {} = {}'.format(name, value))
+        self._conn.create_function('UNIX_TIMESTAMP', 1, _unix_timestamp, deterministic=True)
+        self.cursorclass = cursorclass
+
+    def cursor(self, cursorclass=None):
+        return (cursorclass or self.cursorclass)(self)
+
+    def begin(self):
+        # take the write lock up front, rather than fail to upgrade to it
+        # half way through (which busy_timeout can't help with)
+        self._conn.execute('BEGIN IMMEDIATE')
+
+    def commit(self):
+        if self._conn.in_transaction:
+            self._conn.execute('COMMIT')
+
+    def rollback(self):
+        if self._conn.in_transaction:
+            self._conn.execute('ROLLBACK')
+
+    def ping(self, reconnect=False):
+        self._conn.execute('SELECT 1')
+
+    def get_autocommit(self):
+        return True
+
+    def autocommit(self, value):
+        pass    # always, outside of begin()
+
+    def executescript(self, script):
+        self._conn.executescript(script)
+
+    def close(self):
+        self._conn.close()
+
+
+class SQLiteBackend:
+    name = 'sqlite'
+    errors = (sqlite3.Error,)
+    integrity_errors = (sqlite3.IntegrityError,)
+    cursorclass = SQLiteCursor
+    streamcursorclass = SQLiteStreamCursor
+
+    # WAL lets readers carry on while someone writes; NORMAL sync is
+    # safe in WAL mode (a power cut can lose the last commits, but
+    # never corrupts the file); waits up to 5s for the write lock
+    PRAGMAS = dict(
+        journal_mode='WAL',
+        synchronous='NORMAL',
+        foreign_keys='ON',
+        busy_timeout=5000,
+        temp_store='MEMORY',
+        cache_size=-16000,      # KiB, per connection
+        mmap_size=134217728,    # bytes
+    )
+
+    def __init__(self, config):
+        self.config = config
+        self.pragmas = dict(self.PRAGMAS, **config['SQLITE_PRAGMAS'])
+        self.database = config['SQLITE_PATH']
+        self.uri = False
+        self._keepalive = None
+        if self.database == ':memory:':
+            # one in-memory database shared by all the pool's connections;
+            # it lasts as long as something holds it open
+            self.database = 'file:ptrak-{}?mode=memory&cache=shared'.format(uuid.uuid4().hex)
+            self.uri = True
+            self.pragmas.pop('journal_mode')
+            self._keepalive = self.connect()
+
+    def connect(self):
+        return SQLiteConnection(self.database, self.pragmas,
+                                self.config['DB_CURSORCLASS'] or self.cursorclass,
+                                uri=self.uri)
+
+    def reset(self, conn):
+        # the pragmas are set on connect, and nothing else is kept per
+        # connection: an open transaction is all there is to undo
+        conn.rollback()
+
+    def upsert(self, table, columns, key, update=()):
+        sql = 'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({})'.format(
+            table, ', '.join(columns), ', '.join(['%s'] * len(columns)), ', '.join(key))
+        if update:
+            return sql + ' DO UPDATE SET ' + ', '.join(
+                '{0}=excluded.{0}'.format(column) for column in update)
+        return sql + ' DO NOTHING'
+
+    def tables(self, dbcursor):
+        dbcursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        return {row['name'] for row in dbcursor.fetchall()}
+
+    def columns(self, dbcursor, table):
+        dbcursor.execute('SELECT name FROM pragma_table_info(%s)', (table,))
+        return {row['name'].lower() for row in dbcursor.fetchall()}
+
+    def indexes(self, dbcursor, table):
+        dbcursor.execute('SELECT name FROM pragma_index_list(%s)', (table,))
+        indexes = {}
+        for row in dbcursor.fetchall():
+            dbcursor.execute('SELECT name FROM pragma_index_info(%s) ORDER BY seqno', (row['name'],))
+            indexes[row['name']] = [column['name'].lower() for column in dbcursor.fetchall()]
+        return indexes
+
+    def full_scans(self, dbcursor, query, args):
+        tables = self.tables(dbcursor)
+        dbcursor.execute('EXPLAIN QUERY PLAN ' + query, args)
+        scans = []
+        for row in dbcursor.fetchall():
+            # e.g. "SCAN Tasks"; "SCAN Tasks USING INDEX ..." walks an index
+            match = re.match(r'SCAN (\w+)$', row['detail'])
+            if match and match.group(1) in tables:
+                scans.append(match.group(1))
+        return scans
+
+    def add_full_text_index(self, dbcursor, table, name, columns, key):
+        """
+        An FTS5 table over ``columns`` of ``table`` (which it reads the
+        text back from, rather than keeping a copy), filled in from the
+        rows already there and kept up to date by triggers.
+        """
+        if name in self.tables(dbcursor):
+            return
+        values = lambda row: ', '.join('{}.{}'.format(row, column) for column in columns)
+        spec = dict(name=name, table=table, key=key, columns=', '.join(columns),
+                    new=values('new'), old=values('old'))
+        dbcursor.execute(
+            "CREATE VIRTUAL TABLE {name} USING fts5({columns}, content='{table}',"
+            " content_rowid='{key}', prefix='2 3', tokenize='unicode61 remove_diacritics 2')"
+            .format(**spec))
+        forget = ("INSERT INTO {name} ({name}, rowid, {columns})"
+                  " VALUES ('delete', old.{key}, {old});").format(**spec)
+        remember = ('INSERT INTO {name} (rowid, {columns})'
+                    ' VALUES (new.{key}, {new});').format(**spec)
+        dbcursor.execute('CREATE TRIGGER {name}_insert AFTER INSERT ON {table}'
+                         ' BEGIN {remember} END'.format(remember=remember, **spec))
+        dbcursor.execute('CREATE TRIGGER {name}_delete AFTER DELETE ON {table}'
+                         ' BEGIN {forget} END'.format(forget=forget, **spec))
+        # only when the indexed text changes (not e.g. a task's status)
+        dbcursor.execute('CREATE TRIGGER {name}_update AFTER UPDATE OF {columns} ON {table}'
+                         ' BEGIN {forget} {remember} END'.format(
+                             forget=forget, remember=remember, **spec))
+        dbcursor.execute("INSERT INTO {name} ({name}) VALUES ('rebuild')".format(**spec))
+
+    def match(self, table, name, columns, key):
+        return FullText(
+            ' JOIN {0} ON {0}.rowid = {1}.{2}'.format(name, table, key),
+            '{} MATCH %s'.format(name),
+            # bm25() is lower for better matches
+            '-bm25({})'.format(name),
+            0
+        )
+
+    def search_terms(self, words):
+        return ' '.join('"{}"*'.format(word) for word in words)
+
+
+BACKENDS = dict(mysql=MySQLBackend, sqlite=SQLiteBackend)
+
+
+def make_backend(config):
+    try:
+        backend = BACKENDS[config['DB_BACKEND']]
+    except KeyError:
+        raise ValueError('unknown DB_BACKEND {!r}'.format(config['DB_BACKEND']))
+    return backend(config)
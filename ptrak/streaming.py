@@ -0,0 +1,142 @@
+"""
+Streamed page rendering.
+
+``render_template()`` builds a whole page before the first byte goes
+out, so the browser waits for the slowest query and the page's size
+is held in memory. ``stream_page()`` sends the page as it's rendered
+instead: the template is run with Jinja's ``generate()``, and its
+output is sent in chunks of about ``STREAM_CHUNK_SIZE`` characters,
+plus whenever the template outputs ``{{ flush }}`` (``base.html`` does,
+right after the navbar and flashed messages).
+
+For that to help, the expensive data has to be fetched while the page
+is rendered, not before: pass it to the template as something that
+loads when it's first used, such as ``Rows`` or ``PageRows``, which
+read their rows through a server-side (unbuffered) cursor one at a
+time as the template loops over them, so memory stays flat however
+many rows there are. Whatever the page needs before the navbar (its
+title, say) still has to be loaded up front.
+
+Once the first chunk is sent the status and headers can't change, so
+anything that might redirect or fail has to happen before calling
+``stream_page()``. That includes the session cookie, so the flashed
+messages are taken out of the session before the page starts.
+"""
+from flask import Response, current_app, get_flashed_messages, stream_with_context
+from markupsafe import Markup
+
+from ptrak.db import get_backend, get_db
+from ptrak.paging import encode_cursor, page_query, sort_keys
+
+# what {{ flush }} outputs; harmless if the page isn't streamed
+FLUSH = '<!-- flush -->'
+
+
+def chunks(pieces, size):
+    """
+    Join the template's output into chunks of about ``size``
+    characters, cutting one short wherever it says to flush.
+    """
+    buffer, length = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        length += len(piece)
+        if length >= size or FLUSH in piece:
+            yield ''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def stream_page(template, **context):
+    """
+    Like ``render_template()``, but the response is sent as it's
+    rendered. The request context stays available to the template
+    (and anything it loads) until the page is done.
+
+    :return: a streamed ``text/html`` response
+    """
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    # (kept for the template; popping them later wouldn't be saved)
+    get_flashed_messages()
+    pieces = app.jinja_env.get_template(template).generate(context)
+    return Response(stream_with_context(chunks(pieces, app.config['STREAM_CHUNK_SIZE'])),
+                    mimetype='text/html')
+
+
+class Rows:
+    """
+    The rows of a SELECT, run when first looped over and read through
+    a server-side cursor, one at a time. Can only be looped over once.
+
+    :param query: the SQL
+    :param args: its arguments
+    :param each: called with every row; what it returns is what's
+                 yielded (e.g. ``ptrak.people.person``)
+    """
+
+    def __init__(self, query, args=(), each=None):
+        self.query = query
+        self.args = args
+        self.each = each
+
+    def rows(self):
+        dbcursor = get_db().cursor(current_app.config['DB_STREAMCURSORCLASS']
+                                   or get_backend().streamcursorclass)
+        try:
+            dbcursor.execute(self.query, self.args)
+            while True:
+                row = dbcursor.fetchone()
+                if row is None:
+                    break
+                yield row
+        finally:
+            # (reads whatever's left, so the connection can be used again)
+            dbcursor.close()
+
+    def __iter__(self):
+        for row in self.rows():
+            yield row if self.each is None else self.each(row)
+
+
+class PageRows(Rows):
+    """
+    One page of rows, like ``ptrak.paging.fetch_page()``, but read as
+    they're looped over. ``more`` (the cursor for the next page, or
+    None) is only known once the loop is done, so put the "next page"
+    link after it.
+
+    :param done: called with the list of rows' ``keep`` values once
+                 the page has been read (e.g. to mark them as seen)
+    :param keep: what to remember of each row for ``done``
+    """
+
+    def __init__(self, query, args, sort, after=None, limit=25, each=None,
+                 done=None, keep=None):
+        super().__init__(*page_query(query, args, sort, after, limit), each=each)
+        self.keys = sort_keys(sort)
+        self.limit = limit
+        self.done = done
+        self.keep = keep
+        self.more = None
+
+    def rows(self):
+        kept, last, count = [], None, 0
+        for row in super().rows():
+            count += 1
+            if count > self.limit:
+                # the extra row: there's another page
+                self.more = encode_cursor(last, self.keys)
+                continue
+            last = row
+            if self.keep is not None:
+                kept.append(self.keep(row))
+            yield row
+        if self.done is not None:
+            self.done(kept)
+
+
+def init_app(app):
+    app.config.setdefault('STREAM_CHUNK_SIZE', 8192)    # characters per chunk sent
+    app.jinja_env.globals['flush'] = Markup(FLUSH)
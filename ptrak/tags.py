@@ -0,0 +1,201 @@
+"""
+Task tags.
+
+A task's tags are typed in as a comma-separated list and kept in
+``Tasks.tags`` (e.g. ``'backend, needs review'``), which is what pages
+show and what full-text search looks at. Finding tasks *by* tag in
+that column would mean a LIKE over every task, so each tag is also
+kept as a row of ``TaskTags`` (pid, tag, tid). Its primary key starts
+with (pid, tag), so:
+
+- the tasks with a tag in a project (the board's ``?tag=`` filter),
+- the tag counts for a project, and
+- the tasks with a tag across all of a user's projects
+
+are all read off a range of the index. ``TaskTags.tag`` compares
+exactly (``utf8mb4_bin`` on MySQL), like ``parse()`` does, so tags it
+keeps apart, e.g. ``resume`` and ``résumé``, stay apart. The two copies are kept in step
+by ``set_tags()``, which is the only thing that should write either.
+``flask reindex-tags`` rebuilds ``TaskTags`` from ``Tasks.tags`` (e.g.
+for rows written some other way).
+"""
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from ptrak.db import get_db, read, transaction
+from ptrak.paging import fetch_page
+
+# the width of TaskTags.tag
+MAX_LENGTH = 50
+
+# a project's (pid, limit) most used tags
+COUNTS_QUERY = (
+    'SELECT tag, COUNT(*) AS num FROM TaskTags WHERE pid=%s'
+    ' GROUP BY tag ORDER BY num DESC, tag LIMIT %s'
+)
+# the order ``tagged_tasks()`` pages in
+TAGGED_SORT = ('Tasks.date_updated', 'Tasks.tid')
+
+
+def parse(text):
+    """
+    Split a comma-separated list of tags into normalized tags: trimmed,
+    lowercased, with inner whitespace collapsed, without a leading
+    ``#``, and without duplicates (first one wins). Anything past
+    ``TASK_MAX_TAGS`` tags is dropped.
+
+    :param text: what the user typed (or a ``Tasks.tags`` value)
+    :return: a list of tags, in the order given
+    """
+    tags = []
+    for part in (text or '').split(','):
+        tag = ' '.join(part.split()).lstrip('#').strip().lower()[:MAX_LENGTH].rstrip()
+        if tag and tag not in tags:
+            tags.append(tag)
+    return tags[:current_app.config['TASK_MAX_TAGS']]
+
+
+def set_tags(dbcursor, tid, pid, tags):
+    """
+    Give a task these tags (and only these), in both ``Tasks.tags``
+    and ``TaskTags``. Run it in the same transaction as the task's
+    INSERT or UPDATE.
+
+    :param tags: a list from ``parse()``
+    """
+    dbcursor.execute(
+        'UPDATE Tasks SET tags=%s WHERE tid=%s',
+        (', '.join(tags) or None, tid)
+    )
+    dbcursor.execute('DELETE FROM TaskTags WHERE tid=%s', (tid,))
+    if tags:
+        dbcursor.executemany(
+            'INSERT INTO TaskTags (pid, tag, tid) VALUES (%s, %s, %s)',
+            [(pid, tag, tid) for tag in tags]
+        )
+
+
+def tagged(pid, tag):
+    """
+    The SQL condition (and its arguments) for "``Tasks`` row has this
+    tag", to add to a query on one project's tasks.
+
+    :return: (condition, args)
+    """
+    return 'Tasks.tid IN (SELECT tid FROM TaskTags WHERE pid=%s AND tag=%s)', (pid, tag)
+
+
+def tag_counts(pid, limit=None):
+    """
+    A ``read()`` for a project's most used tags.
+
+    :param limit: how many tags (default: ``PROJECT_TAGS``)
+    :return: rows with ``tag`` and ``num``, most used first
+    """
+    if limit is None:
+        limit = current_app.config['PROJECT_TAGS']
+    return read(COUNTS_QUERY, (pid, limit))
+
+
+def tagged_tasks(dbcursor, tag, pids, after=None, limit=None, columns=None):
+    """
+    One page of the tasks with a tag in any of the given projects,
+    most recently updated first. The tasks are found through the
+    (pid, tag) range of each project in ``TaskTags``.
+
+    :param pids: the projects to look in (the ones the user is involved in)
+    :param after: the page cursor (see ``ptrak.paging``)
+    :param limit: the page size (default: ``TAGGED_PAGE_SIZE``)
+    :param columns: what to SELECT (default: the task and its project title)
+    :return: (rows, cursor for the next page or None)
+    """
+    if not pids:
+        return [], None
+    if limit is None:
+        limit = current_app.config['TAGGED_PAGE_SIZE']
+    query, args = tagged_tasks_query(tag, pids, columns)
+    return fetch_page(dbcursor, query, args, sort=TAGGED_SORT, after=after, limit=limit)
+
+
+def tagged_tasks_query(tag, pids, columns=None):
+    """
+    The query for ``tagged_tasks()`` (before paging), and its arguments.
+
+    :return: (query, args)
+    """
+    if columns is None:
+        columns = ('Tasks.tid, Tasks.pid, Projects.title AS project, Tasks.title,'
+                   ' Tasks.status, Tasks.tags, Tasks.date_updated')
+    return (
+        'SELECT {} FROM TaskTags JOIN Tasks ON Tasks.tid = TaskTags.tid'
+        ' JOIN Projects ON Projects.pid = Tasks.pid'
+        ' WHERE TaskTags.pid IN ({}) AND TaskTags.tag=%s'.format(
+            columns, ', '.join(['%s'] * len(pids))),
+        tuple(sorted(pids)) + (tag,)
+    )
+
+
+def backfill(dbcursor, pids=None, echo=None):
+    """
+    Rebuild ``TaskTags`` from ``Tasks.tags``, a project at a time,
+    normalizing ``Tasks.tags`` on the way. Safe to run more than once.
+
+    :param pids: the projects to do (default: all of them)
+    :param echo: called with a progress message per project
+    :return: the number of projects done
+    """
+    if pids is None:
+        dbcursor.execute('SELECT pid FROM Projects ORDER BY pid')
+        pids = [row['pid'] for row in dbcursor.fetchall()]
+    for number, pid in enumerate(pids, 1):
+        dbcursor.execute('DELETE FROM TaskTags WHERE pid=%s', (pid,))
+        dbcursor.execute(
+            'SELECT tid, tags FROM Tasks WHERE pid=%s AND tags IS NOT NULL',
+            (pid,)
+        )
+        rows = dbcursor.fetchall()
+        for row in rows:
+            tags = parse(row['tags'])
+            if ', '.join(tags) != row['tags']:
+                dbcursor.execute(
+                    'UPDATE Tasks SET tags=%s WHERE tid=%s',
+                    (', '.join(tags) or None, row['tid'])
+                )
+        entries = [(pid, tag, row['tid']) for row in rows for tag in parse(row['tags'])]
+        if entries:
+            dbcursor.executemany(
+                'INSERT INTO TaskTags (pid, tag, tid) VALUES (%s, %s, %s)',
+                entries
+            )
+        if echo is not None:
+            echo('  project {} ({}/{}): {} tagged tasks'.format(
+                pid, number, len(pids), len(rows)))
+    return len(pids)
+
+
+@click.command('reindex-tags')
+@click.option('--project', 'pids', type=int, multiple=True,
+              help='Only this project (can be given more than once).')
+@with_appcontext
+def reindex_tags_command(pids):
+    """
+    Rebuild the task tag index from the tasks' tags.
+    """
+    dbcursor = get_db().cursor()
+    if not pids:
+        dbcursor.execute('SELECT pid FROM Projects ORDER BY pid')
+        pids = [row['pid'] for row in dbcursor.fetchall()]
+    # a transaction per project, like backfill-feed
+    for number, pid in enumerate(pids, 1):
+        with transaction() as dbcursor:
+            backfill(dbcursor, [pid])
+        click.echo('  project {} ({}/{})'.format(pid, number, len(pids)))
+    click.echo('Done: {} projects.'.format(len(pids)))
+
+
+def init_app(app):
+    app.config.setdefault('TASK_MAX_TAGS', 10)      # tags per task
+    app.config.setdefault('PROJECT_TAGS', 30)       # tags listed on a project page
+    app.config.setdefault('TAGGED_PAGE_SIZE', 25)   # tasks per page of a tag
+    app.cli.add_command(reindex_tags_command)
@@ -3,31 +3,31 @@ The ``task`` template.
 """
 
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, url_for
+    Blueprint, current_app, flash, g, redirect, render_template, request, session, url_for
 )
-from ptrak.db import get_db
+from ptrak.db import get_db, transaction
 from ptrak.user import login_required
+from ptrak.access import project_rank
+from ptrak.fragments import bump_project
+from ptrak import notify, tags
+from ptrak import notes as tasknotes
 import time, datetime   #
 
 bp = Blueprint('task', __name__, url_prefix='/task')
 
+# the task being edited (also the involvement check)
+TASK_QUERY = 'SELECT * FROM Tasks WHERE tid=%s'
+
 @bp.route('/edit/<int:tid>', methods=('GET', 'POST'))
 @login_required()
 def edit(tid):
     dbcursor = get_db().cursor()
     # get data for this task to pass to the template (and the involvement check)
-    dbcursor.execute(
-        'SELECT * FROM Tasks WHERE tid=%s',
-        (tid,)
-    )
+    dbcursor.execute(TASK_QUERY, (tid,))
     thistask = dbcursor.fetchone()
 
     # involvement check: is the user actually assigned to this project?
-    res = dbcursor.execute(
-        'SELECT * FROM Involvements WHERE pid=(%s) AND uid=(%s)',
-        (thistask['pid'], session['uid'],)
-    )
-    if not res:
+    if thistask is None or project_rank(thistask['pid']) is None:
         flash('You aren\'t involved in that project.', category='warning')
         return redirect(url_for('my.dashboard'))
 
@@ -37,16 +37,76 @@ def edit(tid):
         description = request.form['description']
         date_due = request.form['date_due']
         status = request.form['status']
+        tasktags = tags.parse(request.form.get('tags'))
 
         error = None
 
         if error is None:
-            dbcursor.execute(
-                'UPDATE Tasks SET title=%s, description=%s, date_due=%s, status=%s'
-                ' WHERE tid=%s',
-                (title, description, date_due, status, tid)
-            )
+            # the task and its tags (see ptrak.tags) change together
+            with transaction() as dbcursor:
+                dbcursor.execute(
+                    'UPDATE Tasks SET title=%s, description=%s, date_due=%s, status=%s,'
+                    ' date_updated=CURRENT_TIMESTAMP'
+                    ' WHERE tid=%s',
+                    (title, description, date_due, status, tid)
+                )
+                tags.set_tags(dbcursor, tid, thistask['pid'], tasktags)
+                bump_project(thistask['pid'], dbcursor)
+            notify.publish(notify.project_channel(thistask['pid']), 'task',
+                           tid=tid, status=status, by=session['uid'])
             return redirect(url_for('project.project',pid=thistask['pid']))
         flash(error)
-        
-    return render_template('task/edit.html', thistask=thistask)
+
+    # the first page of the task's notes; older ones are loaded from
+    # task.notes when asked for
+    thread, morenotes = tasknotes.load_thread(dbcursor, tid)
+    return render_template('task/edit.html', thistask=thistask,
+                           thread=thread, morenotes=morenotes)
+
+@bp.route('/<int:tid>/notes', methods=('GET', 'POST'))
+@login_required()
+def notes(tid):
+    """
+    GET: one page of the task's notes, newest first, as an HTML
+    fragment for the board and task.edit to load into the page
+    (``?after=`` continues from the previous page).
+
+    POST: add a note to the task.
+    """
+    dbcursor = get_db().cursor()
+    dbcursor.execute(
+        'SELECT tid, pid FROM Tasks WHERE tid=%s',
+        (tid,)
+    )
+    thistask = dbcursor.fetchone()
+
+    # involvement check, as in edit()
+    if thistask is None or project_rank(thistask['pid']) is None:
+        if request.method == 'GET':
+            return 'You aren\'t involved in that project.', 404
+        flash('You aren\'t involved in that project.', category='warning')
+        return redirect(url_for('my.dashboard'))
+
+    if request.method == 'POST':
+        content = request.form.get('content', '').strip()
+
+        error = None
+        if not content:
+            error = 'A note can\'t be empty.'
+        elif len(content) > current_app.config['NOTE_MAX_LENGTH']:
+            error = 'That note is too long.'
+
+        if error is None:
+            with transaction() as dbcursor:
+                nid = tasknotes.add_note(dbcursor, tid, session['uid'], content)
+                # the board shows note counts and the latest note
+                bump_project(thistask['pid'], dbcursor)
+            notify.publish(notify.project_channel(thistask['pid']), 'note',
+                           tid=tid, nid=nid, by=session['uid'])
+            flash('Note added.', category='success')
+        else:
+            flash(error, category='danger')
+        return redirect(url_for('task.edit', tid=tid) + '#notes')
+
+    thread, morenotes = tasknotes.load_thread(dbcursor, tid, after=request.args.get('after'))
+    return render_template('task/_notes.html', tid=tid, thread=thread, morenotes=morenotes)
@@ -0,0 +1,391 @@
+"""
+Bulk export and import: ``flask ptrak export`` / ``flask ptrak import``.
+
+Data goes in and out as one file per table (``Users.jsonl``,
+``Tasks.csv``, ...) in a directory, parents before children, so that
+a whole export can be imported into an empty database as is. Rows are
+kept exactly as stored: ids are preserved (so references still line
+up), and names and emails stay mystified, passwords hashed.
+
+Both directions stream, so memory use doesn't grow with the data:
+
+- export reads each table in primary key order through an unbuffered
+  (server-side) cursor and writes rows out as they arrive;
+- import reads its files a line at a time and writes ``--chunk`` rows
+  per multi-row INSERT, one transaction per chunk.
+
+Each keeps a checkpoint file in the directory, updated after every
+chunk. With ``--resume``, an interrupted run picks up from its
+checkpoint instead of starting over. In CSV files, NULL is ``\\N``.
+
+After an import, the derived data (unread counters, announcement
+feeds, the task tag index, cached pages and ranks) is rebuilt for what
+was imported.
+"""
+import csv
+import datetime
+import json
+import os
+import time
+
+import click
+from flask.cli import AppGroup
+
+from ptrak import feed, tags
+from ptrak.access import forget_ranks
+from ptrak.db import get_backend, get_db, transaction
+from ptrak.fragments import bump_project
+
+# (table, primary key, columns), parents first
+TABLES = [
+    ('Users', ('uid',),
+     ('uid', 'firstname', 'lastname', 'email', 'password', 'projects', 'level',
+      'lastlogin', 'unreadcount')),
+    ('Projects', ('pid',),
+     ('pid', 'title', 'owner', 'description', 'date_due')),
+    ('Involvements', ('uid', 'pid'),
+     ('uid', 'pid', '`rank`')),
+    ('Tasks', ('tid',),
+     ('tid', 'pid', 'creator', 'status', 'title', 'description', 'date_due',
+      'date_submitted', 'date_updated', 'tags')),
+    ('Notes', ('nid',),
+     ('nid', 'tid', 'content', 'author', 'date_added')),
+    ('Messages', ('mid',),
+     ('mid', 'destination', 'source', 'subject', 'content', 'date_sent', 'unread')),
+    ('Announcements', ('aid',),
+     ('aid', 'pid', 'author', 'date_made', 'content')),
+]
+TABLE_NAMES = [table for table, _, _ in TABLES]
+
+FORMATS = ('jsonl', 'csv')
+NULL = r'\N'
+
+EXPORT_CHECKPOINT = '.export-checkpoint.json'
+IMPORT_CHECKPOINT = '.import-checkpoint.json'
+
+cli = AppGroup('ptrak', help='PTrak data tools.')
+
+
+def bare(column):
+    return column.strip('`')
+
+
+def table_path(directory, table, fmt):
+    return os.path.join(directory, '{}.{}'.format(table, fmt))
+
+
+def load_checkpoint(directory, name, fmt, resume):
+    """
+    :return: the checkpoint to carry on from (empty unless resuming)
+    """
+    path = os.path.join(directory, name)
+    if not resume or not os.path.exists(path):
+        return dict(format=fmt, tables={})
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint['format'] != fmt:
+        raise click.ClickException('the checkpoint is for a {} run'.format(checkpoint['format']))
+    return checkpoint
+
+
+def save_checkpoint(directory, name, checkpoint):
+    # written to the side and renamed, so it's never half there
+    path = os.path.join(directory, name)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(path + '.tmp', path)
+
+
+class Progress:
+    """
+    Prints a table's row count and rate every few seconds.
+    """
+    def __init__(self, table, done=0, every=5):
+        self.table = table
+        self.done = done
+        self.every = every
+        self.rows = 0
+        self.start = self.last = time.perf_counter()
+
+    def add(self, rows):
+        self.rows += rows
+        now = time.perf_counter()
+        if now - self.last >= self.every:
+            self.last = now
+            click.echo('  {}: {} rows ({:.0f} rows/s)'.format(
+                self.table, self.done + self.rows, self.rows / (now - self.start)))
+
+    def finish(self):
+        elapsed = time.perf_counter() - self.start
+        click.echo('{}: {} rows in {:.1f}s ({:.0f} rows/s){}'.format(
+            self.table, self.done + self.rows, elapsed,
+            self.rows / elapsed if elapsed else 0,
+            ', {} done before'.format(self.done) if self.done else ''))
+
+
+# --- export ----------------------------------------------------------------
+
+def to_text(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(' ')
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def after(key, last):
+    """
+    A WHERE clause for the rows after ``last`` in ``key`` order.
+    """
+    if last is None:
+        return '', []
+    # written out rather than as (a, b) > (x, y), which MySQL
+    # doesn't always use the primary key for
+    clauses, args = [], []
+    for n, column in enumerate(key):
+        clauses.append('(' + ' AND '.join(
+            ['{} = %s'.format(c) for c in key[:n]] + ['{} > %s'.format(column)]) + ')')
+        args += list(last[:n]) + [last[n]]
+    return ' WHERE ' + ' OR '.join(clauses), args
+
+
+def export_table(directory, fmt, table, key, columns, state, chunk):
+    """
+    Stream a table to its file, carrying on from ``state`` (which is
+    updated, and saved by the caller, after every chunk).
+    """
+    path = table_path(directory, table, fmt)
+    names = [bare(column) for column in columns]
+    if state.get('offset'):
+        # drop anything written after the last checkpoint
+        with open(path, 'r+', encoding='utf-8', newline='') as f:
+            f.truncate(state['offset'])
+    where, args = after(key, state.get('last'))
+
+    conn = get_backend().connect()
+    try:
+        dbcursor = conn.cursor(get_backend().streamcursorclass)
+        dbcursor.execute('SELECT {} FROM {}{} ORDER BY {}'.format(
+            ', '.join(columns), table, where, ', '.join(key)), args or None)
+        with open(path, 'a' if state.get('offset') else 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f) if fmt == 'csv' else None
+            if writer is not None and not state.get('offset'):
+                writer.writerow(names)
+            progress = Progress(table, state.get('rows', 0))
+            while True:
+                rows = dbcursor.fetchmany(chunk)
+                if not rows:
+                    break
+                for row in rows:
+                    values = [to_text(row[name]) for name in names]
+                    if writer is not None:
+                        writer.writerow([NULL if value is None else value for value in values])
+                    else:
+                        f.write(json.dumps(dict(zip(names, values))) + '\n')
+                f.flush()
+                state.update(last=[rows[-1][column] for column in key], offset=f.tell(),
+                             rows=state.get('rows', 0) + len(rows))
+                yield
+                progress.add(len(rows))
+        progress.finish()
+    finally:
+        conn.close()
+    state['done'] = True
+    yield
+
+
+@cli.command('export')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='jsonl', show_default=True)
+@click.option('--table', 'tables', type=click.Choice(TABLE_NAMES), multiple=True,
+              help='Only this table (can be given more than once).')
+@click.option('--chunk', default=5000, show_default=True, help='Rows per checkpoint.')
+@click.option('--resume', is_flag=True, help='Carry on from the last checkpoint.')
+def export_command(directory, fmt, tables, chunk, resume):
+    """
+    Export tables to DIRECTORY, a file per table.
+    """
+    os.makedirs(directory, exist_ok=True)
+    checkpoint = load_checkpoint(directory, EXPORT_CHECKPOINT, fmt, resume)
+    for table, key, columns in TABLES:
+        if tables and table not in tables:
+            continue
+        state = checkpoint['tables'].setdefault(table, {})
+        if state.get('done'):
+            click.echo('{}: already exported'.format(table))
+            continue
+        for _ in export_table(directory, fmt, table, key, columns, state, chunk):
+            save_checkpoint(directory, EXPORT_CHECKPOINT, checkpoint)
+    click.echo('Exported to {}.'.format(directory))
+
+
+# --- import ----------------------------------------------------------------
+
+def read_rows(path, fmt):
+    """
+    :return: the file's column names, and an iterator over its rows
+             (as lists, in that order)
+    """
+    f = open(path, encoding='utf-8', newline='')
+    if fmt == 'csv':
+        reader = csv.reader(f)
+        names = next(reader, [])
+        rows = ([None if value == NULL else value for value in row] for row in reader)
+    else:
+        first = f.readline()
+        names = list(json.loads(first)) if first.strip() else []
+        f.seek(0)
+        rows = _records(f, names)
+    return names, _closing(rows, f)
+
+
+def _records(f, names):
+    for number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            yield [record[name] for name in names]
+        except (ValueError, KeyError) as e:
+            raise click.ClickException('{}, line {}: bad row ({})'.format(f.name, number, e))
+
+
+def _closing(rows, f):
+    with f:
+        yield from rows
+
+
+def import_table(directory, fmt, table, key, columns, state, chunk, skip_existing):
+    """
+    Insert a table's file, ``chunk`` rows per transaction, carrying on
+    from ``state`` (which is updated, and saved by the caller, after
+    every chunk). Yields the pids and uids whose derived data needs
+    rebuilding so far: pids for anything belonging to a project, uids
+    for memberships.
+    """
+    names, rows = read_rows(table_path(directory, table, fmt), fmt)
+    if not names:
+        click.echo('{}: empty'.format(table))
+        state['done'] = True
+        yield set(), set()
+        return
+    known = {bare(column): column for column in columns}
+    unknown = [name for name in names if name not in known]
+    if unknown:
+        raise click.ClickException('{}: unknown column(s) {}'.format(table, ', '.join(unknown)))
+    missing = [column for column in key if column not in names]
+    if missing:
+        raise click.ClickException('{}: missing key column(s) {}'.format(table, ', '.join(missing)))
+
+    quoted = [known[name] for name in names]
+    if skip_existing:
+        # rows that made it in after the last checkpoint are left alone
+        sql = get_backend().upsert(table, quoted, key)
+    else:
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            table, ', '.join(quoted), ', '.join(['%s'] * len(quoted)))
+    pidcolumn = names.index('pid') if 'pid' in names else None
+    uidcolumn = names.index('uid') if table == 'Involvements' else None
+    pids, uids = set(), set()
+
+    done = state.get('rows', 0)
+    progress = Progress(table, done)
+    batch = []
+    for number, row in enumerate(rows, 1):
+        if number <= done:
+            continue
+        if len(row) != len(names):
+            raise click.ClickException('{}: row {} has {} values, expected {}'.format(
+                table, number, len(row), len(names)))
+        batch.append(row)
+        if len(batch) >= chunk:
+            _insert(sql, batch, pids, pidcolumn, uids, uidcolumn)
+            state['rows'] = number
+            progress.add(len(batch))
+            batch = []
+            yield pids, uids
+    if batch:
+        _insert(sql, batch, pids, pidcolumn, uids, uidcolumn)
+        state['rows'] = done + progress.rows + len(batch)
+        progress.add(len(batch))
+    progress.finish()
+    state['done'] = True
+    yield pids, uids
+
+
+def _insert(sql, batch, pids, pidcolumn, uids, uidcolumn):
+    with transaction() as dbcursor:
+        dbcursor.executemany(sql, batch)
+    if pidcolumn is not None:
+        pids.update(int(row[pidcolumn]) for row in batch)
+    if uidcolumn is not None:
+        uids.update(int(row[uidcolumn]) for row in batch)
+
+
+def rebuild(tables, pids, uids):
+    """
+    Bring the data derived from the imported rows up to date.
+    """
+    dbcursor = get_db().cursor()
+    if 'Messages' in tables:
+        click.echo('Recounting unread messages')
+        dbcursor.execute(
+            'UPDATE Users SET unreadcount ='
+            ' (SELECT COUNT(*) FROM Messages WHERE destination=uid AND unread=1)'
+        )
+    if 'Announcements' in tables or 'Involvements' in tables:
+        click.echo('Filling announcement feeds')
+        for pid in sorted(pids):
+            with transaction() as dbcursor:
+                feed.backfill(dbcursor, [pid])
+    if 'Tasks' in tables:
+        click.echo('Indexing task tags')
+        for pid in sorted(pids):
+            with transaction() as dbcursor:
+                tags.backfill(dbcursor, [pid])
+    if uids:
+        forget_ranks(*uids)
+    for pid in pids:
+        bump_project(pid)
+
+
+@cli.command('import')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='jsonl', show_default=True)
+@click.option('--table', 'tables', type=click.Choice(TABLE_NAMES), multiple=True,
+              help='Only this table (can be given more than once).')
+@click.option('--chunk', default=1000, show_default=True, help='Rows per INSERT and transaction.')
+@click.option('--resume', is_flag=True,
+              help='Carry on from the last checkpoint (rows already there are skipped).')
+def import_command(directory, fmt, tables, chunk, resume):
+    """
+    Import the table files in DIRECTORY (as written by export).
+    """
+    checkpoint = load_checkpoint(directory, IMPORT_CHECKPOINT, fmt, resume)
+    selected = [entry for entry in TABLES
+                if (not tables or entry[0] in tables)
+                and os.path.exists(table_path(directory, entry[0], fmt))]
+    if not selected:
+        raise click.ClickException('no .{} table files in {}'.format(fmt, directory))
+
+    pids = set(checkpoint.get('pids', ()))
+    uids = set(checkpoint.get('uids', ()))
+    for table, key, columns in selected:
+        state = checkpoint['tables'].setdefault(table, {})
+        if state.get('done'):
+            click.echo('{}: already imported'.format(table))
+            continue
+        for newpids, newuids in import_table(directory, fmt, table, key, columns,
+                                             state, chunk, resume):
+            checkpoint['pids'] = sorted(pids | newpids)
+            checkpoint['uids'] = sorted(uids | newuids)
+            save_checkpoint(directory, IMPORT_CHECKPOINT, checkpoint)
+        pids.update(checkpoint['pids'])
+        uids.update(checkpoint['uids'])
+
+    rebuild([table for table, _, _ in selected], pids, uids)
+    click.echo('Imported from {}.'.format(directory))
+
+
+def init_app(app):
+    app.cli.add_command(cli)
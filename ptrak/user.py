@@ -7,20 +7,34 @@ functionality.
 import functools
 # a few flask components
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, url_for
+    Blueprint, current_app, flash, g, redirect, render_template, request,
+    session, url_for
 )
-# functions for generating and checking password hashes
-# check_password_hash() is needed because you can hash a password twice
+# functions for generating and checking password hashes (in a process pool)
+# check_password() is needed because you can hash a password twice
 # and get two different results, courtesy of salting
-from werkzeug.security import check_password_hash, generate_password_hash
+from ptrak.passwords import PasswordBusy, check_password, hash_password, needs_rehash
 # import our get_db() function
-from ptrak.db import get_db, mystify, demystify
+from ptrak.db import get_db, mystify, demystify, transaction
+from ptrak.cache import get_cache
+from ptrak.access import forget_ranks
+from ptrak import membership
+from ptrak.people import person, forget_person
+from ptrak.directory import add_user
+from ptrak.fragments import bump_project
 from time import time
 import re
 
 # init the blueprint object
 bp = Blueprint('user', __name__, url_prefix='/user')
 
+# shown when the password hashing pool is full (see ptrak.passwords)
+BUSY = 'The server is busy right now. Please try again in a moment.'
+
+# the logged-in user's row, on every request that isn't cached
+# (``flask check-queries`` EXPLAINs this one, and the others like it)
+USER_QUERY = 'SELECT * FROM Users WHERE uid = (%s)'
+
 
 @bp.before_app_request
 def load_logged_in_user():
@@ -29,25 +43,44 @@ def load_logged_in_user():
     Its decorator makes sure this function gets called
     before each request so that user data is available
     before any view function is called (for example).
+
+    The user row is cached (see ``ptrak.cache``); anything that
+    changes it must call ``forget_user()``. That includes the
+    ``unreadcount`` column, which is what the navbar badge shows.
     """
     uid = session.get('uid')
 
-    if uid is None:
-        g.user = None
-    else:
+    # static files never look at the user, so don't bother
+    if uid is None or request.endpoint == 'static':
+        g.user = g.me = None
+        return
+
+    key = user_cache_key(uid)
+    cached = get_cache().get(key)
+    if cached is None:
         dbcursor = get_db().cursor()
-        dbcursor.execute(
-            'SELECT * FROM Users WHERE uid = (%s)', (uid,)
-        )
-        g.user = dbcursor.fetchone()
-        dbcursor.execute(
-            'SELECT subject, content, date_sent, firstname, lastname'
-            ' FROM Messages JOIN Users on source=uid'
-            ' WHERE destination = (%s) AND unread=1'
-            ' ORDER BY date_sent DESC',
-            (uid,)
-        )
-        g.unreadmsgs = dbcursor.fetchall()
+        dbcursor.execute(USER_QUERY, (uid,))
+        user = dbcursor.fetchone()
+        if user is not None:
+            # no need to keep the hash around (or ship it to a shared cache)
+            user.pop('password', None)
+        cached = user
+        get_cache().set(key, cached, current_app.config['USER_CACHE_TTL'])
+    g.user = cached
+    g.unreadcount = cached['unreadcount'] if cached is not None else 0
+    # the user's decoded name and email, for the templates
+    g.me = person(cached) if cached is not None else None
+
+def user_cache_key(uid):
+    return 'user:{}'.format(uid)
+
+def forget_user(uid):
+    """
+    Drop the cached row for ``uid``.
+    Call this whenever it changes.
+    """
+    get_cache().delete(user_cache_key(uid))
+    forget_person(uid)
 
 @bp.after_app_request
 def update_lastrequest(response):
@@ -123,10 +156,26 @@ def login():
         )
         user_result = dbcursor.fetchone()
 
-        if user_result is None:
-            error = 'Incorrect username.'
-        elif not check_password_hash(user_result['password'], password):
-            error = 'Incorrect password.'
+        try:
+            if user_result is None:
+                error = 'Incorrect username.'
+            elif not check_password(user_result['password'], password):
+                error = 'Incorrect password.'
+        except PasswordBusy:
+            # fail fast rather than queue up behind everyone else
+            flash(BUSY, category='warning')
+            return render_template('user/login.html'), 503
+
+        if error is None and needs_rehash(user_result['password']):
+            # the hash method or cost has changed since this hash was
+            # made, and this is the only time we have the password to redo it
+            try:
+                dbcursor.execute(
+                    'UPDATE Users SET password=%s WHERE uid=%s',
+                    (hash_password(password), user_result['uid'],)
+                )
+            except PasswordBusy:
+                pass    # it'll be done next time
 
         if error is None:
             # empty the session and store the user's uid in it
@@ -137,6 +186,7 @@ def login():
                 'UPDATE Users SET lastlogin=CURRENT_TIMESTAMP WHERE uid=(%s)',
                 (session['uid'],)
             )
+            forget_user(session['uid'])
             firstname = demystify(user_result['firstname'])
             lastname = demystify(user_result['lastname'])
             if password == firstname[0]+lastname:
@@ -163,12 +213,18 @@ def resetPwd():
 
             #insert new user
             if error is None:
+                try:
+                    pwhash = hash_password(password1)
+                except PasswordBusy:
+                    flash(BUSY, category='warning')
+                    return render_template('user/resetPwd.html'), 503
                 dbcursor = get_db().cursor()
                 dbcursor.execute(
                     'UPDATE Users SET '
                     'password = %s WHERE uid = %s',
-                    (generate_password_hash(password1), session['uid'])
+                    (pwhash, session['uid'])
                 )
+                forget_user(session['uid'])
                 flash('Password successfully reset!', category='success')
                 return redirect(url_for('my.dashboard'))
             flash(error, category='warning')
@@ -207,20 +263,32 @@ def new():
         elif level is None:
             error = 'No level assigned!'
 
-        #insert new user
+        # their first password (hashed before the transaction starts,
+        # so it isn't held open while we wait)
         if error is None:
-            dbcursor.execute(
-                'INSERT INTO Users (firstname, lastname, email, password, level) '
-                'VALUES (%s, %s, %s, %s, %s)',
-                (mystify(firstname), mystify(lastname), mystify(email), generate_password_hash(firstname[0]+lastname), level,)
-            )
+            try:
+                pwhash = hash_password(firstname[0]+lastname)
+            except PasswordBusy:
+                flash(BUSY, category='warning')
+                return render_template('user/new.html', allprojects=allprojects), 503
 
-            for pid in projects:
+        #insert new user, along with their projects
+        if error is None:
+            with transaction() as dbcursor:
                 dbcursor.execute(
-                    'INSERT INTO Involvements (uid, pid, rank)'
-                    ' VALUES (LAST_INSERT_ID(), %s, 1)',
-                    (pid,)
+                    'INSERT INTO Users (firstname, lastname, email, password, level) '
+                    'VALUES (%s, %s, %s, %s, %s)',
+                    (mystify(firstname), mystify(lastname), mystify(email), pwhash, level,)
+                )
+                newuid = dbcursor.lastrowid
+                membership.apply_changes(
+                    dbcursor, add=[(newuid, pid, 1) for pid in projects]
                 )
+                for pid in projects:
+                    bump_project(pid, dbcursor)
+            forget_ranks(newuid)
+            # pickers can find them straight away
+            add_user(newuid, firstname, lastname, email)
 
             flash('User successfully added.', category='success')
             return redirect(url_for('my.dashboard'))
@@ -0,0 +1,115 @@
+import datetime
+
+import pytest
+
+from ptrak import create_app
+from ptrak import feed, membership, tags
+from ptrak.db import get_db, get_pool, mystify, transaction
+from ptrak.passwords import hash_password
+
+PASSWORD = 'correct horse'
+
+# uid: (firstname, lastname, level)
+USERS = {
+    1: ('Mona', 'Manager', 3),
+    2: ('Cody', 'Contributor', 1),
+    3: ('Otto', 'Outsider', 3),
+}
+
+
+def seed(dbcursor):
+    """
+    Two projects: 1 is managed by user 1, with user 2 on it as a
+    contributor; 2 belongs to user 3 alone. Project 1 has a tagged
+    task and an announcement, and user 1 has an unread message.
+    """
+    password = hash_password(PASSWORD)
+    dbcursor.executemany(
+        'INSERT INTO Users (uid, firstname, lastname, email, password, level)'
+        ' VALUES (%s, %s, %s, %s, %s, %s)',
+        [(uid, mystify(first), mystify(last), mystify('user{}@example.com'.format(uid)),
+          password, level) for uid, (first, last, level) in USERS.items()]
+    )
+    due = datetime.datetime(2030, 1, 1)
+    dbcursor.executemany(
+        'INSERT INTO Projects (pid, title, owner, description, date_due)'
+        ' VALUES (%s, %s, %s, %s, %s)',
+        [(1, 'Apollo', 1, 'Get to the moon.', due),
+         (2, 'Gemini', 3, 'Practice first.', due)]
+    )
+    membership.apply_changes(dbcursor, add=[(1, 1, 3), (2, 1, 1), (3, 2, 3)])
+    dbcursor.execute(
+        'INSERT INTO Tasks (tid, pid, creator, status, title, description)'
+        " VALUES (1, 1, 1, 'new', 'Build a rocket', 'Big.\nAnd tall.')"
+    )
+    tags.set_tags(dbcursor, 1, 1, ['engines'])
+    dbcursor.execute(
+        "INSERT INTO Announcements (aid, pid, author, content) VALUES (1, 1, 1, 'Launch on Friday.')"
+    )
+    feed.fan_out(dbcursor, 1)
+    dbcursor.execute(
+        'INSERT INTO Messages (destination, source, subject, content)'
+        " VALUES (1, 2, 'Fuel', 'We need more of it.')"
+    )
+    dbcursor.execute('UPDATE Users SET unreadcount=1 WHERE uid=1')
+
+
+@pytest.fixture
+def app():
+    app = create_app({
+        'TESTING': True,
+        'SECRET_KEY': b'test',
+        'DB_BACKEND': 'sqlite',
+        'SQLITE_PATH': ':memory:',
+        # hash inline, and cheaply
+        'PASSWORD_WORKERS': 0,
+        'PASSWORD_METHOD': 'pbkdf2:sha256:1',
+    })
+    result = app.test_cli_runner().invoke(args=['migrate'])
+    assert result.exit_code == 0, result.output
+    with app.app_context():
+        with transaction() as dbcursor:
+            seed(dbcursor)
+
+    yield app
+
+    # the in-memory database goes with the last connection to it
+    with app.app_context():
+        get_pool().dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def query(app):
+    """
+    Run a query against the test database, outside of any request.
+
+    :return: the rows
+    """
+    def query(sql, args=()):
+        with app.app_context():
+            dbcursor = get_db().cursor()
+            dbcursor.execute(sql, args)
+            return dbcursor.fetchall()
+    return query
+
+
+class AuthActions:
+    def __init__(self, client):
+        self._client = client
+
+    def login(self, uid=1):
+        return self._client.post('/user/login', data=dict(
+            email='user{}@example.com'.format(uid), password=PASSWORD))
+
+    def logout(self):
+        return self._client.get('/user/logout')
+
+
+@pytest.fixture
+def auth(client):
+    return AuthActions(client)
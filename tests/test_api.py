@@ -0,0 +1,79 @@
+def test_login_required(client):
+    response = client.get('/api/projects')
+    assert response.status_code == 401
+    assert response.get_json()['error']
+
+
+def test_projects(client, auth):
+    auth.login()
+    items = client.get('/api/projects').get_json()['items']
+    assert [(item['pid'], item['rank']) for item in items] == [(1, 3)]
+
+
+def test_project_not_involved(client, auth):
+    auth.login()
+    assert client.get('/api/projects/2').status_code == 404
+
+
+def test_tasks(client, auth):
+    auth.login()
+    response = client.get('/api/projects/1/tasks?fields=tid,title')
+    assert response.status_code == 200
+    assert response.get_json() == {'items': [{'tid': 1, 'title': 'Build a rocket'}], 'next': None}
+    assert response.headers['ETag']
+
+
+def test_tasks_not_modified(client, auth):
+    auth.login()
+    etag = client.get('/api/projects/1/tasks').headers['ETag']
+    response = client.get('/api/projects/1/tasks', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    # until something changes
+    client.post('/project/1', data=dict(status='complete', taskid='1'))
+    response = client.get('/api/projects/1/tasks', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+
+
+def test_tasks_filtered(client, auth):
+    auth.login()
+    response = client.get('/api/projects/1/tasks?status=new&tag=engines')
+    assert [item['tid'] for item in response.get_json()['items']] == [1]
+    # only the ETag can be trusted on a filtered list
+    assert 'Last-Modified' not in response.headers
+    assert client.get('/api/projects/1/tasks?status=complete').get_json()['items'] == []
+    assert client.get('/api/projects/1/tasks?status=done').status_code == 400
+
+
+def test_tasks_paged(client, auth):
+    auth.login()
+    for number in range(3):
+        client.post('/project/1/newtask', data=dict(
+            title='Task {}'.format(number), date_due='2030-02-01 12:00',
+            description='', status='new', tags=''))
+    first = client.get('/api/projects/1/tasks?limit=2&fields=tid').get_json()
+    assert len(first['items']) == 2 and first['next']
+    rest = client.get('/api/projects/1/tasks?limit=2&fields=tid&cursor=' + first['next']).get_json()
+    assert len(rest['items']) == 2 and rest['next'] is None
+    tids = [item['tid'] for item in first['items'] + rest['items']]
+    assert sorted(tids) == [1, 2, 3, 4]
+
+
+def test_announcements(client, auth):
+    auth.login(2)
+    items = client.get('/api/projects/1/announcements').get_json()['items']
+    assert [item['content'] for item in items] == ['Launch on Friday.']
+
+
+def test_messages(client, auth):
+    auth.login()
+    response = client.get('/api/messages')
+    assert [item['subject'] for item in response.get_json()['items']] == ['Fuel']
+    # reading it here doesn't mark it as read
+    assert b'Fuel' in client.get('/my/dashboard').data
+
+
+def test_users(client, auth):
+    auth.login()
+    response = client.get('/api/users?q=ott')
+    assert response.status_code == 200
+    assert 3 in [item['uid'] for item in response.get_json()['items']]
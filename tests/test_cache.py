@@ -0,0 +1,16 @@
+import socket
+
+from ptrak.cache import RedisCache
+
+
+def test_redis_failed_sets_counted_apart():
+    # a port nothing is listening on
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    cache = RedisCache(port=port, timeout=0.1)
+    cache.set('key', 'value')
+    stats = cache.stats()
+    assert stats['sets'] == 0
+    assert stats['failed_sets'] == 1
+    assert cache.get('key') is None
@@ -0,0 +1,83 @@
+import datetime
+import sqlite3
+
+from ptrak.db import fetch_concurrently, read
+from ptrak.instrument import ENVIRON_KEY
+from ptrak.migrate import MIGRATIONS
+from ptrak.pool import ConnectionPool
+
+
+def test_migrate_is_idempotent(app):
+    result = app.test_cli_runner().invoke(args=['migrate'])
+    assert 'Already up to date (version {}).'.format(MIGRATIONS[-1][0]) in result.output
+
+
+def test_check_queries(app):
+    result = app.test_cli_runner().invoke(args=['check-queries'])
+    assert result.exit_code == 0, result.output
+
+
+def test_fetch_concurrently(app):
+    with app.test_request_context('/'):
+        reads = [read('SELECT uid FROM Users WHERE uid=%s', (uid,), one=True)
+                 for uid in (3, 1, 2, 1, 3)]
+        rows = fetch_concurrently(*reads)
+    assert [row['uid'] for row in rows] == [3, 1, 2, 1, 3]
+
+
+def test_streamed_page_queries_recorded(client, auth):
+    auth.login()
+    # the queries run while a streamed page is sent are recorded too
+    queries = client.environ_base[ENVIRON_KEY] = []
+    response = client.get('/my/messages')
+    response.get_data()
+    response.close()
+    statements = [statement for statement, _, _ in queries]
+    assert any('FROM Messages JOIN Users' in statement for statement in statements)
+    assert any(statement.startswith('UPDATE Messages') for statement in statements)
+
+
+def test_sqlite_conversions_are_per_backend(app, query):
+    # the app's timestamps come back as datetimes, and bytes go in as text
+    row = query('SELECT date_made, %s AS word FROM Announcements', (b'hello',))[0]
+    assert isinstance(row['date_made'], datetime.datetime)
+    assert row['word'] == 'hello'
+    # without changing what sqlite3 does for anyone else
+    other = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES)
+    other.execute('CREATE TABLE t (stamp DATETIME, data BLOB)')
+    other.execute('INSERT INTO t VALUES (?, ?)', ('2030-01-01 00:00:00', b'\x00\xff'))
+    assert other.execute('SELECT stamp, data FROM t').fetchone() == \
+        ('2030-01-01 00:00:00', b'\x00\xff')
+    other.close()
+
+
+class FakeConnection:
+    closed = False
+
+    def rollback(self):
+        pass
+
+    def get_autocommit(self):
+        return True
+
+    def close(self):
+        self.closed = True
+
+
+def test_pool_resets_returned_connections():
+    resets = []
+    pool = ConnectionPool(FakeConnection, reset=resets.append, size=1, pre_ping=False)
+    conn = pool.checkout()
+    pool.checkin(conn)
+    assert resets == [conn]
+    assert pool.checkout() is conn
+
+
+def test_pool_closes_connections_it_cannot_reset():
+    def reset(conn):
+        raise OSError('COM_RESET_CONNECTION not supported')
+    pool = ConnectionPool(FakeConnection, reset=reset, size=1, pre_ping=False)
+    conn = pool.checkout()
+    pool.checkin(conn)
+    assert conn.closed
+    assert pool.checkout() is not conn
@@ -0,0 +1,65 @@
+def test_dashboard(client, auth):
+    auth.login()
+    response = client.get('/my/dashboard')
+    assert response.status_code == 200
+    assert b'Apollo' in response.data
+    assert b'Gemini' not in response.data
+    assert b'Launch on Friday.' in response.data
+    # the unread message is previewed
+    assert b'Fuel' in response.data
+
+
+def test_messages_marks_read(client, auth, query):
+    auth.login()
+    response = client.get('/my/messages')
+    assert response.status_code == 200
+    assert b'We need more of it.' in response.get_data()
+    response.close()
+    assert query('SELECT unread FROM Messages WHERE destination=1') == [{'unread': 0}]
+    assert query('SELECT unreadcount FROM Users WHERE uid=1') == [{'unreadcount': 0}]
+
+
+def test_send_message(client, auth, query):
+    auth.login(2)
+    response = client.post('/my/messages', data=dict(
+        destination='1', subject='Re: Fuel', content='Ordered some.'))
+    assert b'Message sent!' in response.get_data()
+    rows = query('SELECT source, subject FROM Messages WHERE destination=1 ORDER BY mid')
+    assert rows[-1] == {'source': 2, 'subject': 'Re: Fuel'}
+    assert query('SELECT unreadcount FROM Users WHERE uid=1') == [{'unreadcount': 2}]
+
+
+def test_send_message_invalid_destination(client, auth, query):
+    auth.login(2)
+    for destination in ('nobody', '99'):
+        response = client.post('/my/messages', data=dict(
+            destination=destination, subject='Hello', content='Anyone?'))
+        assert b'Invalid destination.' in response.get_data()
+    assert len(query('SELECT mid FROM Messages')) == 1
+
+
+def test_tagged(client, auth):
+    auth.login()
+    response = client.get('/my/tagged?tag=engines')
+    assert b'Build a rocket' in response.data
+
+
+def test_stream_closed_unstarted(app):
+    from ptrak.notify import get_broker, stream
+    # a client that goes away before the stream has sent anything
+    with app.test_request_context('/my/events'):
+        for _ in range(3):
+            stream('user:1').close()
+        assert get_broker().stats()['subscribers'] == 0
+
+
+def test_search(client, auth):
+    auth.login()
+    assert b'Build a rocket' in client.get('/my/search?q=rocket').data
+    assert b'Build a rocket' in client.get('/my/search?q=rocket&project=1').data
+
+
+def test_search_other_project(client, auth):
+    auth.login()
+    for project in ('2', '99', 'apollo'):
+        assert client.get('/my/search?q=rocket&project=' + project).status_code == 404
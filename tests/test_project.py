@@ -0,0 +1,194 @@
+import pytest
+
+from ptrak.fragments import project_version
+from ptrak.instrument import ENVIRON_KEY
+
+
+def version(app, pid=1):
+    with app.app_context():
+        return project_version(pid)
+
+
+def test_project_page(client, auth):
+    auth.login()
+    response = client.get('/project/1')
+    assert response.status_code == 200
+    data = response.get_data()
+    assert b'Apollo' in data
+    assert b'Build a rocket' in data
+    assert b'Launch on Friday.' in data
+    assert b'Contributor' in data
+
+
+def test_project_page_not_involved(client, auth):
+    auth.login()
+    response = client.get('/project/2')
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/my/dashboard')
+
+
+def test_project_page_tag_filter(client, auth):
+    auth.login()
+    assert b'Build a rocket' in client.get('/project/1?tag=engines').get_data()
+    assert b'Build a rocket' not in client.get('/project/1?tag=paint').get_data()
+
+
+def test_status_update(app, client, auth, query):
+    auth.login(2)
+    before = version(app)
+    response = client.post('/project/1', data=dict(status='in progress', taskid='1'))
+    assert response.status_code == 302
+    assert query('SELECT status FROM Tasks WHERE tid=1') == [{'status': 'in progress'}]
+    assert version(app) > before
+
+
+def test_newtask(app, client, auth, query):
+    auth.login(2)
+    client.get('/project/1').get_data()
+    before = version(app)
+    response = client.post('/project/1/newtask', data=dict(
+        title='Paint it', date_due='2030-02-01 12:00', description='White.',
+        status='new', tags='Paint, outside'))
+    assert response.status_code == 302
+    rows = query("SELECT tid, tags FROM Tasks WHERE title='Paint it'")
+    assert len(rows) == 1
+    assert query('SELECT tag FROM TaskTags WHERE tid=%s ORDER BY tag', (rows[0]['tid'],)) == \
+        [{'tag': 'outside'}, {'tag': 'paint'}]
+    assert version(app) > before
+    # not the cached board from before
+    assert b'Paint it' in client.get('/project/1').get_data()
+
+
+def test_announce(client, auth, query):
+    auth.login()
+    response = client.post('/project/1/announce', data=dict(content='Scrubbed.'))
+    assert response.status_code == 302
+    aid = query("SELECT aid FROM Announcements WHERE content='Scrubbed.'")[0]['aid']
+    # in the feed of everyone on the project
+    assert query('SELECT uid FROM AnnouncementFeed WHERE aid=%s ORDER BY uid', (aid,)) == \
+        [{'uid': 1}, {'uid': 2}]
+    auth.login(2)
+    assert b'Scrubbed.' in client.get('/my/dashboard').data
+
+
+def test_edit(client, auth, query):
+    auth.login()
+    assert client.get('/project/1/edit').status_code == 200
+    response = client.post('/project/1/edit', data=dict(
+        title='Apollo 11', description='Land on the moon.', date_due='2030-07-20 20:17',
+        toadd=['3']))
+    assert response.status_code == 302
+    assert query('SELECT title FROM Projects WHERE pid=1') == [{'title': 'Apollo 11'}]
+    assert query('SELECT `rank` FROM Involvements WHERE pid=1 AND uid=3') == [{'rank': 1}]
+
+
+def test_edit_needs_manager(client, auth, query):
+    auth.login(2)
+    response = client.post('/project/1/edit', data=dict(
+        title='Mine now', description='', date_due=''))
+    assert response.status_code == 302
+    assert query('SELECT title FROM Projects WHERE pid=1') == [{'title': 'Apollo'}]
+
+
+def test_edit_cant_remove_self(client, auth, query):
+    auth.login()
+    client.post('/project/1/edit', data=dict(
+        title='Apollo', description='Get to the moon.', date_due='', toremove=['1']))
+    assert query('SELECT uid FROM Involvements WHERE pid=1 AND uid=1')
+
+
+def test_members(client, auth, query):
+    auth.login()
+    response = client.post('/project/1/members', json={'add': [3], 'rank': {'2': 2}})
+    assert response.status_code == 200
+    assert response.get_json()['affected'] == [2, 3]
+    assert query('SELECT uid, `rank` FROM Involvements WHERE pid=1 ORDER BY uid') == \
+        [{'uid': 1, 'rank': 3}, {'uid': 2, 'rank': 2}, {'uid': 3, 'rank': 1}]
+
+
+@pytest.mark.parametrize(('uid', 'changes', 'status'), [
+    # a contributor can't change the team
+    (2, {'add': [3]}, 403),
+    # nobody can change their own membership
+    (1, {'remove': [1]}, 403),
+    (1, {'rank': {'1': 1}}, 403),
+    # not JSON, or not sensible
+    (1, ['add', 3], 400),
+    (1, {'add': ['three']}, 400),
+    (1, {'rank': {'2': 7}}, 400),
+    # a user that doesn't exist
+    (1, {'add': [99]}, 400),
+])
+def test_members_rejected(client, auth, query, uid, changes, status):
+    auth.login(uid)
+    response = client.post('/project/1/members', json=changes)
+    assert response.status_code == status
+    assert 'error' in response.get_json()
+    assert query('SELECT uid, `rank` FROM Involvements WHERE pid=1 ORDER BY uid') == \
+        [{'uid': 1, 'rank': 3}, {'uid': 2, 'rank': 1}]
+
+
+def test_members_rank_above_own(client, auth, query):
+    auth.login()
+    client.post('/project/1/members', json={'rank': {'2': 2}})
+    query('UPDATE Users SET level=3 WHERE uid=2')
+    # a rank 2 member can't hand out rank 3, or touch the manager
+    auth.login(2)
+    response = client.post('/project/1/members', json={'rank': {'3': 3}})
+    assert response.status_code == 403
+    assert 'above your own' in response.get_json()['error']
+    response = client.post('/project/1/members', json={'remove': [1]})
+    assert response.status_code == 403
+    assert 'as high as you' in response.get_json()['error']
+    # but can add a contributor
+    assert client.post('/project/1/members', json={'add': [3]}).status_code == 200
+
+
+def test_removed_member_loses_access(client, auth, query):
+    auth.login(2)
+    assert client.get('/project/1').status_code == 200
+    # as if by another worker, whose in-process cache this one can't see
+    query('DELETE FROM Involvements WHERE uid=2 AND pid=1')
+    response = client.get('/project/1')
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/my/dashboard')
+
+
+def test_settings(client, auth):
+    auth.login()
+    queries = client.environ_base[ENVIRON_KEY] = []
+    assert client.get('/project/1/settings').status_code == 200
+    statements = ' '.join(statement for statement, _, _ in queries)
+    # just the project, not the board
+    assert 'FROM Projects' in statements
+    assert 'Tasks' not in statements and 'Announcements' not in statements
+
+
+def sync_members(app, tmp_path, *lines):
+    source = tmp_path / 'members.jsonl'
+    source.write_text('\n'.join(lines) + '\n')
+    return app.test_cli_runner().invoke(args=['sync-members', str(source)])
+
+
+def test_sync_members(app, tmp_path, query):
+    result = sync_members(app, tmp_path, '{"pid": 2, "uid": 1, "rank": 1}',
+                          '{"pid": 1, "uid": 2, "remove": true}')
+    assert result.exit_code == 0, result.output
+    assert query('SELECT uid, pid FROM Involvements ORDER BY uid, pid') == \
+        [{'uid': 1, 'pid': 1}, {'uid': 1, 'pid': 2}, {'uid': 3, 'pid': 2}]
+
+
+@pytest.mark.parametrize(('entry', 'error'), [
+    ('{"uid": 3}', 'line 2: needs a numeric "pid"'),
+    ('{"pid": "1", "uid": 3}', 'line 2: needs a numeric "pid"'),
+    ('{"pid": 1}', 'line 2: needs a "uid" or an "email"'),
+    ('{"pid": 1, "uid": "3"}', 'line 2: "uid" must be a number'),
+    ('{"pid": 1, "uid": 3, "rank": "high"}', 'line 2: "rank" must be a number'),
+    ('[1, 3]', 'line 2: not a JSON object'),
+    ('{"pid": 1, "email": "nobody@example.com"}', 'line 2: unknown user nobody@example.com'),
+])
+def test_sync_members_bad_entry(app, tmp_path, query, entry, error):
+    result = sync_members(app, tmp_path, '{"pid": 2, "uid": 1}', entry)
+    assert result.exit_code != 0
+    assert error in result.output
+    assert query('SELECT uid FROM Involvements WHERE pid=2') == [{'uid': 3}]
@@ -0,0 +1,61 @@
+def test_edit_page(client, auth):
+    auth.login(2)
+    response = client.get('/task/edit/1')
+    assert response.status_code == 200
+    assert b'Build a rocket' in response.data
+
+
+def test_edit_not_involved(client, auth):
+    auth.login(3)
+    response = client.get('/task/edit/1')
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/my/dashboard')
+
+
+def test_edit(client, auth, query):
+    auth.login(2)
+    # cache the board first
+    client.get('/project/1').get_data()
+    response = client.post('/task/edit/1', data=dict(
+        title='Build a bigger rocket', description='Bigger.', date_due='2030-03-01 09:00',
+        status='under review', tags='engines, fuel'))
+    assert response.status_code == 302
+    assert query('SELECT title, status FROM Tasks WHERE tid=1') == \
+        [{'title': 'Build a bigger rocket', 'status': 'under review'}]
+    assert query('SELECT tag FROM TaskTags WHERE tid=1 ORDER BY tag') == \
+        [{'tag': 'engines'}, {'tag': 'fuel'}]
+    assert b'Build a bigger rocket' in client.get('/project/1').get_data()
+
+
+def test_notes(client, auth, query):
+    auth.login(2)
+    client.get('/project/1').get_data()
+    response = client.post('/task/1/notes', data=dict(content='Ordered the engines.'))
+    assert response.status_code == 302
+    assert query('SELECT author, content FROM Notes WHERE tid=1') == \
+        [{'author': 2, 'content': 'Ordered the engines.'}]
+    assert b'Ordered the engines.' in client.get('/task/1/notes').data
+    # the board shows the latest note
+    assert b'Ordered the engines.' in client.get('/project/1').get_data()
+
+
+def test_empty_note(client, auth, query):
+    auth.login(2)
+    client.post('/task/1/notes', data=dict(content='  '))
+    assert query('SELECT nid FROM Notes') == []
+
+
+def test_notes_not_involved(client, auth):
+    auth.login(3)
+    assert client.get('/task/1/notes').status_code == 404
+
+
+def test_edit_accented_tags(client, auth, query):
+    auth.login(2)
+    response = client.post('/task/edit/1', data=dict(
+        title='Build a rocket', description='', date_due='2030-03-01 09:00',
+        status='new', tags='Résumé, resume, RESUME'))
+    assert response.status_code == 302
+    # told apart like parse() does, not by a case- and accent-blind collation
+    assert query('SELECT tag FROM TaskTags WHERE tid=1 ORDER BY tag') == \
+        [{'tag': 'resume'}, {'tag': 'résumé'}]
@@ -0,0 +1,39 @@
+from flask import session
+
+
+def test_login_page(client):
+    assert client.get('/user/login').status_code == 200
+
+
+def test_login(client, auth):
+    response = auth.login()
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/my/dashboard')
+    with client:
+        client.get('/my/dashboard')
+        assert session['uid'] == 1
+
+
+def test_login_wrong_password(client):
+    response = client.post('/user/login', data=dict(
+        email='user1@example.com', password='wrong'))
+    assert b'Incorrect password.' in response.data
+
+
+def test_login_unknown_user(client):
+    response = client.post('/user/login', data=dict(
+        email='nobody@example.com', password='wrong'))
+    assert b'Incorrect username.' in response.data
+
+
+def test_login_required(client):
+    response = client.get('/my/dashboard')
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/user/login')
+
+
+def test_logout(client, auth):
+    auth.login()
+    with client:
+        auth.logout()
+        assert 'uid' not in session